@@ -125,14 +125,10 @@ class ParticleFilter:
         if not self.time % self.resample_window:
             offset = (np.arange(self.number_of_particles) + np.random.uniform()) / self.number_of_particles
             cumsum = np.cumsum(self.weights)
-            i, j = 0, 0
-            indexes = np.zeros(self.number_of_particles, 'i')
-            while i < self.number_of_particles and j < self.number_of_particles:
-                if offset[i] < cumsum[j]:  # reject
-                    indexes[i] = j
-                    i += 1
-                else:
-                    j += 1
+            # Particle j for the offsets in [cumsum[j-1], cumsum[j]). Offsets past
+            # the last cumsum (from rounding) are given particle 0.
+            indexes = np.searchsorted(cumsum, offset, side='right')
+            indexes[indexes == self.number_of_particles] = 0
             self.states = self.states[indexes]
             #print(self.states)
             self.weights = self.weights[indexes]
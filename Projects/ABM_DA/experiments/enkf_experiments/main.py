@@ -52,10 +52,13 @@ def run_enkf(model_params, filter_params):
     # Initialise filter with StationSim and params
     enkf = EnsembleKalmanFilter(Model, filter_params, model_params)
 
-    for i in range(filter_params['max_iterations']):
-        if i % 25 == 0:
-            print('step {0}'.format(i))
-        enkf.step()
+    try:
+        for i in range(filter_params['max_iterations']):
+            if i % 25 == 0:
+                print('step {0}'.format(i))
+            enkf.step()
+    finally:
+        enkf.close()
     return enkf
 
 def run_all(pop_size=20, its=300, assimilation_period=50, ensemble_size=10):
@@ -89,12 +89,10 @@ if __name__  == "__main__":
                                                               2*model.pop_total))
     
     nan_array = np.ones(shape = truths.shape)*np.nan
-    for i, agent in enumerate(model.agents):
-        "find which rows are  NOT (None, None). Store in index. "
-        array = np.array(agent.history_locations)
-        index = ~np.equal(array,None)[:,0]
-        "set anything in index to 1. I.E which agents are still in model."
-        nan_array[index,2*i:(2*i)+2] = 1
+    "history_locations is nan wherever an agent is not in the model. set the rest to 1."
+    history_locations = model.history_locations.data
+    index = ~np.isnan(history_locations.reshape(history_locations.shape[0], -1))
+    nan_array[index] = 1
         
     truths*=nan_array
     
@@ -9,9 +9,6 @@ Created on Mon Dec  2 11:42:17 2019
 import os
 import sys
 
-"used in fx to restore stepped model"
-from copy import deepcopy  
-
 class HiddenPrints:
     
     
@@ -34,7 +31,7 @@ def fx(x, **fx_kwargs):
     
     """Transition function for the StationSim
     
-    - Copies current base model
+    - Clones current base model (without its history)
     - Replaces positions with some sigma points
     - Step replaced model forwards one time point
     - record new stationsim positions as forecasted sigmapoint
@@ -58,7 +55,7 @@ def fx(x, **fx_kwargs):
     #model = pickle.load(f)
     #f.close()
     base_model = fx_kwargs["base_model"]
-    model = deepcopy(base_model)
+    model = base_model.clone()
     model.set_state(state = x,sensor="location")    
     with HiddenPrints():
         model.step() #step model with print suppression
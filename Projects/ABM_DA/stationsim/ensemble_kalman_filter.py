@@ -6,12 +6,12 @@ A class to represent a general Ensemble Kalman Filter for use with StationSim.
 """
 
 # Imports
-from copy import deepcopy as dcopy
 import warnings as warns
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 from filter import Filter
+from truth_producer import TruthProducer, check_mode
 
 # Classes
 class EnsembleKalmanFilter(Filter):
@@ -45,6 +45,9 @@ class EnsembleKalmanFilter(Filter):
         self.data_covariance = None
         self.keep_results = False
         self.vis = False
+        self.truth_producer = None
+        self.truth_cache = None
+        self.truth_queue_size = 16
 
         # Get filter attributes from params, warn if unexpected attribute
         for k, v in filter_params.items():
@@ -53,10 +56,20 @@ class EnsembleKalmanFilter(Filter):
                 warns.warn(w, RuntimeWarning)
             setattr(self, k, v)
 
-        # Set up ensemble of models
-        self.models = [dcopy(self.base_model) for _ in range(self.ensemble_size)]
-        self.vanilla_models = [dcopy(self.base_model) for _ in
-                               range(self.ensemble_size)]
+        # Set up ensemble of models, each with its own random number generator
+        self.models = self.base_model.spawn(self.ensemble_size)
+        self.vanilla_models = self.base_model.spawn(self.ensemble_size)
+
+        # Step the base model ahead of the filter in a thread or process,
+        # or replay it from the cache (see truth_producer), until close().
+        # Only for stationsim_model.Model
+        check_mode(self.truth_producer)
+        self.truth = None
+        if self.truth_producer is not None or self.truth_cache is not None:
+            process = self.truth_producer == 'process'
+            until = self.base_model.step_id + self.max_iterations
+            self.truth = TruthProducer(self.base_model, until, self.truth_queue_size,
+                                       process=process, cache=self.truth_cache)
 
         # Make sure that models have state
         # for m in self.models:
@@ -152,6 +165,22 @@ class EnsembleKalmanFilter(Filter):
         self.time += 1
         self.results.append(self.state_mean)
         self.vanilla_results.append(self.vanilla_state_mean)
+        if self.time >= self.max_iterations:
+            self.close()
+
+    def close(self):
+        """
+        Stop the truth producer, if there is one.
+        This is done by step() once max_iterations have been taken, and
+        should be done by anything that stops stepping the filter sooner.
+
+        Params:
+
+        Returns:
+            None
+        """
+        if self.truth is not None:
+            self.truth.close()
 
     def predict(self):
         """
@@ -162,7 +191,10 @@ class EnsembleKalmanFilter(Filter):
         Returns:
             None
         """
-        self.base_model.step()
+        if self.truth is None:
+            self.base_model.step()
+        else:
+            self.truth.step(self.base_model)
         for i in range(self.ensemble_size):
             self.models[i].step()
         for i in range(self.ensemble_size):
@@ -0,0 +1,112 @@
+'''
+Likelihoods
+    Observation models for the weights of a particle filter.
+
+Description:
+    A likelihood gives the log of the likelihood of an observation for every
+    particle at once, from what each particle predicts would be observed:
+
+        observe = ObservationOperator(operator)
+        log_weights = likelihood.log_likelihood(observe(states), observation,
+                                                observe.mask(active))
+
+    and the filter normalises the weights in log space (with logsumexp), so
+    that particles far from the observation do not all underflow to a weight
+    of zero.
+    The ObservationOperator maps the particle states to what is observed of
+    them: the whole state, some of its elements (say, the agents that a
+    camera sees), or a linear combination of them. The mask leaves out the
+    observed elements that depend on agents that are not active in the
+    truth, since where they are is not seen.
+'''
+
+import numpy as np
+
+
+class ObservationOperator:
+    '''
+    What is observed of a state.
+
+    Parameters:
+        operator - None to observe the whole state, the indices of the
+                   elements of the state that are observed, or an (M, D)
+                   matrix H that observes H @ state
+    '''
+    def __init__(self, operator=None):
+        self.indices, self.matrix = None, None
+        if operator is not None:
+            operator = np.asarray(operator)
+            if operator.ndim == 2:
+                self.matrix = operator.astype(float)
+            else:
+                self.indices = operator.astype(int)
+
+    def __call__(self, states):
+        '''
+        The observations of a state, or of each row of an array of states.
+        '''
+        states = np.asarray(states, dtype=float)
+        if self.matrix is not None:
+            return states @ self.matrix.T
+        if self.indices is not None:
+            return states[..., self.indices]
+        return states
+
+    def mask(self, state_mask):
+        '''
+        Which of the observed elements only depend on the elements of the state in state_mask.
+        '''
+        state_mask = np.asarray(state_mask, dtype=bool)
+        if self.matrix is not None:
+            return ~np.any(self.matrix[:, ~state_mask] != 0, axis=1)
+        if self.indices is not None:
+            return state_mask[self.indices]
+        return state_mask
+
+
+class GaussianLikelihood:
+    '''
+    Independent Gaussian errors of standard deviation std on each observed element.
+
+    Parameters:
+        std - the standard deviation of the observation errors
+    '''
+    def __init__(self, std):
+        self.std = float(std)
+
+    def log_likelihood(self, predicted, observation, mask=None):
+        '''
+        The log likelihood of the observation for each particle.
+
+        Parameters:
+            predicted   - (particles, M) array of what each particle would observe
+            observation - (M,) array of what was observed
+            mask        - the observed elements to use, or None for all of them
+        '''
+        residual = np.asarray(predicted, dtype=float) - observation
+        if mask is not None:
+            residual = residual[:, mask]
+        m = residual.shape[1]
+        return -.5 * np.sum((residual / self.std) ** 2, axis=1) - m * np.log(self.std * np.sqrt(2 * np.pi))
+
+
+class InverseSquareLikelihood:
+    '''
+    The weights 1 / distance**2 that the particle filter first used, in log space.
+
+    Description:
+        This is not a likelihood of the observation errors, and gives most of
+        the weight to the nearest few particles, but is kept to compare with
+        earlier runs.
+    '''
+    def log_likelihood(self, predicted, observation, mask=None):
+        residual = np.asarray(predicted, dtype=float) - observation
+        if mask is not None:
+            residual = residual[:, mask]
+        return -2 * np.log(np.linalg.norm(residual, axis=1) + 1e-9)
+
+
+LIKELIHOODS = {
+    'gaussian': GaussianLikelihood,
+    'inverse_square': InverseSquareLikelihood,
+}
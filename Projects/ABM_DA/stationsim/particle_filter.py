@@ -1,13 +1,16 @@
 from filter import Filter
 from stationsim_model import Model
+from particle_workers import ParticleWorkers, BatchParticles
+from truth_producer import TruthProducer, check_mode
+import resampling
+import likelihoods
 
 
 import numpy as np
+from scipy.special import logsumexp
 import matplotlib.pyplot as plt
-from copy import deepcopy
 import multiprocessing
 import warnings
-import itertools
 import time
 
 
@@ -33,6 +36,32 @@ class ParticleFilter(Filter):
          - agents_to_visualise:     The number of agents to plot particles for
          - model_std:               The standard deviation of the noise added to model observations
          - do_resample:             Whether or not to resample (default true, this is mainly for benchmarking)
+         - resample_scheme:         'systematic' (default), 'stratified', 'multinomial' or 'residual'
+                                    (see resampling.SCHEMES)
+         - ess_threshold:           If set, carry the weights from one window to the next and only resample
+                                    when the effective sample size falls below this fraction of the number
+                                    of particles. If not set (the default), resample at every window.
+         - likelihood:              How the particles are weighted, 'inverse_square' (default, 1/distance**2
+                                    as before) or 'gaussian', or an object with a log_likelihood method (see
+                                    likelihoods)
+         - likelihood_std:          The standard deviation of the 'gaussian' likelihood (default model_std ** 2,
+                                    that of the observation noise). The particles are not exactly the truth
+                                    model, so a few times that usually gives smaller errors.
+         - observation_operator:    What is observed of the state: None (default) for all of it, the indices
+                                    of the elements that are observed, or an (M, D) matrix
+         - mask_inactive:           Whether to leave the agents that are not active in the base model out of
+                                    the likelihood (default false)
+         - batch_predict:           Whether to step all of the particles together in the main process, as the
+                                    replicates of one stationsim_batch.BatchModel, rather than in worker
+                                    processes (default false, only for stationsim_model.Model)
+         - truth_producer:          Whether to step the base model ahead of the filter in a 'thread' or a
+                                    'process' of its own (see truth_producer), rather than in predict()
+                                    (default None, only for stationsim_model.Model)
+         - truth_cache:             A directory to save the trajectory of the base model in, and replay it
+                                    from in later runs of the same scenario (default None, implies a
+                                    'thread' truth_producer if that is not set, only for
+                                    stationsim_model.Model)
+         - truth_queue_size:        The most steps the truth_producer may run ahead (default 16)
          - do_save:                 Boolean to determine if data should be saved and stats printed
          - do_ani:                  Boolean to determine if particle filter data should be animated
                                     and displayed
@@ -42,22 +71,26 @@ class ParticleFilter(Filter):
         DESCRIPTION
         Firstly, set all attributes using filter parameters. Set time and
         initialise base model using model parameters. Initialise particle
-        models using a deepcopy of base model. Determine particle filter 
-        dimensions, initialise all remaining arrays, and set initial
-        particle states to the base model state using multiprocessing. 
+        models as clones of the base model, each with its own random number
+        generator spawned from the base model's seed, and hand them to the
+        worker processes (see particle_workers), which keep them for the
+        whole run. Determine particle filter dimensions, initialise all
+        remaining arrays, and set initial particle states to the base model
+        state. The particle states and weights are in shared memory, so
+        the workers see them too. With batch_predict the particle models
+        are instead the replicates of one BatchModel in this process.
+        With a truth_producer (or truth_cache) the base model is stepped
+        by a TruthProducer, which runs a clone of it ahead of the filter.
         '''
         for key, value in filter_params.items():
             setattr(self, key, value)
         self.time = 0
         self.number_of_iterations = model_params['batch_iterations']
         self.base_model = ModelClass(**model_params) # (Model does not need a unique id)
-        self.models = list([deepcopy(self.base_model) for _ in range(self.number_of_particles)])  
         self.dimensions = len(self.base_model.get_state(sensor='location'))
-        self.states = np.zeros((self.number_of_particles, self.dimensions))
-        self.weights = np.ones(self.number_of_particles)
         self.indexes = np.zeros(self.number_of_particles, 'i')
         self.window_counter = 0 # Just for printing the progress of the PF
-        # Pool object needed for multiprocessing
+        # Worker processes needed for multiprocessing
         if numcores == None:
             numcores = multiprocessing.cpu_count()
 
@@ -68,11 +101,87 @@ class ParticleFilter(Filter):
             self.do_resample = True
         if not self.do_resample:
             print("**Warning**: Not resampling. This should only be used for benchmarking")
+        # Systematic resampling unless another scheme has been set
+        try:
+            self.resample_scheme
+        except AttributeError:
+            self.resample_scheme = 'systematic'
+        if self.resample_scheme not in resampling.SCHEMES:
+            raise ValueError(f"Unknown resample_scheme '{self.resample_scheme}', expected one of "
+                             f"{', '.join(resampling.SCHEMES)}")
+        # Resample at every window unless an effective sample size threshold has been set
+        try:
+            self.ess_threshold
+        except AttributeError:
+            self.ess_threshold = None
+        self.ess = [] # The effective sample size after each reweight
+        # Weight by 1/distance**2 of the whole state of the active agents unless set otherwise
+        try:
+            self.likelihood
+        except AttributeError:
+            self.likelihood = 'inverse_square'
+        try:
+            self.likelihood_std
+        except AttributeError:
+            self.likelihood_std = self.model_std ** 2
+        if self.likelihood == 'gaussian':
+            self.likelihood = likelihoods.GaussianLikelihood(self.likelihood_std)
+        elif self.likelihood == 'inverse_square':
+            self.likelihood = likelihoods.InverseSquareLikelihood()
+        elif not hasattr(self.likelihood, 'log_likelihood'):
+            raise ValueError(f"Unknown likelihood '{self.likelihood}', expected one of "
+                             f"{', '.join(likelihoods.LIKELIHOODS)}")
+        try:
+            self.observation_operator
+        except AttributeError:
+            self.observation_operator = None
+        self.observation_operator = likelihoods.ObservationOperator(self.observation_operator)
+        try:
+            self.mask_inactive
+        except AttributeError:
+            self.mask_inactive = False
+        self.resampled = [] # Whether the particles were resampled after each reweight
+
+        # Step the base model in predict() unless a truth producer or cache has been set
+        try:
+            self.truth_producer
+        except AttributeError:
+            self.truth_producer = None
+        try:
+            self.truth_cache
+        except AttributeError:
+            self.truth_cache = None
+        try:
+            self.truth_queue_size
+        except AttributeError:
+            self.truth_queue_size = 16
+        check_mode(self.truth_producer)
 
         ## We get problems when there are more processes than particles (larger particle variance for some reason)
         #if numcores > self.number_of_particles:
         #    numcores = self.number_of_particles
-        self.pool = multiprocessing.Pool(processes=numcores)
+        try:
+            self.batch_predict
+        except AttributeError:
+            self.batch_predict = False
+        if self.batch_predict:
+            self.workers = BatchParticles(self.base_model.spawn(self.number_of_particles), self.dimensions)
+        else:
+            self.workers = ParticleWorkers(self.base_model.spawn(self.number_of_particles), self.dimensions,
+                                           ParticleFilter.step_particle, numcores)
+        numcores = len(self.workers.shards)
+        self.truth = None
+        if self.truth_producer is not None or self.truth_cache is not None:
+            # The most steps that step() will take the base model
+            until = self.number_of_iterations
+            if self.multi_step:
+                until = -(-self.number_of_iterations // self.resample_window) * self.resample_window
+            try:
+                self.truth = TruthProducer(self.base_model, self.base_model.step_id + until, self.truth_queue_size,
+                                           process=self.truth_producer == 'process', cache=self.truth_cache)
+            except BaseException: # Such as a cache that can not be written, stop the workers that were started
+                self.workers.close()
+                raise
         if self.do_save or self.p_save:
             self.active_agents = []
             self.mean_states = [] # Mean state of all partciles, weighted by distance from observations
@@ -92,6 +201,29 @@ class ParticleFilter(Filter):
             filter_params['number_of_particles'], filter_params['number_of_runs'], numcores, model_params["pop_total"]),
             flush=True)
 
+    @property
+    def states(self):
+        """
+        The particle states, one row per particle, in the shared memory of the workers.
+        Assigning to states copies into it, so the workers always see the current states.
+        """
+        return self.workers.states
+
+    @states.setter
+    def states(self, states):
+        self.workers.states[:] = states
+
+    @property
+    def weights(self):
+        """
+        The particle weights, in the shared memory of the workers (as for states).
+        """
+        return self.workers.weights
+
+    @weights.setter
+    def weights(self, weights):
+        self.workers.weights[:] = weights
+
     def initial_state(self, particle_number, base_model_state):
         """
         Set the state of the particles to the state of the
@@ -127,13 +259,12 @@ class ParticleFilter(Filter):
         :param particle_std: the particle noise standard deviation
         :param particle_shape: the shape of the particle array
         """
-        # Force the model to re-seed its random number generator (otherwise each child process
-        # has the same generator https://stackoverflow.com/questions/14504866/python-multiprocessing-numpy-random
-        model.set_random_seed()
+        # Each particle draws from its own generator (see Model.spawn), which is returned with the model, so
+        # the child processes do not need to re-seed https://stackoverflow.com/questions/14504866/python-multiprocessing-numpy-random
         for i in range(num_iter):
             model.step()
 
-        noise = np.random.normal(0, particle_std ** 2, size=particle_shape)
+        noise = model.random.normal(0, particle_std ** 2, size=particle_shape)
         state = model.get_state(sensor='location') + noise
         model.set_state(state, sensor='location')
         return model, state
@@ -196,7 +327,9 @@ class ParticleFilter(Filter):
 
                         if self.do_resample: # Can turn off resampling for benchmarking
                             self.reweight()
-                            self.resample()
+                            self.resampled.append(self.resample_due())
+                            if self.resampled[-1]:
+                                self.resample()
 
                         # Store the model states before and after resampling
                         if self.do_save or self.p_save:
@@ -206,8 +339,10 @@ class ParticleFilter(Filter):
                         if self.do_ani:
                             self.ani()
 
-                        print("\tFinished window {}, step {} (took {}s)".format(
-                            self.window_counter, self.time, round(float(time.time() - window_start_time), 2)))
+                        print("\tFinished window {}, step {} (took {}s){}".format(
+                            self.window_counter, self.time, round(float(time.time() - window_start_time), 2),
+                            ", ESS {:.1f}, {} resamples".format(self.ess[-1], sum(self.resampled))
+                            if self.do_resample else ""))
                         window_start_time = time.time()
 
                     elif self.multi_step:
@@ -256,36 +391,36 @@ class ParticleFilter(Filter):
             # If not saving then just return null
             return
 
-        finally: # Whatever happens, make sure the multiprocessing pool is colsed
-            self.pool.close()
+        finally: # Whatever happens, make sure the worker processes are stopped
+            self.workers.close()
+            if self.truth is not None:
+                self.truth.close()
 
     def predict(self, numiter=1):
         '''
         Predict
 
         DESCRIPTION
-        Increment time. Step the base model. Use a multiprocessing method to step
-        particle models, set the particle states as the agent
+        Increment time. Step the base model. Have the worker processes step
+        their particle models, set the particle states as the agent
         locations with some added noise, and reassign the
         locations of the particle agents using the new particle
-        states. We extract the models and states from the stepped
-        particles variable.
+        states. The workers write the new states straight into the
+        shared states array, and the models never leave the workers.
+        With batch_predict every particle is stepped at once, and the
+        noise is drawn for all of them together. With a truth producer
+        the base model is set to the next states of the truth instead,
+        which has already stepped them while the particles were stepped.
 
         :param numiter: The number of iterations to step (usually either 1, or the  resample window
         '''
         for i in range(numiter):
-            self.base_model.step()
-
-        stepped_particles = self.pool.starmap(ParticleFilter.step_particle, list(zip( \
-            range(self.number_of_particles),  # Particle numbers (in integer)
-            [m for m in self.models],  # Associated Models (a Model object)
-            [numiter] * self.number_of_particles,  # Number of iterations to step each particle (an integer)
-            [self.particle_std] * self.number_of_particles,  # Particle std (for adding noise) (a float)
-            [s.shape for s in self.states],  # Shape (for adding noise) (a tuple)
-        )))
+            if self.truth is None:
+                self.base_model.step()
+            else:
+                self.truth.step(self.base_model)
 
-        self.models = [stepped_particles[i][0] for i in range(len(stepped_particles))]
-        self.states = np.array([stepped_particles[i][1] for i in range(len(stepped_particles))])
+        self.workers.predict(numiter, self.particle_std)
 
         return
 
@@ -294,53 +429,83 @@ class ParticleFilter(Filter):
         Reweight
 
         DESCRIPTION
-        Add noise to the base model state to get a measured state. Calculate
-        the distance between the particle states and the measured base model
-        state and then calculate the new particle weights as 1/distance.
-        Add a small term to avoid dividing by 0. Normalise the weights.
+        Observe the base model (see observe). Calculate the log likelihood
+        of the observation for every particle at once, from what each
+        particle would observe (see likelihoods). With an ess_threshold
+        the log weights carried from the last windows are added.
+        Normalise the weights in log space with logsumexp, so that they
+        do not all underflow to 0, and record the effective sample size.
         '''
-        measured_state = (self.base_model.get_state(sensor='location')
-                          + np.random.normal(0, self.model_std ** 2, size=self.states.shape))
-        distance = np.linalg.norm(self.states - measured_state, axis=1)
-        self.weights = 1 / (distance + 1e-9) ** 2
-        self.weights /= np.sum(self.weights)
+        observation, mask = self.observe()
+        log_weights = self.likelihood.log_likelihood(self.observation_operator(self.states), observation, mask)
+        if self.ess_threshold is not None:
+            with np.errstate(divide='ignore'):
+                log_weights = log_weights + np.log(self.weights)
+        self.weights = np.exp(log_weights - logsumexp(log_weights))
+        self.ess.append(self.effective_sample_size())
 
         return
 
+    def observe(self):
+        '''
+        Observe the base model.
+
+        DESCRIPTION
+        Observe the base model state through the observation operator and
+        add noise to get a measured state. Also return the mask of the
+        observed elements that only depend on agents that are active in
+        the base model (or None to use all of them, without mask_inactive).
+        '''
+        observation = self.observation_operator(self.base_model.get_state(sensor='location'))
+        observation = observation + np.random.normal(0, self.model_std ** 2, size=observation.shape)
+        mask = None
+        if self.mask_inactive:
+            # The statuses, from the full state, which both models give as rows of (status, x, y, speed)
+            state = self.base_model.get_state()[1:].reshape(self.base_model.pop_total, -1)
+            mask = self.observation_operator.mask(np.repeat(state[:, 0] == 1, 2))
+        return observation, mask
+
+    def effective_sample_size(self):
+        '''
+        The effective sample size of the (normalised) weights, 1 / sum(w^2).
+        It is the number of particles if the weights are equal, and 1 if one particle has all of the weight.
+        '''
+        return 1 / np.sum(self.weights ** 2)
+
+    def resample_due(self):
+        '''
+        Whether to resample after this reweight: always, unless the ess_threshold is set, in which
+        case only when the effective sample size is below ess_threshold * number_of_particles.
+        '''
+        if self.ess_threshold is None:
+            return True
+        return self.effective_sample_size() < self.ess_threshold * self.number_of_particles
+
     def resample(self):
         '''
         Resample
 
         DESCRIPTION
-        Calculate a random partition of (0,1) and then
-        take the cumulative sum of the particle weights.
-        Carry out a systematic resample of particles.
-        Set the new particle states and weights and then
-        update agent locations in particle models using
-        multiprocessing methods.
+        Choose the particles to keep with the resample_scheme (see
+        resampling), which by default is a systematic resample of
+        particles. Set the new particle states and weights and then
+        have the workers update agent locations in their particle
+        models from the shared states (only the indexes are sent, and
+        only the particles whose index changed are updated). With an
+        ess_threshold the weights are carried to the next window, so
+        they start again equal.
         '''
-        offset_partition = ((np.arange(self.number_of_particles)
-                             + np.random.uniform()) / self.number_of_particles)
-        cumsum = np.cumsum(self.weights)
-        i, j = 0, 0
-        while i < self.number_of_particles:
-            if offset_partition[i] < cumsum[j]:
-                self.indexes[i] = j
-                i += 1
-            else:
-                j += 1
+        self.indexes[:] = resampling.SCHEMES[self.resample_scheme](self.weights)
 
         self.states[:] = self.states[self.indexes]
-        self.weights[:] = self.weights[self.indexes]
+        if self.ess_threshold is None:
+            self.weights[:] = self.weights[self.indexes]
+        else:
+            self.weights[:] = 1 / self.number_of_particles
 
         # self.unique_particles.append(len(np.unique(self.states,axis=0)))
 
-        # Could use pool.starmap here, but it's quicker to do it in a single process
-        self.models = list(itertools.starmap(ParticleFilter.assign_agents, list(zip(
-            range(self.number_of_particles),  # Particle numbers (in integer)
-            [s for s in self.states],  # States
-            [m for m in self.models]  # Associated Models (a Model object)
-        ))))
+        self.workers.assign(self.indexes)
         return
 
     def save(self, before: bool):
@@ -437,7 +602,7 @@ class ParticleFilter(Filter):
             markersizes += 8 - np.mean(markersizes)  # remean
 
             particle = -1
-            for model in self.models:
+            for model in self.workers.get_models():
                 particle += 1
                 markersize = np.clip(markersizes[particle], .5, 8)
                 for agent in model.agents[:self.agents_to_visualise]:
@@ -453,7 +618,7 @@ class ParticleFilter(Filter):
                     plt.plot(*agent.location, 'sk', markersize=4)
 
             plt.axis(np.ravel(self.base_model.boundaries, 'F'))
-            plt.title(f"{self.models[0].pop_total} agents, {self.number_of_particles} particles, {self.time} iterations", fontsize=13)
+            plt.title(f"{self.base_model.pop_total} agents, {self.number_of_particles} particles, {self.time} iterations", fontsize=13)
             plt.xlabel("X position")
             plt.ylabel("Y position")
             if self.show_ani:
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for particle_filter.
+
+Run from this directory with `python -m unittest particle_filter_tests`.
+"""
+
+import multiprocessing
+import unittest
+import warnings
+import tempfile
+import numpy as np
+from stationsim_model import Model
+from particle_filter import ParticleFilter
+from particle_workers import ParticleWorkers, BatchParticles
+from truth_producer import TruthProducer, get_frame
+import resampling
+import likelihoods
+from scipy import stats
+from scipy.special import logsumexp
+
+
+def systematic_loop(weights, u):
+    """The systematic resampling loop that ParticleFilter.resample used."""
+    n = len(weights)
+    offset_partition = (np.arange(n) + u) / n
+    cumsum = np.cumsum(weights)
+    indexes = np.zeros(n, 'i')
+    i, j = 0, 0
+    while i < n:
+        if offset_partition[i] < cumsum[j]:
+            indexes[i] = j
+            i += 1
+        else:
+            j += 1
+    return indexes
+
+
+class Test_Workers(unittest.TestCase):
+
+    def test_workers(self):
+
+        """The workers step their particles as step_particle does in one process.
+
+        Each particle draws from its own generator, so it does not matter
+        which worker steps it. After resampling the models are set to their
+        new states.
+        """
+
+        warnings.simplefilter('ignore')
+        base = Model(pop_total=10, width=50, height=20, gates_speed=.5, do_print=False, do_history=False,
+                     random_seed=2)
+        models = base.spawn(7)
+        expected = [model.clone() for model in models]
+        workers = ParticleWorkers(models, 20, ParticleFilter.step_particle, numcores=3)
+        try:
+            self.assertEqual([len(shard) for shard in workers.shards], [2, 2, 3])
+            for _ in range(3):
+                workers.predict(5, .5)
+                states = np.array([ParticleFilter.step_particle(i, model, 5, .5, (20,))[1]
+                                   for i, model in enumerate(expected)])
+                np.testing.assert_array_equal(workers.states, states)
+            indexes = np.array([0, 0, 1, 4, 4, 4, 6])
+            workers.states[:] = workers.states[indexes]
+            workers.assign(indexes)
+            for model, state in zip(workers.get_models(), workers.states):
+                np.testing.assert_array_equal(model.get_state(sensor='location'), state)
+        finally:
+            workers.close()
+        self.assertEqual(workers.states.shape, (7, 20))
+
+    def test_batch_particles(self):
+
+        """BatchParticles steps every particle as its own model would, and adds the noise in one draw."""
+
+        warnings.simplefilter('ignore')
+        base = Model(pop_total=10, width=50, height=20, gates_speed=.5, do_print=False, do_history=False,
+                     random_seed=2)
+        models = base.spawn(7)
+        expected = [model.clone() for model in models]
+        particles = BatchParticles(models, 20)
+        for _ in range(3):
+            particles.predict(5, 0)
+            for model in expected:
+                for _ in range(5):
+                    model.step()
+            np.testing.assert_array_equal(particles.states, [model.get_state('location') for model in expected])
+        particles.predict(5, .5)
+        for model in expected:
+            for _ in range(5):
+                model.step()
+        noise = particles.states - [model.get_state('location') for model in expected]
+        self.assertGreater(np.std(noise), 0)
+        np.testing.assert_array_equal(particles.states, particles.batch.get_state('location'))
+        indexes = np.array([0, 0, 1, 4, 4, 4, 6])
+        particles.states[:] = particles.states[indexes]
+        particles.assign(indexes)
+        for model, state in zip(particles.get_models(), particles.states):
+            np.testing.assert_array_equal(model.get_state(sensor='location'), state)
+
+
+class Test_Filter(unittest.TestCase):
+
+    model_params = dict(pop_total=5, width=50, height=20, gates_speed=.5, batch_iterations=60, do_print=False,
+                        do_history=False, random_seed=2)
+    filter_params = dict(number_of_particles=40, number_of_runs=1, resample_window=5, multi_step=True,
+                         particle_std=.5, model_std=1.0, agents_to_visualise=2, do_save=False, plot_save=False,
+                         do_ani=False, show_ani=False)
+
+    def test_ess_threshold(self):
+
+        """With an ess_threshold the filter only resamples when the ESS falls below it."""
+
+        warnings.simplefilter('ignore')
+        np.random.seed(0)
+        pf = ParticleFilter(Model, self.model_params, dict(self.filter_params, ess_threshold=.5), numcores=2)
+        pf.step()
+        self.assertEqual(len(pf.ess), 12)
+        self.assertEqual(pf.resampled, [ess < 20 for ess in pf.ess])
+        self.assertGreater(sum(pf.resampled), 0)
+        self.assertLess(sum(pf.resampled), 12)
+        self.assertAlmostEqual(pf.weights.sum(), 1)
+
+    def test_gcs_mask_inactive(self):
+
+        """A Grand Central base model can be filtered, with and without masking its inactive agents."""
+
+        from stationsim_gcs_model import Model as GCSModel
+        warnings.simplefilter('ignore')
+        model_params = dict(pop_total=5, batch_iterations=10, gates_speed=2, do_print=False, do_history=False,
+                            random_seed=2)
+        for mask_inactive in (False, True):
+            np.random.seed(0)
+            pf = ParticleFilter(GCSModel, model_params, dict(self.filter_params, mask_inactive=mask_inactive),
+                                numcores=2)
+            pf.step()
+            self.assertEqual(len(pf.ess), 2)
+            self.assertTrue(all(1 <= ess <= 40 for ess in pf.ess))
+
+    def test_truth_producer(self):
+
+        """The filter gives the same weights whether its base model is stepped in predict() or by a truth producer."""
+
+        warnings.simplefilter('ignore')
+        ess = []
+        for truth_producer in (None, 'thread'):
+            np.random.seed(0)
+            pf = ParticleFilter(Model, self.model_params, dict(self.filter_params, truth_producer=truth_producer),
+                                numcores=2)
+            pf.step()
+            ess.append(pf.ess)
+        self.assertEqual(ess[0], ess[1])
+
+    def test_bad_truth_producer(self):
+
+        """An unknown truth_producer is refused before any worker process is started."""
+
+        warnings.simplefilter('ignore')
+        with self.assertRaises(ValueError):
+            ParticleFilter(Model, self.model_params, dict(self.filter_params, truth_producer='proces'), numcores=2)
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_gcs_truth_producer(self):
+
+        """The truth producer refuses a Grand Central base model, and the workers are stopped."""
+
+        from stationsim_gcs_model import Model as GCSModel
+        warnings.simplefilter('ignore')
+        with self.assertRaises(TypeError):
+            ParticleFilter(GCSModel, dict(pop_total=5, batch_iterations=10, do_print=False),
+                           dict(self.filter_params, truth_producer='thread'), numcores=2)
+        self.assertEqual(multiprocessing.active_children(), [])
+
+
+class Test_Truth(unittest.TestCase):
+
+    def test_producer(self):
+
+        """The truth producers and the cache set the base model to the states it would step to itself.
+
+        That includes the generator, which the UKF clones the base model
+        with, and the history and analytics. The first run saves the
+        trajectory in the cache and the second replays it.
+        """
+
+        warnings.simplefilter('ignore')
+        params = dict(pop_total=10, width=50, height=20, gates_speed=.5, do_print=False, do_history=True,
+                      random_seed=4)
+        expected = Model(**params)
+        frames = []
+        for _ in range(150):
+            expected.step()
+            frames.append(get_frame(expected))
+        cache = tempfile.mkdtemp()
+        for options, replayed in ((dict(), False), (dict(process=True), False), (dict(cache=cache), False),
+                                  (dict(cache=cache), True)):
+            model = Model(**params)
+            truth = TruthProducer(model, 150, maxsize=4, **options)
+            try:
+                self.assertEqual(truth.replayed, replayed)
+                for frame in frames:
+                    truth.step(model)
+                    np.testing.assert_array_equal(get_frame(model), frame)
+                truth.step(model)  # Past `until` the model is left as it is
+                np.testing.assert_array_equal(get_frame(model), frames[-1])
+            finally:
+                truth.close()
+            self.assertEqual(model.random.bit_generator.state, expected.random.bit_generator.state)
+            for name in ('history_state', 'history_locations', 'history_collision_locs', 'history_collision_times',
+                         'history_wiggle_locs', 'steps_taken', 'steps_exped', 'steps_delay'):
+                np.testing.assert_array_equal(np.asarray(getattr(model, name)), np.asarray(getattr(expected, name)),
+                                              err_msg=name)
+            self.assertEqual(model.get_analytics(), expected.get_analytics())
+
+
+class Test_Resampling(unittest.TestCase):
+
+    def test_systematic(self):
+
+        """Systematic resampling gives the indexes of the loop."""
+
+        random = np.random.default_rng(0)
+        for n in (1, 10, 1000):
+            weights = random.exponential(size=n) ** 4
+            weights /= weights.sum()
+            u = np.random.default_rng(n).uniform()
+            np.testing.assert_array_equal(resampling.systematic(weights, np.random.default_rng(n)),
+                                          systematic_loop(weights, u))
+
+    def test_schemes(self):
+
+        """Every scheme keeps N particles, in order, as often as their weights on average."""
+
+        random = np.random.default_rng(1)
+        weights = random.exponential(size=50)
+        weights /= weights.sum()
+        for name, scheme in resampling.SCHEMES.items():
+            counts = np.zeros(50)
+            for _ in range(2000):
+                indexes = scheme(weights, random)
+                self.assertEqual(len(indexes), 50)
+                self.assertTrue(np.all(np.diff(indexes) >= 0))
+                counts += np.bincount(indexes, minlength=50)
+            np.testing.assert_allclose(counts / 2000, 50 * weights, atol=.25, err_msg=name)
+            if name in ('systematic', 'residual'):
+                self.assertTrue(np.all(np.bincount(indexes, minlength=50) >= np.floor(50 * weights)))
+
+
+class Test_Likelihoods(unittest.TestCase):
+
+    def test_gaussian(self):
+
+        """The Gaussian likelihood of what is observed of the active agents.
+
+        The observation operator picks some of the elements of the state, or
+        combines them, and the elements of inactive agents are masked out.
+        Far from the observation the weights still normalise in log space.
+        """
+
+        random = np.random.default_rng(3)
+        states = random.normal(0, 50, (30, 8))
+        active = np.repeat([True, False, True, True], 2)
+        observe = likelihoods.ObservationOperator([0, 1, 2, 6])
+        np.testing.assert_array_equal(observe(states), states[:, [0, 1, 2, 6]])
+        np.testing.assert_array_equal(observe.mask(active), [True, True, False, True])
+        matrix = likelihoods.ObservationOperator(np.eye(8)[[0, 1, 2, 6]] + np.eye(8)[[7, 7, 7, 7]])
+        np.testing.assert_array_equal(matrix(states), states[:, [0, 1, 2, 6]] + states[:, [7]])
+        np.testing.assert_array_equal(matrix.mask(active), [True, True, False, True])
+
+        observation = random.normal(0, 50, 4)
+        mask = observe.mask(active)
+        log_likelihood = likelihoods.GaussianLikelihood(2.).log_likelihood(observe(states), observation, mask)
+        expected = stats.norm.logpdf(observe(states)[:, mask], observation[mask], 2.).sum(axis=1)
+        np.testing.assert_allclose(log_likelihood, expected)
+        weights = np.exp(log_likelihood - logsumexp(log_likelihood))
+        self.assertAlmostEqual(weights.sum(), 1)
+        self.assertEqual(weights.argmax(), expected.argmax())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,234 @@
+'''
+Particle Workers
+    Processes that keep the particle models of a ParticleFilter.
+
+Description:
+    Stepping the particles with Pool.starmap pickles every model to a worker
+    process and back again at every window, which for thousands of particles
+    costs more than stepping them. Instead, ParticleWorkers starts one
+    process per core, and each process is given a fixed shard of the
+    particle models once, when it starts, and keeps them for the whole run.
+    The particle states and weights are arrays in shared memory
+    (multiprocessing.shared_memory), which the filter and the workers all
+    see, so the workers write the states of their particles in place and
+    the filter reads them without any copying:
+
+        workers = ParticleWorkers(models, dimensions, step_particle)
+        workers.predict(numiter, particle_std)  # workers.states is updated
+        workers.states[:] = workers.states[indexes]
+        workers.assign(indexes)                  # the models follow them
+
+    So each command only sends a few numbers, or the resampled indexes, and
+    the models never leave their process.
+
+    BatchParticles does the same for StationSim models in the main process,
+    without any workers: the particles are the replicates of one
+    stationsim_batch.BatchModel, which steps them all together, and the noise
+    is added to all of them in one draw.
+'''
+
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+try:
+    from stationsim_batch import BatchModel
+except ImportError:  # imported as part of the stationsim package
+    from .stationsim_batch import BatchModel
+
+
+def _work(connection, models, first, names, shapes, step_particle):
+    '''
+    The loop of a worker process, which answers the commands of ParticleWorkers for its shard of models.
+
+    Parameters:
+        connection    - the worker's end of the pipe to ParticleWorkers
+        models        - the models of the particles first, first + 1, ...
+        first         - the number of the first particle of the shard
+        names         - the names of the shared blocks of the states and the weights
+        shapes        - the shapes of the states and the weights
+        step_particle - ParticleFilter.step_particle, to step each particle
+    '''
+    blocks = [shared_memory.SharedMemory(name=name) for name in names]
+    states = np.ndarray(shapes[0], dtype=float, buffer=blocks[0].buf)
+    shard = np.arange(first, first + len(models))
+    try:
+        while True:
+            command, args = connection.recv()
+            try:
+                if command == 'predict':
+                    numiter, particle_std = args
+                    for k, model in enumerate(models):
+                        models[k], states[first + k] = step_particle(first + k, model, numiter, particle_std,
+                                                                     states.shape[1:])
+                    reply = None
+                elif command == 'assign':
+                    indexes, = args
+                    # The other particles kept their own state, which their models already have
+                    for k in np.flatnonzero(indexes[shard] != shard):
+                        models[k].set_state(states[first + k], sensor='location')
+                    reply = None
+                elif command == 'models':
+                    reply = models
+                elif command == 'close':
+                    break
+                else:
+                    raise ValueError(f"Unknown command '{command}'")
+            except Exception as error:
+                connection.send(('error', error))
+            else:
+                connection.send(('ok', reply))
+    finally:
+        del states
+        for block in blocks:
+            block.close()
+        connection.close()
+
+
+class ParticleWorkers:
+    '''
+    Worker processes that each step a fixed shard of the particle models.
+
+    Parameters:
+        models        - the particle models, which are handed to the workers
+        dimensions    - the length of the state of a particle
+        step_particle - ParticleFilter.step_particle (or the like), which
+                        steps one model and returns it and its new state
+        numcores      - the number of worker processes (at most one per particle)
+
+    Attributes:
+        states  - (particles, dimensions) array of the particle states, in shared memory
+        weights - (particles,) array of the particle weights, in shared memory
+        shards  - the range of particles of each worker
+    '''
+    def __init__(self, models, dimensions, step_particle, numcores=None):
+        n = len(models)
+        numcores = multiprocessing.cpu_count() if numcores is None else numcores
+        numcores = max(min(numcores, n), 1)
+        self._blocks = [shared_memory.SharedMemory(create=True, size=max(size * 8, 1))
+                        for size in (n * dimensions, n)]
+        self.states = np.ndarray((n, dimensions), dtype=float, buffer=self._blocks[0].buf)
+        self.weights = np.ndarray((n,), dtype=float, buffer=self._blocks[1].buf)
+        self.states[:] = 0
+        self.weights[:] = 1
+        bounds = np.linspace(0, n, numcores + 1).astype(int)
+        self.shards = [range(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+        self._connections, self._processes = [], []
+        for shard in self.shards:
+            connection, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_work, daemon=True, args=(
+                child, list(models[shard.start:shard.stop]), shard.start, [block.name for block in self._blocks],
+                [(n, dimensions), (n,)], step_particle))
+            process.start()
+            child.close()
+            self._connections.append(connection)
+            self._processes.append(process)
+
+    def _command(self, command, *args):
+        '''
+        Send a command to every worker, so that they run it together, and return their replies in order.
+        '''
+        for connection in self._connections:
+            connection.send((command, args))
+        replies = [connection.recv() for connection in self._connections]
+        for status, reply in replies:
+            if status == 'error':
+                raise reply
+        return [reply for _, reply in replies]
+
+    def predict(self, numiter, particle_std):
+        '''
+        Step every particle numiter times and add noise, writing the new states into `states`.
+        '''
+        self._command('predict', numiter, particle_std)
+
+    def assign(self, indexes):
+        '''
+        Set the locations of the particle models to their rows of `states`, after resampling with `indexes`.
+
+        Description:
+            Only the models of the particles whose index changed are set.
+            The others kept their own state, which their models already
+            have.
+        '''
+        self._command('assign', indexes)
+
+    def get_models(self):
+        '''
+        Copies of the particle models, in order (such as to plot them).
+        '''
+        return [model for models in self._command('models') for model in models]
+
+    def close(self):
+        '''
+        Stop the workers and free the shared memory.
+
+        Description:
+            `states` and `weights` are replaced with copies in ordinary
+            memory, so they can still be read afterwards. Nothing else may
+            still view the shared arrays (see ParticleFilter.states).
+        '''
+        if not self._processes:
+            return
+        for connection in self._connections:
+            connection.send(('close', ()))
+        for process in self._processes:
+            process.join()
+        for connection in self._connections:
+            connection.close()
+        self._connections, self._processes = [], []
+        self.states, self.weights = self.states.copy(), self.weights.copy()
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+
+
+class BatchParticles:
+    '''
+    The particle models of a ParticleFilter as the replicates of one BatchModel, in the main process.
+
+    Description:
+        Has the methods and attributes of ParticleWorkers, so the filter
+        uses either in the same way. predict() steps every particle at once
+        and adds noise drawn in one batch from a generator of its own, a
+        child of the SeedSequence of the first model, so the particles
+        follow the same model as with ParticleWorkers but draw different
+        noise.
+
+    Parameters:
+        models     - the particle models, stationsim_model.Model with the same parameters
+        dimensions - the length of the state of a particle
+    '''
+    def __init__(self, models, dimensions):
+        self.models = list(models)
+        self.batch = BatchModel.from_models(self.models)
+        self.random = np.random.default_rng(self.models[0].seed_sequence.spawn(1)[0])
+        n = len(self.models)
+        self.states = np.zeros((n, dimensions))
+        self.weights = np.ones(n)
+        self.shards = [range(n)]
+
+    def predict(self, numiter, particle_std):
+        '''
+        Step every particle numiter times and add noise, writing the new states into `states`.
+        '''
+        self.batch.run(until=self.batch.step_id + numiter)
+        noise = self.random.normal(0, particle_std ** 2, size=self.states.shape)
+        self.states[:] = self.batch.get_state(sensor='location') + noise
+        self.batch.set_state(self.states, sensor='location')
+
+    def assign(self, indexes):
+        '''
+        Set the locations of the particles to their rows of `states`, for the particles whose index changed.
+        '''
+        changed = np.flatnonzero(indexes != np.arange(len(indexes)))
+        self.batch.locations[changed] = self.states[changed].reshape(len(changed), -1, 2)
+
+    def get_models(self):
+        '''
+        The particle models, with the state of the batch copied into them.
+        '''
+        self.batch.copy_to(self.models)
+        return self.models
+
+    def close(self):
+        pass
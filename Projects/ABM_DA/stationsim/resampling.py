@@ -0,0 +1,89 @@
+'''
+Resampling
+    Resampling schemes for particle filters.
+
+Description:
+    Each scheme takes the normalised weights of N particles and returns the
+    indexes of the N particles to keep, in ascending order, so that particle
+    i is replaced by particle indexes[i]. All of them place N points in
+    (0, 1) and find the particle whose part of the cumulative weights each
+    point falls in with one np.searchsorted, rather than walking along the
+    weights in a Python loop:
+
+        systematic  - one uniform draw, shifted by 1/N for each point
+        stratified  - one uniform draw in each of the N strata of (0, 1)
+        multinomial - N independent uniform draws
+        residual    - floor(N w) copies of each particle, and the rest drawn
+                      as multinomial from what is left of the weights
+
+    Systematic resampling gives exactly the indexes of the loops that the
+    filters used before. The draws are made with `random`, which is the
+    global np.random by default (as the filters used) or a Generator.
+'''
+
+import numpy as np
+
+
+def search(weights, positions):
+    '''
+    The particle that each of the positions in (0, 1) falls in, given the weights.
+
+    Description:
+        Particle j is picked for the positions in
+        [cumsum[j-1], cumsum[j]), as in the loop
+
+            if positions[i] < cumsum[j]: indexes[i] = j; i += 1
+            else: j += 1
+
+        Positions past the last cumulative weight (which may be just
+        below 1 with rounding) pick the last particle.
+    '''
+    cumsum = np.cumsum(weights)
+    return np.minimum(np.searchsorted(cumsum, positions, side='right'), len(weights) - 1)
+
+
+def systematic(weights, random=np.random):
+    '''
+    Systematic resampling: positions (k + u) / N for one uniform draw u.
+    '''
+    n = len(weights)
+    return search(weights, (np.arange(n) + random.uniform()) / n)
+
+
+def stratified(weights, random=np.random):
+    '''
+    Stratified resampling: positions (k + u_k) / N for a uniform draw u_k in each stratum.
+    '''
+    n = len(weights)
+    return search(weights, (np.arange(n) + random.uniform(size=n)) / n)
+
+
+def multinomial(weights, random=np.random):
+    '''
+    Multinomial resampling: N sorted uniform positions.
+    '''
+    return search(weights, np.sort(random.uniform(size=len(weights))))
+
+
+def residual(weights, random=np.random):
+    '''
+    Residual resampling: floor(N w) copies of each particle, and multinomial resampling of the rest.
+    '''
+    weights = np.asarray(weights, dtype=float)
+    n = len(weights)
+    copies = np.floor(n * weights).astype(int)
+    indexes = np.repeat(np.arange(n), copies)
+    rest = n - len(indexes)
+    if rest > 0:
+        residue = n * weights - copies
+        extra = search(residue / residue.sum(), np.sort(random.uniform(size=rest)))
+        indexes = np.sort(np.concatenate([indexes, extra]))
+    return indexes[:n]
+
+
+SCHEMES = {
+    'systematic': systematic,
+    'stratified': stratified,
+    'multinomial': multinomial,
+    'residual': residual,
+}
@@ -0,0 +1,50 @@
+'''
+StationSim Agents
+    What the agents of the StationSim models share.
+
+Description:
+    Both the StationSim model and its Grand Central version keep the state
+    of their agents in arrays with a row per agent, which the Agent objects
+    view through AgentArray attributes, and work out the distances of many
+    agents at once with distances(), which gives exactly what Agent.distance
+    gives one at a time.
+'''
+
+import numpy as np
+
+
+def distances(x, y):
+    '''
+    Agent.distance for arrays of x and y differences.
+
+    Description:
+        Agent.distance takes the square root with math.sqrt, which is
+        correctly rounded, as np.sqrt is, so the two give the same bits. (A
+        power of .5 does not: it can differ from the square root in the last
+        bit, which is enough to change whether two agents collide, or when.)
+        So the vectorised steps reproduce the agents' own steps exactly.
+    '''
+    return np.sqrt(x*x + y*y)
+
+
+class AgentArray:
+    '''
+    An agent attribute that is stored in one of the model's agent arrays.
+
+    Description:
+        The state of every agent is held by the model in contiguous NumPy
+        arrays (one row per agent) so that all of the agents can be stepped
+        at once. Declaring `status = AgentArray('agents_status')` on the
+        Agent class makes `agent.status` read and write
+        `model.agents_status[agent.unique_id]`.
+    '''
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, agent, owner=None):
+        if agent is None:
+            return self
+        return getattr(agent.model, self.name)[agent.unique_id]
+
+    def __set__(self, agent, value):
+        getattr(agent.model, self.name)[agent.unique_id] = value
@@ -0,0 +1,260 @@
+'''
+StationSim Batch
+    Many replicates of a StationSim model stepped together.
+
+Description:
+    A particle or ensemble filter forecasts many copies of the same model,
+    and stepping each one on its own (or pickling them to a pool of
+    processes) costs a Python step per copy. A BatchModel holds R replicates
+    of a stationsim_model.Model with the same parameters, each with its own
+    agents and generator, and steps all of them at once:
+
+        batch = BatchModel.from_models(model.spawn(R))
+        batch.run(until=model.step_id + 10)
+        locations = batch.locations  # (R, pop_total, 2)
+
+    The agent arrays of the replicates are put end to end, so agent i of
+    replicate r is row r * pop_total + i, and `locations` and `status` are
+    (R, pop_total, ...) views of them. A step is that of Model's 'numpy'
+    backend on every row at once: the neighbours are found with a
+    stationsim_index.GridIndex grouped by replicate, so an agent only ever
+    collides with the agents of its own replicate, and the wiggles of each
+    replicate are drawn from its own generator in unique_id order. So each
+    replicate steps exactly as its Model would with any backend.
+'''
+
+import numpy as np
+try:
+    import stationsim_index
+    from stationsim_model import Model
+except ImportError:  # imported as part of the stationsim package
+    from . import stationsim_index
+    from .stationsim_model import Model
+
+
+class BatchModel:
+    '''
+    R replicates of a StationSim Model, stepped together.
+
+    Description:
+        The replicates are made from a list of models with the same
+        parameters and step_id (see from_models), or afresh (see __init__).
+        Only the state is stepped: a BatchModel keeps no history, and the
+        figures and analytics are those of the models that the replicates
+        are copied back to (see copy_to).
+
+    Params:
+        replicates  # the number of replicates R
+        **kwargs    # the parameters of stationsim_model.Model
+
+    Returns:
+        step_id
+        locations
+        status
+
+        step()
+        run()
+        get_state()
+        set_state()
+        copy_to()
+    '''
+    # Parameters that may differ between the models of the replicates
+    _free_params = ('random_seed', 'do_history', 'do_print', 'history_path', 'backend', 'neighbour_index')
+
+    def __init__(self, replicates, **kwargs):
+        '''
+        Create R new replicates, seeded with the children of the SeedSequence of random_seed.
+
+        Description:
+            Replicate r is the model Model(random_seed=children[r], **kwargs),
+            so it has agents of its own, and is reproducible from random_seed.
+        '''
+        params = dict(kwargs, do_history=False, do_print=False)
+        seed_sequence = np.random.SeedSequence(params.pop('random_seed', None))
+        self._init_models([Model(random_seed=child, **params) for child in seed_sequence.spawn(replicates)])
+
+    @classmethod
+    def from_models(cls, models):
+        '''
+        Put the state of a list of models into a new BatchModel.
+
+        Description:
+            The agent arrays are copied, but the generators are shared, so
+            stepping the batch draws from the models' own generators, and
+            copy_to(models) leaves each model as if it had been stepped
+            itself.
+
+        Parameters:
+            models - models with the same parameters (but for the seed and
+                     the backend, say) and step_id, such as Model.spawn(R)
+        '''
+        batch = cls.__new__(cls)
+        batch._init_models(list(models))
+        return batch
+
+    def _init_models(self, models):
+        if not models:
+            raise ValueError("A BatchModel needs at least one model")
+        first = models[0]
+        params = {key: value for key, value in first.params.items() if key not in self._free_params}
+        for model in models[1:]:
+            if {key: value for key, value in model.params.items() if key not in self._free_params} != params:
+                raise ValueError("The models of a BatchModel must have the same parameters")
+            if model.step_id != first.step_id:
+                raise ValueError("The models of a BatchModel must be at the same step_id")
+        self.params = first.params
+        [setattr(self, key, value) for key, value in params.items()]
+        self.replicates = len(models)
+        self.boundaries = first.boundaries
+        self.step_id = first.step_id
+        self.do_history = False
+        self.randoms = [model.random for model in models]
+        # The speeds of each model are padded with nan to the most speeds of any of them
+        width = max(model.agents_speeds.shape[1] for model in models)
+        for name in Model._agent_array_names:
+            if name == 'agents_speeds':
+                rows = [np.pad(model.agents_speeds, ((0, 0), (0, width - model.agents_speeds.shape[1])),
+                               constant_values=np.nan) for model in models]
+            else:
+                rows = [getattr(model, name) for model in models]
+            setattr(self, name, np.concatenate(rows))
+        self.pop_active = int(np.count_nonzero(self.agents_status == 1))
+        self.pop_finished = int(np.count_nonzero(self.agents_status == 2))
+        self._init_schedule()
+
+    @property
+    def locations(self):
+        '''
+        (R, pop_total, 2) view of the locations of the agents of each replicate.
+        '''
+        return self.agents_location.reshape(self.replicates, self.pop_total, 2)
+
+    @property
+    def status(self):
+        '''
+        (R, pop_total) view of the statuses of the agents of each replicate.
+        '''
+        return self.agents_status.reshape(self.replicates, self.pop_total)
+
+    @property
+    def replicate_active(self):
+        '''
+        The number of active agents in each replicate.
+        '''
+        return np.count_nonzero(self.status == 1, axis=1)
+
+    @property
+    def replicate_finished(self):
+        '''
+        The number of agents that have finished in each replicate.
+        '''
+        return np.count_nonzero(self.status == 2, axis=1)
+
+    # Model's 'numpy' backend, which only needs the neighbours and the draws (below) to know of the replicates
+    _init_schedule = Model._init_schedule
+    _due_ids = Model._due_ids
+    _update_active = Model._update_active
+    _neighbour_ids = Model._neighbour_ids
+    _candidates = Model._candidates
+    _step_numpy = Model._step_numpy
+    _move_numpy = Model._move_numpy
+    _wiggled = Model._wiggled
+    _arrived = Model._arrived
+    re_bound = Model.re_bound
+
+    def _build_index(self, state, due):
+        '''
+        Build a GridIndex of the agents that can be a neighbour in this step, grouped by replicate.
+        '''
+        self.index_ids = self._neighbour_ids(due)
+        self.index = stationsim_index.GridIndex(state[self.index_ids], self.boundaries, self.separation,
+                                                groups=self.index_ids // self.pop_total)
+
+    def _query_neighbours(self, locations, owners):
+        '''
+        The agents within `separation` of each location, of the replicate of the agent (owner) that tries it.
+        '''
+        counts, neighbours = self.index.query_many(locations, self.separation, groups=owners // self.pop_total)
+        return counts, self.index_ids[neighbours]
+
+    def _draw_wiggles(self, movers, wiggled, peek=False):
+        '''
+        Model._draw_wiggles, drawing the wiggles of each replicate from its own generator.
+        '''
+        replicate = movers[wiggled] // self.pop_total
+        counts = np.bincount(replicate, minlength=self.replicates)
+        starts = np.concatenate([[0], np.cumsum(counts)])
+        draws = np.empty(replicate.size, dtype=np.int64)
+        for r in np.flatnonzero(counts):
+            random = self.randoms[r]
+            random_state = random.bit_generator.state
+            draws[starts[r]:starts[r+1]] = random.integers(-1, 1+1, size=counts[r])
+            if peek:
+                random.bit_generator.state = random_state
+        return draws
+
+    def step(self):
+        '''
+        Step every replicate once.
+
+        Description:
+            As Model.step does, nothing is done once every agent of every
+            replicate has finished or step_limit is reached. A replicate
+            whose agents have all finished is left as it is, but its step_id
+            goes on with those of the others.
+        '''
+        if self.pop_finished < self.agents_status.size and self.step_id < self.step_limit:
+            self._step_numpy()
+            self.step_id += 1
+
+    def run(self, until=None):
+        '''
+        Step every replicate until step_id is until (or step_limit), or every agent has finished.
+        '''
+        until = self.step_limit if until is None else min(until, self.step_limit)
+        while self.pop_finished < self.agents_status.size and self.step_id < until:
+            self._step_numpy()
+            self.step_id += 1
+
+    def get_state(self, sensor='location2D'):
+        '''
+        The state of each replicate, as Model.get_state(sensor).
+
+        Returns:
+            'location2D' - (R, pop_total, 2) array of the locations
+            'location'   - (R, 2 * pop_total) array of the locations
+        '''
+        if sensor == 'location2D':
+            return self.locations.copy()
+        elif sensor == 'location':
+            return self.locations.reshape(self.replicates, -1).copy()
+        raise ValueError(f"Unknown sensor '{sensor}', expected 'location2D' or 'location'")
+
+    def set_state(self, state, sensor='location2D'):
+        '''
+        Set the locations of the agents of each replicate, from an array of their states (see get_state).
+        '''
+        if sensor not in ('location2D', 'location'):
+            raise ValueError(f"Unknown sensor '{sensor}', expected 'location2D' or 'location'")
+        self.agents_location[:] = np.reshape(state, (-1, 2))
+
+    def copy_to(self, models):
+        '''
+        Copy the state of each replicate back into its model, in place.
+
+        Parameters:
+            models - a model for each replicate, such as those the batch was made from
+        '''
+        n = self.pop_total
+        for r, model in enumerate(models):
+            rows = slice(r * n, (r + 1) * n)
+            for name in Model._agent_array_names:
+                array = getattr(model, name)
+                if name == 'agents_speeds':
+                    array[...] = self.agents_speeds[rows, :array.shape[1]]
+                else:
+                    array[...] = getattr(self, name)[rows]
+            model.step_id = self.step_id
+            model.pop_active = int(np.count_nonzero(model.agents_status == 1))
+            model.pop_finished = int(np.count_nonzero(model.agents_status == 2))
+            model._init_schedule()
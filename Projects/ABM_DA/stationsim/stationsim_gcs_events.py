@@ -0,0 +1,196 @@
+'''
+StationSim GCS Events
+    An event-driven scheduler for the collisions of the GCS model.
+
+Description:
+    Model.step with scheduler='table' works out the collision time of every
+    active agent with the walls, the obstacles and every other agent at every
+    step. But an agent only changes its trajectory when it wiggles, and
+    only enters or leaves the station when it activates or finishes, so
+    most of those times are known from the steps before.
+    CollisionEvents keeps the predicted collisions in a heap, in the way
+    that event-driven simulations of hard discs do, by the (model) time at
+    which they happen:
+
+        (time, i, j, version of i, version of j)
+
+    where j is the unique_id of the other agent, WALL or OBSTACLE. Each agent
+    has a version, which is increased whenever it wiggles, activates or
+    finishes, and an event is out of date (and dropped when it reaches the
+    top of the heap) if the version of either agent has changed since the
+    event was predicted. Only the agents that have changed are predicted
+    again, against their neighbours, so each event costs O(k log N) for k
+    neighbours rather than the O(N k) of a new table.
+    The pairs of agents are only predicted within a horizon (see
+    Model.predict_collisions), so every horizon the heap is rebuilt from
+    scratch.
+    Agents that already overlap another agent (or an obstacle) are the
+    exception: their collision time is the time since they began to overlap
+    (see stationsim_gcs_geometry.collision_times), which grows as time goes
+    on, so they are predicted again at every step, as long as they overlap.
+
+    The collision times are the same as those of the table, but are kept
+    as absolute times, so they round differently once time has moved on,
+    and a model stepped with the events drifts apart from one stepped with
+    the table by rounding errors.
+'''
+
+import heapq
+import numpy as np
+
+WALL = -1
+OBSTACLE = -2
+
+
+class CollisionEvents:
+    '''
+    The predicted collisions of the active agents of a GCS model.
+
+    Parameters:
+        model   - the stationsim_gcs_model.Model to predict for
+        horizon - how long the heap is used for before it is rebuilt
+    '''
+    def __init__(self, model, horizon=2.0):
+        self.model = model
+        self.horizon = horizon
+        self.clear()
+
+    def clear(self):
+        '''
+        Forget every prediction, as when the state of the model is set.
+        '''
+        self.heap = []
+        self.version = np.zeros(self.model.pop_total, dtype=int)
+        self.status = np.zeros(self.model.pop_total, dtype=int)
+        self.active_ids = np.empty(0, dtype=int)
+        self.overlapping = set()
+        self.valid_until = -np.inf
+
+    def _push(self, now, ids, time_wall, time_obstacle, a, b, time_pair):
+        version = self.version
+        self.overlapping.update(ids[time_obstacle < 0].tolist(),
+                                a[time_pair < 0].tolist(),
+                                b[time_pair < 0].tolist())
+        time_obstacle, time_pair = np.abs(time_obstacle), np.abs(time_pair)
+        events = [(now + t, i, WALL, version[i], 0)
+                  for t, i in zip(time_wall.tolist(), ids.tolist())
+                  if t < 1.0e300]
+        events += [(now + t, i, OBSTACLE, version[i], 0)
+                   for t, i in zip(time_obstacle.tolist(), ids.tolist())
+                   if t < 1.0e300]
+        events += [(now + t, i, j, version[i], version[j])
+                   for t, i, j in zip(time_pair.tolist(), a.tolist(),
+                                      b.tolist())
+                   if t < 1.0e300]
+        if len(events) > len(self.heap):
+            self.heap += events
+            heapq.heapify(self.heap)
+        else:
+            for event in events:
+                heapq.heappush(self.heap, event)
+
+    def _valid(self, event):
+        _, i, j, version_i, version_j = event
+        return self.version[i] == version_i and\
+            (j < 0 or self.version[j] == version_j)
+
+    def rebuild(self):
+        '''
+        Predict the collisions of all of the active agents again.
+        '''
+        now = self.model.total_time
+        self.heap = []
+        self.overlapping = set()
+        self.sync()
+        self.valid_until = now + self.horizon
+        self._push(now, *self.model.predict_collisions(
+            horizon=self.horizon))
+
+    def update(self, ids):
+        '''
+        Predict the collisions of the agents ids again, after they have
+        wiggled or been activated, and drop their old predictions.
+        '''
+        ids = np.unique(np.fromiter(ids, dtype=int))
+        ids = ids[self.status[ids] == 1]
+        if not len(ids):
+            return
+        now = self.model.total_time
+        self.version[ids] += 1
+        self._push(now, *self.model.predict_collisions(
+            ids, horizon=max(self.valid_until - now, 0.0)))
+
+    def sync(self):
+        '''
+        Returns the unique_ids of the agents that have been activated since
+        the last call, and drops the predictions of those that have
+        finished.
+
+        Description:
+            The active agents are compared with the model's active_ids, so
+            this only looks at the active agents, not at every agent.
+        '''
+        active_ids = self.model.active_ids
+        activated = np.setdiff1d(active_ids, self.active_ids)
+        finished = np.setdiff1d(self.active_ids, active_ids)
+        self.active_ids = active_ids
+        self.status[activated] = 1
+        self.status[finished] = 2
+        self.version[activated] += 1
+        self.version[finished] += 1
+        return activated
+
+    def next_collision(self):
+        '''
+        Returns the time until the next collision (tmin), or 1.0e300.
+
+        Description:
+            The heap is rebuilt when it might not hold every collision
+            within the next step (of 1 + tolerance).
+        '''
+        now = self.model.total_time
+        if now + 1.0 + self.model.tolerance > self.valid_until:
+            self.rebuild()
+        else:
+            overlapping, self.overlapping = self.overlapping, set()
+            self.update(overlapping.union(self.sync().tolist()))
+        heap = self.heap
+        while heap and not self._valid(heap[0]):
+            heapq.heappop(heap)
+        return heap[0][0] - now if heap else 1.0e300
+
+    def pop_wiggles(self, time):
+        '''
+        Returns the unique_ids of the agents that collide in time, within
+        the tolerance, as Model.get_wiggleTable does, and removes their
+        collisions from the heap.
+
+        Description:
+            The set is made in the order of the rows of the collision table,
+            so that it is iterated in the same order as that of
+            get_wiggleTable (and so the agents wiggle in the same order).
+        '''
+        now = self.model.total_time
+        tolerance = self.model.tolerance
+        heap = self.heap
+        collide, later = [], []
+        while heap and heap[0][0] - now < time + tolerance:
+            event = heapq.heappop(heap)
+            if not self._valid(event):
+                continue
+            _, i, j = event[:3]
+            if abs(event[0] - now - time) >= tolerance:
+                later.append(event)
+            elif j == WALL:
+                collide.append((i, 0, i))
+            elif j == OBSTACLE:
+                collide.append((i, 1, i))
+            else:
+                collide.append((min(i, j), 2, max(i, j)))
+        for event in later:
+            heapq.heappush(heap, event)
+        wiggle = set()
+        for i, _, j in sorted(collide):
+            wiggle.add(i)
+            wiggle.add(j)
+        return wiggle
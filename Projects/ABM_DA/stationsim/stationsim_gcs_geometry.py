@@ -0,0 +1,263 @@
+'''
+StationSim GCS Geometry
+    The walls and obstacles of a station of the GCS model.
+
+Description:
+    A Geometry holds the walls of a station as an array of line segments and
+    its obstacles (such as the clock of Grand Central) as an array of
+    circles, and works out when each of many agents, moving in straight
+    lines, first touches them, in one vectorised call:
+
+        geometry = Geometry(segments, circles)
+        time_wall, time_obstacle = geometry.contact_times(location,
+                                                          velocity, size)
+
+    A wall is touched when an agent's edge reaches the segment, or one of
+    its ends, from either side. The times with the four walls of a
+    rectangular station are exactly those of Agent.get_collisionTimeWall,
+    and those with a circle are those of Agent.get_collisionTime2Agents
+    with a still agent.
+
+    Each segment is cut into pieces no longer than `piece`, and the pieces
+    and circles are put in a neighbour index (see stationsim_index) by their
+    centres, as a set of bounding circles. Given a horizon, contact_times
+    only looks at the walls and obstacles that an agent could reach within
+    it, so the time does not grow with the number of them.
+'''
+
+import numpy as np
+try:
+    import stationsim_index
+    from stationsim_agents import distances
+except ImportError:  # imported as part of the stationsim package
+    from . import stationsim_index
+    from .stationsim_agents import distances
+
+
+def squares(x):
+    '''
+    x**2 for an array, with the Python power that
+    Agent.get_collisionTime2Agents uses, which can differ from x*x (and
+    so from NumPy's x**2) in the last bit.
+    '''
+    return np.array([v**2 for v in np.ravel(x).tolist()],
+                    dtype=float).reshape(np.shape(x))
+
+
+def dots(a, b):
+    '''
+    np.dot of each row of a with the same row of b.
+
+    Description:
+        np.matmul multiplies the rows in the same way as np.dot (which may
+        use a fused multiply-add), so this gives exactly what
+        Agent.get_collisionTime2Agents gets from np.dot.
+    '''
+    return np.matmul(a[:, None, :], b[:, :, None])[:, 0, 0]
+
+
+def collision_times(r, v, size):
+    '''
+    Agent.get_collisionTime2Agents for many pairs of agents at once.
+
+    Parameters:
+        r    - (N, 2) array of the location of agent A minus that of agent B
+        v    - (N, 2) array of the velocity of agent A minus that of agent B
+        size - the sum of the sizes of the agents
+
+    Returns:
+        the time until each pair collides, 1.0e300 if they do not, and
+        minus the time since they began to overlap if they already do
+        (Agent.get_collisionTime2Agents gives its absolute value)
+    '''
+    b = dots(v, r)
+    vv = dots(v, v)
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        delta = squares(b) - (vv*(dots(r, r) - squares(size)))
+        collide = (b < 0.0) & (delta > 0.0)
+        delta = np.where(collide, delta, 0.0)
+        return np.where(collide, (-b - np.sqrt(delta)) / vv, 1.0e300)
+
+
+class Geometry:
+    '''
+    The walls and obstacles of a station.
+
+    Parameters:
+        segments - (S, 2, 2) array of the two ends of each wall
+        circles  - (C, 3) array of the x, y and radius of each obstacle
+        piece    - the longest piece of wall in the index
+        index    - the neighbour index to use, see stationsim_index
+    '''
+    def __init__(self, segments=(), circles=(), piece=10.0, index='kdtree'):
+        self.segments = np.asarray(segments, dtype=float).reshape(-1, 2, 2)
+        self.circles = np.asarray(circles, dtype=float).reshape(-1, 3)
+
+        # The unit normal of each wall, and where it crosses the normal
+        start, end = self.segments[:, 0], self.segments[:, 1]
+        edge = end - start
+        length = distances(*edge.T)
+        self.normal = np.column_stack([-edge[:, 1], edge[:, 0]]) /\
+            length[:, None]
+        self.offset = self.normal[:, 0] * start[:, 0] +\
+            self.normal[:, 1] * start[:, 1]
+
+        # Bounding circles of the pieces of the walls and of the obstacles
+        pieces = np.maximum(np.ceil(length / piece), 1).astype(int)
+        owner = np.repeat(np.arange(len(self.segments)), pieces)
+        fraction = (np.arange(pieces.sum()) - np.repeat(
+            np.cumsum(pieces) - pieces, pieces) + .5) / np.repeat(pieces,
+                                                                   pieces)
+        centres = start[owner] + edge[owner] * fraction[:, None]
+        self.owner = np.concatenate([owner, len(self.segments) +
+                                     np.arange(len(self.circles))])
+        self.reach = max([*(length / pieces / 2), *self.circles[:, 2], 0])
+        centres = np.concatenate([centres, self.circles[:, :2]])
+        self.index = None
+        if len(centres):
+            self.index = stationsim_index.INDEXES[index](
+                centres, np.array([centres.min(0), centres.max(0)]),
+                self.reach)
+
+    @classmethod
+    def rectangle(cls, width, height, circles=(), segments=(), **kwargs):
+        '''
+        The four walls of a width x height station (with a corner at the
+        origin), and the other walls and obstacles.
+        '''
+        walls = [[[0, 0], [width, 0]], [[0, height], [width, height]],
+                 [[0, 0], [0, height]], [[width, 0], [width, height]]]
+        segments = np.concatenate([np.array(walls, dtype=float),
+                                   np.asarray(segments,
+                                              dtype=float).reshape(-1, 2, 2)])
+        return cls(segments, circles, **kwargs)
+
+    def candidates(self, location, radius):
+        '''
+        The pairs of agents and walls or obstacles that may be within radius
+        of each other.
+
+        Returns:
+            agent - the row of location of each agent
+            wall  - the wall, or len(segments) + the obstacle
+        '''
+        n_walls = len(self.segments) + len(self.circles)
+        if np.isinf(radius) or self.index is None:
+            return (np.repeat(np.arange(len(location)), n_walls),
+                    np.tile(np.arange(n_walls), len(location)))
+        counts, points = self.index.query_many(location, radius + self.reach)
+        pairs = np.unique(np.repeat(np.arange(len(location)), counts) *
+                          n_walls + self.owner[points])
+        return pairs // n_walls, pairs % n_walls
+
+    def contact_times(self, location, velocity, size, horizon=np.inf):
+        '''
+        Returns the time until each agent first touches a wall, and the time
+        until it touches an obstacle.
+
+        Description:
+            An agent that is already past a wall (nearer to it than size)
+            and moving towards it touched it a time ago, so the time is
+            negative, as with Agent.get_collisionTimeWall. An agent that
+            already overlaps an obstacle has minus the time since it began
+            to (see collision_times).
+            With a finite horizon, only the walls and obstacles that the
+            agents could reach within it are looked at, and the others are
+            taken to be out of reach (1.0e300).
+
+        Parameters:
+            location - (N, 2) array of the locations of the agents
+            velocity - (N, 2) array of their velocities
+            size     - the size (radius) of each agent, or of all of them
+            horizon  - the longest time that is needed
+
+        Returns:
+            time_wall     - the time until each agent touches a wall
+            time_obstacle - the time until each agent touches an obstacle
+                            (the one with the shortest absolute time)
+        '''
+        location = np.asarray(location, dtype=float).reshape(-1, 2)
+        velocity = np.asarray(velocity, dtype=float).reshape(-1, 2)
+        size = np.broadcast_to(np.asarray(size, dtype=float),
+                               len(location))
+        time_wall = np.full(len(location), 1.0e300)
+        time_obstacle = np.full(len(location), 1.0e300)
+        if not len(location):
+            return time_wall, time_obstacle
+        radius = np.inf
+        if not np.isinf(horizon):
+            speed = distances(*velocity.T).max()
+            radius = (speed * horizon + size.max()) * (1 + 1e-9)
+        agent, wall = self.candidates(location, radius)
+
+        # Walls, from the side that the agent is on
+        is_wall = wall < len(self.segments)
+        a, w = agent[is_wall], wall[is_wall]
+        x, y = location[a].T
+        vx, vy = velocity[a].T
+        nx, ny = self.normal[w].T
+        along = nx * x + ny * y
+        towards = nx * vx + ny * vy
+        side = np.where(along < self.offset[w], -1.0, 1.0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            time = (self.offset[w] + side * size[a] - along) / towards
+            # Where the agent touches the line, along the segment
+            start, end = self.segments[w, 0], self.segments[w, 1]
+            edge = end - start
+            contact = location[a] + velocity[a] * time[:, None] - start
+            fraction = (contact[:, 0] * edge[:, 0] + contact[:, 1] *
+                        edge[:, 1]) / (edge[:, 0]**2 + edge[:, 1]**2)
+        hit = (side * towards < 0) & (fraction >= 0) & (fraction <= 1)
+        np.minimum.at(time_wall, a[hit], time[hit])
+
+        # The ends of the walls, as points
+        a = np.repeat(a, 2)
+        time = collision_times(location[a] - self.segments[w].reshape(-1, 2),
+                               velocity[a], size[a])
+        np.minimum.at(time_wall, a, time)
+
+        # Obstacles
+        a, c = agent[~is_wall], wall[~is_wall] - len(self.segments)
+        if len(a):
+            time = collision_times(location[a] - self.circles[c, :2],
+                                   velocity[a], size[a] + self.circles[c, 2])
+            order = np.lexsort((np.abs(time), a))
+            first = np.r_[True, a[order][1:] != a[order][:-1]]
+            time_obstacle[a[order][first]] = time[order][first]
+        return time_wall, time_obstacle
+
+    def overlaps(self, location, size):
+        '''
+        Whether an agent at location would overlap a wall or an obstacle
+        (be no further than size from a wall, or than size plus the radius
+        from the centre of an obstacle).
+
+        Parameters:
+            location - a location, or an (N, 2) array of locations
+            size     - the size (radius) of the agent at each location, or
+                       of all of them
+
+        Returns:
+            whether each location overlaps, or a bool for one location
+        '''
+        one = np.ndim(location) == 1
+        location = np.asarray(location, dtype=float).reshape(-1, 2)
+        size = np.broadcast_to(np.asarray(size, dtype=float), len(location))
+        overlap = np.zeros(len(location), dtype=bool)
+        if len(location):
+            agent, wall = self.candidates(location, size.max())
+            # Obstacles
+            is_wall = wall < len(self.segments)
+            a, c = agent[~is_wall], wall[~is_wall] - len(self.segments)
+            dx, dy = (location[a] - self.circles[c, :2]).T
+            overlap[a[distances(dx, dy) <= size[a] + self.circles[c, 2]]] =\
+                True
+            # Walls, at the nearest point of each
+            a, w = agent[is_wall], wall[is_wall]
+            start, edge = self.segments[w, 0], np.diff(self.segments[w],
+                                                       axis=1)[:, 0]
+            fraction = np.clip(((location[a] - start) * edge).sum(1) /
+                               (edge**2).sum(1), 0, 1)
+            dx, dy = (location[a] - start - edge * fraction[:, None]).T
+            overlap[a[distances(dx, dy) <= size[a]]] = True
+        return bool(overlap[0]) if one else overlap
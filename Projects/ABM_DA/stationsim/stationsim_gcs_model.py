@@ -4,11 +4,24 @@ StationSim - GrandCentral version
 '''
 
 import warnings
+import copy
+import math
 import numpy as np
 import os
-from scipy.spatial import cKDTree
 import matplotlib.pyplot as plt
 from matplotlib.animation import FuncAnimation
+try:
+    import stationsim_gcs_events
+    import stationsim_gcs_geometry
+    import stationsim_history
+    import stationsim_index
+    from stationsim_agents import AgentArray, distances
+except ImportError:  # imported as part of the stationsim package
+    from . import stationsim_gcs_events
+    from . import stationsim_gcs_geometry
+    from . import stationsim_history
+    from . import stationsim_index
+    from .stationsim_agents import AgentArray, distances
 # Dont automatically load seaborn as it isn't needed on the HPC
 try:
     from seaborn import kdeplot as sns_kdeplot
@@ -18,10 +31,68 @@ except ImportError as e:
                   "map) then it will fail.")
 
 
+class Placements:
+    '''
+    Where the agents that move in turn in one step have moved to.
+
+    Description:
+        activate_agents and wiggle_agents try locations for their agents in
+        turn, and an agent may only take a location that is more than r from
+        every other agent. The other agents are those found near the
+        location by a neighbour index made before any of them moved, which
+        are checked where they were unless they have since moved, and
+        those that have moved, which are checked where they have moved to.
+        Those are kept in a grid of cells of size `radius`, so only the
+        cells around a location are looked at.
+
+    Parameters:
+        locations - the model's agents_location array
+        radius    - the largest r that free() is asked about
+    '''
+    def __init__(self, locations, radius):
+        self.locations = locations
+        self.radius = radius
+        self.moved = set()
+        self._cells = {}
+
+    @staticmethod
+    def _near(x0, y0, x, y, r):
+        # As the indexes compare distances (see stationsim_index)
+        dx, dy = x0 - x, y0 - y
+        return dx * dx + dy * dy <= r * r
+
+    def _cell(self, x, y):
+        return int(x // self.radius), int(y // self.radius)
+
+    def free(self, unique_id, x, y, r, neighbours):
+        '''
+        Whether agent unique_id can move to (x, y): more than r from the
+        neighbours (other than itself) that have not moved, and from every
+        location taken.
+        '''
+        if any(j != unique_id and j not in self.moved and
+               self._near(*self.locations[j].tolist(), x, y, r)
+               for j in neighbours):
+            return False
+        cx, cy = self._cell(x, y)
+        return not any(self._near(x0, y0, x, y, r)
+                       for a in (-1, 0, 1) for b in (-1, 0, 1)
+                       for x0, y0 in self._cells.get((cx+a, cy+b), ()))
+
+    def take(self, unique_id, x, y):
+        '''
+        Record that agent unique_id has moved to (x, y).
+        '''
+        self.moved.add(unique_id)
+        self._cells.setdefault(self._cell(x, y), []).append((x, y))
+
+
 class Agent:
     '''
     A class representing a generic agent for the StationSim ABM.
     '''
+    location = AgentArray('agents_location')
+
     def __init__(self, model, unique_id):
         '''
         Initialise a new agent.
@@ -30,8 +101,9 @@ class Agent:
             Creates a new agent and gives it a randomly chosen exit,
             and desired speed.
             All agents start with active state 0 ('not started').
-            Their initial location (** (x,y) tuple-floats **) is set to
-            (0,0) and changed when the agent is activated.
+            Their initial location (row unique_id of the model's
+            agents_location array) is set to (0,0) and changed when the
+            agent is activated.
 
         Parameters:
             model - a pointer to the StationSim model that is creating
@@ -44,26 +116,24 @@ class Agent:
         self.location = [0, 0]  # replaced when the agent is activated
         self.size = model.agent_size
 
-        self.gate_in = np.random.randint(model.gates_in)
-        gate_out = np.random.randint(model.gates_out) + model.gates_in
+        self.gate_in = model.random.integers(model.gates_in)
+        gate_out = model.random.integers(model.gates_out) + model.gates_in
         while (gate_out == self.gate_in or
                gate_out >= len(model.gates_locations)):
-            gate_out = np.random.randint(model.gates_out)
+            gate_out = model.random.integers(model.gates_out)
         self.loc_desire = self.set_agent_location(gate_out)
 
         # Speed
         speed_max = 0
         while speed_max <= model.speed_min:
-            speed_max = np.random.normal(model.speed_mean, model.speed_std)
+            speed_max = model.random.normal(model.speed_mean, model.speed_std)
         self.speeds = np.arange(speed_max, model.speed_min, - model.speed_step)
-        self.speed = np.random.choice((self.speeds))
+        self.speed = model.random.choice((self.speeds))
         # Others
-        self.steps_activate = np.random.exponential(model.gates_speed)
+        self.steps_activate = model.random.exponential(model.gates_speed)
 
         # History
         if model.do_history:
-            self.history_locations = []
-            self.history_speeds = []
             self.history_wiggles = 0
             self.history_collisions = 0
             self.step_start = None
@@ -88,14 +158,16 @@ class Agent:
         It is necessary to ensure that the agent has an initial position
         different from the position of all active agents. If it was not
         possible, activate the agent on next time step.
+
+        Model.step activates all of the agents at once, in the same way,
+        with Model.activate_agents.
         '''
         if self.status == 0:
             if self.model.total_time > self.steps_activate:
-                state = self.model.get_state('location2D')
-                self.model.tree = cKDTree(state)
+                self.model.build_index()
                 for _ in range(10):
                     new_location = self.set_agent_location(self.gate_in)
-                    neighbouring_agents = self.model.tree.query_ball_point(
+                    neighbouring_agents = self.model.index.query(
                         new_location, self.size*1.1)
                     if (neighbouring_agents == [] or
                             neighbouring_agents == [self.unique_id]):
@@ -103,7 +175,7 @@ class Agent:
                         self.status = 1
                         self.model.pop_active += 1
                         self.step_start = self.model.total_time  # self.model.step_id
-                        self.loc_start = self.location
+                        self.loc_start = self.location.copy()
                         break
 
     def set_agent_location(self, gate):
@@ -113,15 +185,26 @@ class Agent:
             It is necessary to ensure that the agent has a distance from
             the station wall compatible with its own size.
         '''
-        perturb = self.model.gates_space * np.random.uniform(-10, +10)
+        perturb = self.model.gates_space * self.model.random.uniform(-10, +10)
+        return self.gate_locations(gate, perturb)
+
+    def gate_locations(self, gate, perturb):
+        '''
+        The locations at a gate, moved along it by perturb (a number, or an
+        array of them for an array of locations), at a distance from the
+        wall compatible with the agent's size.
+        '''
+        perturb = np.asarray(perturb, dtype=float)
+        margin = np.full_like(perturb, 1.05*self.size)
         if(self.model.gates_locations[gate][0] == 0):
-            return self.model.gates_locations[gate] + [1.05*self.size, perturb]
+            offset = [margin, perturb]
         elif(self.model.gates_locations[gate][0] == self.model.width):
-            return self.model.gates_locations[gate] + [-1.05*self.size, perturb]
+            offset = [-margin, perturb]
         elif(self.model.gates_locations[gate][1] == 0):
-            return self.model.gates_locations[gate] + [perturb, 1.05*self.size]
+            offset = [perturb, margin]
         else:
-            return self.model.gates_locations[gate] + [perturb, -1.05*self.size]
+            offset = [perturb, -margin]
+        return self.model.gates_locations[gate] + np.stack(offset, axis=-1)
 
     @staticmethod
     def distance(loc1, loc2):
@@ -136,20 +219,19 @@ class Agent:
         '''
         x = loc1[0] - loc2[0]
         y = loc1[1] - loc2[1]
-        norm = (x*x + y*y)**.5
+        norm = math.sqrt(x*x + y*y)  # Correctly rounded, as np.sqrt is, see distances()
         return norm
 
     def get_direction(self, loc_desire, location):
         return (loc_desire - location) / self.distance(loc_desire, location)
 
-    @staticmethod
-    def get_normal_direction(direction):
+    def get_normal_direction(self, direction):
         '''
         Rotate a two-dimensional array by 90 degrees in clockwise or
-        counter clockwise direction (np.random.choice((-1, 1))).
+        counter clockwise direction (model.random.choice((-1, 1))).
         '''
         return np.array([direction[1], direction[0] *
-                         np.random.choice((-1, 1))])
+                         self.model.random.choice((-1, 1))])
 
     def move(self, time_step):
         '''
@@ -174,41 +256,11 @@ class Agent:
         - Otherwise, a new position will be determined.
         - This process has a limit of 10 attempts. If it is not possible
         to determine a new unique position, the agent just stay stopped.
-        '''
-        direction = self.get_direction(self.loc_desire, self.location)
-
-        state = self.model.get_state('location2D')
-        self.model.tree = cKDTree(state)
-        for _ in range(10):
-            normal_direction = self.get_normal_direction(direction)
-            new_location = self.location +\
-                normal_direction *\
-                np.random.normal(self.size, self.size/2.0)
 
-            # Rebound
-            if not self.model.is_within_bounds(self, new_location):
-                new_location = self.model.re_bound(self, new_location)
-
-            # collision_map
-            if self.model.do_history:
-                self.history_collisions += 1
-                self.model.history_collision_locs.append(new_location)
-                self.model.history_collision_times.append(self.model.total_time)
-
-            # Check if the new location is possible
-            neighbouring_agents = self.model.tree.query_ball_point(new_location,
-                                                              self.size*1.1)
-            dist = self.distance(new_location, self.model.clock.location)
-            if ((neighbouring_agents == [] or
-                    neighbouring_agents == [self.unique_id]) and
-                    (dist > (self.size + self.model.clock.size))):
-                self.location = new_location
-
-                # wiggle_map
-                if self.model.do_history:
-                    self.history_wiggles += 1
-                    self.model.history_wiggle_locs.append(new_location)
-                break
+        Model.step wiggles all of the agents that collide at once, in the
+        same way, with Model.wiggle_agents.
+        '''
+        self.model.wiggle_agents([self.unique_id])
 
     def deactivate(self):
         '''
@@ -228,14 +280,12 @@ class Agent:
                 steps_delay = steps_taken - steps_exped
                 self.model.steps_delay.append(steps_delay)
 
-    def history(self):
+    @property
+    def history_locations(self):
         '''
-        Save agent location.
+        The agent's saved locations, nan when it was not active.
         '''
-        if self.status == 1:
-            self.history_locations.append(self.location)
-        else:
-            self.history_locations.append((None, None))
+        return self.model.history_locations[:, self.unique_id]
 
     def get_collisionTime2Agents(self, agentB):
         '''
@@ -300,6 +350,11 @@ class Model:
         **kwargs    # check `params`, and `params_changed`
         do_history  # save memory
         do_print    # mute printing
+        history_path  # keep the history on disk, see save_history()
+        neighbour_index  # 'kdtree' (default) or 'grid', see build_index()
+        scheduler   # 'table' (default) or 'events', see step()
+        walls       # more walls, as [[x0, y0], [x1, y1]] segments
+        obstacles   # more obstacles, as [x, y, radius] circles
 
     Returns:
         step_id
@@ -347,11 +402,16 @@ class Model:
 
             'do_history': True,
             'do_print': True,
+            'history_path': None,  # directory to keep the history in, as memory-mapped files
 
             'random_seed': int.from_bytes(os.urandom(4), byteorder='little'),
 
             'tolerance': 0.1,  # new parameter
-            'station': None  # None or Grand_Central  # new parameter
+            'station': None,  # None or Grand_Central  # new parameter
+            'neighbour_index': 'kdtree',  # 'kdtree' or 'grid', see build_index
+            'scheduler': 'table',  # 'table' or 'events', see step
+            'walls': None,  # list of [[x0, y0], [x1, y1]], see set_station
+            'obstacles': None  # list of [x, y, radius], see set_station
 
         }
         if len(kwargs) == 0:
@@ -362,8 +422,16 @@ class Model:
             )
         self.params, self.params_changed = Model._init_kwargs(params, kwargs)
         [setattr(self, key, value) for key, value in self.params.items()]
-        # Set the random seed
-        np.random.seed(self.random_seed)
+        if self.neighbour_index not in stationsim_index.INDEXES:
+            raise ValueError(
+                f"Unknown neighbour_index '{self.neighbour_index}', expected "
+                f"one of {', '.join(stationsim_index.INDEXES)}")
+        if self.scheduler not in ('table', 'events'):
+            raise ValueError(
+                f"Unknown scheduler '{self.scheduler}', expected 'table' or "
+                f"'events'")
+        # The model draws all of its random numbers from its own generator
+        self._init_random(self.random_seed)
         self.speed_step = (self.speed_mean - self.speed_min) / self.speed_steps
 
         # Variables
@@ -372,6 +440,9 @@ class Model:
         self.pop_finished = 0
         self.total_time = 0.0
 
+        # Locations of the agents
+        self.agents_location = np.zeros((self.pop_total, 2))
+
         # Initialise station
         self.set_station()
         self.boundaries = np.array([[0, 0], [self.width, self.height]])
@@ -379,16 +450,14 @@ class Model:
         # Initialise agents
         self.agents = [Agent(self, unique_id) for unique_id in
                        range(self.pop_total)]
+        self._init_schedule()
+        if self.scheduler == 'events':
+            self.events = stationsim_gcs_events.CollisionEvents(self)
+        else:
+            self.events = None
 
         if self.do_history:
-            self.time_save = []
-            self.history_state = []
-            self.history_wiggle_locs = []
-            self.history_collision_locs = []
-            self.history_collision_times = []
-            self.steps_taken = []
-            self.steps_exped = []
-            self.steps_delay = []
+            self._init_history()
             # Figure Shape Stuff
             self._wid = 8
             self._rel = self._wid / self.width
@@ -405,7 +474,12 @@ class Model:
         Allows to manually set a station (e.g. 'Grand_Central') rather
         than automatically generating a station from parameters like
         number of gates, gate size, etc.
+
+        The walls of the station, and its obstacles (the clock of Grand
+        Central), are kept in self.geometry (see stationsim_gcs_geometry),
+        along with those of the walls and obstacles parameters.
         '''
+        obstacles = []
         if(self.station == 'Grand_Central'):
             self.width = 200
             self.height = 400
@@ -418,24 +492,24 @@ class Model:
                           [self.width, 340]])  # north side
             self.gates_in = len(self.gates_locations)
             self.gates_out = len(self.gates_locations)
-            self.clock = Agent(self, self.pop_total)
-            self.clock.size = 10.0
-            self.clock.location = [self.width/2.0, self.height/2.0]
-            self.clock.speed = 0.0
+            # the clock, in the middle of the concourse
+            obstacles.append([self.width/2.0, self.height/2.0, 10.0])
         else:
             self.gates_locations = np.concatenate([
                 Model._gates_init(0, self.height, self.gates_in),
                 Model._gates_init(self.width, self.height, self.gates_out)])
-            # create a clock outside the station.
-            self.clock = Agent(self, self.pop_total)
-            self.clock.speed = 0.0
-
             if(self.station is not None):
                 warnings.warn(
                     "The station parameter passed to the model is not valid; "
                     "Using the default station.",
                     RuntimeWarning
                 )
+        if self.obstacles is not None:
+            obstacles.extend(self.obstacles)
+        self.geometry = stationsim_gcs_geometry.Geometry.rectangle(
+            self.width, self.height, circles=obstacles,
+            segments=[] if self.walls is None else self.walls,
+            index=self.neighbour_index)
 
     def is_within_bounds(self, agent, loc):
         return all((self.boundaries[0] + agent.size) < loc) and\
@@ -445,6 +519,306 @@ class Model:
         return np.clip(loc, self.boundaries[0] + agent.size*1.1,
                        self.boundaries[1] - agent.size*1.1)
 
+    def build_index(self):
+        '''
+        Index the locations of all of the agents, to find the agents near
+        a location with self.index.query(location, r).
+
+        Description:
+            The index is the neighbour_index parameter, one of
+            stationsim_index.INDEXES ('kdtree' or 'grid'). Point i of the
+            index is the agent with unique_id i, whatever its status.
+        '''
+        self.index = stationsim_index.INDEXES[self.neighbour_index](
+            self.get_state('location2D'), self.boundaries,
+            self.agent_size * 1.1)
+
+    def _init_random(self, seed):
+        '''
+        Seed the model's generator, self.random, from an int, None (fresh
+        entropy) or a SeedSequence.
+        '''
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.seed_sequence = seed
+        self.random = np.random.default_rng(seed)
+
+    def clone(self, include_history=False):
+        '''
+        Copy the model, with its agents.
+
+        Description:
+            Unlike stationsim_model.Model, the model is deep-copied: its
+            agents keep most of their state (status, speed, wiggle and so
+            on) as attributes of the Agent objects rather than in arrays, so
+            there are no arrays to copy them from. The clone's generator
+            starts in the same state as this model's, so it draws the same
+            random numbers (see spawn for clones that do not).
+            With include_history the clone gets a copy of the history,
+            otherwise it starts an empty one (and the history is not copied
+            at all). Either way the clone's history is kept in memory, so it
+            never writes to this model's history_path.
+
+        Parameters:
+            include_history - whether to copy the history (if do_history)
+        '''
+        memo = {}
+        if self.do_history and not include_history:
+            for name in self._history_names + ('time_save', 'steps_taken',
+                                               'steps_exped', 'steps_delay'):
+                memo[id(getattr(self, name))] = None
+        model = copy.deepcopy(self, memo)
+        model.history_path = None
+        if self.do_history and not include_history:
+            model._init_history()
+        return model
+
+    def spawn(self, n, include_history=False):
+        '''
+        Make n clones of the model that draw independent random numbers.
+
+        Description:
+            Each clone is given a generator seeded with a child of this
+            model's SeedSequence (see SeedSequence.spawn), such as for the
+            particles of a particle filter. The clones are reproducible from
+            random_seed, and do not share any random state with each other
+            or this model.
+
+        Parameters:
+            n               - the number of clones
+            include_history - whether to copy the history (if do_history)
+        '''
+        models = [self.clone(include_history) for _ in range(n)]
+        for model, seed_sequence in zip(models, self.seed_sequence.spawn(n)):
+            model._init_random(seed_sequence)
+        return models
+
+    def copy_state_from(self, other):
+        '''
+        Copy the state of another model into this one, in place.
+
+        Description:
+            Copies the attributes of the agents of `other`, which must have
+            the same parameters (a clone, say), agents_location and the
+            step, time and population counts. The history and the generator
+            are left alone, so the two models go on to draw different random
+            numbers.
+        '''
+        self.agents_location[...] = other.agents_location
+        for agent, other_agent in zip(self.agents, other.agents):
+            agent.__dict__.update(
+                (key, copy.copy(value))
+                for key, value in other_agent.__dict__.items()
+                if key != 'model')
+        self.step_id = other.step_id
+        self.total_time = other.total_time
+        self.pop_active = other.pop_active
+        self.pop_finished = other.pop_finished
+        self.status = other.status
+        self._init_schedule()
+        if self.events is not None:
+            self.events.clear()
+
+    def _init_schedule(self):
+        '''
+        Sort the agents that have not started by activation time, and list
+        the active agents.
+
+        Description:
+            The schedule holds the unique_ids of the agents with status 0 in
+            the order of steps_activate, and schedule_next is the first of
+            them that has not yet been due. The agents that were due but
+            could not be placed at their gate wait in waiting_ids, and
+            active_ids holds the unique_ids of the active agents in
+            ascending order. So a step only looks at the active agents and
+            those that are due, rather than at every agent.
+            Both are made again from the statuses of the agents whenever
+            they are set from outside a step (set_state, load_history).
+        '''
+        pending = [agent.unique_id for agent in self.agents
+                   if agent.status == 0]
+        steps_activate = np.array([self.agents[i].steps_activate
+                                   for i in pending], dtype=float)
+        order = np.argsort(steps_activate, kind='stable')
+        self.schedule = np.array(pending, dtype=int)[order]
+        self.schedule_times = steps_activate[order]
+        self.schedule_next = 0
+        self.waiting_ids = np.empty(0, dtype=int)
+        self.active_ids = np.array([agent.unique_id for agent in self.agents
+                                    if agent.status == 1], dtype=int)
+
+    def activate_agents(self):
+        '''
+        Activate the agents whose activation time has passed, as
+        Agent.activate does for each of them in unique_id order.
+
+        Description:
+            Agent.activate builds a new index of the agents for each agent,
+            and tries up to 10 locations at its gate, drawing each of them
+            in turn, until one of them is more than 1.1 sizes from every
+            other agent. Here the locations for up to 10 tries of every
+            agent are drawn at once, for each gate, and checked at once
+            against the agents near the gate, found with one index of the
+            agents at the start. The agents are then placed in
+            turn as before, taking the locations in the order they were
+            drawn, and checking them against the agents that have already
+            been placed (kept in a grid of cells), so the agents end up in
+            the same places, and the generator is left as it would be.
+            The agents that are due are those that have just come up in
+            the schedule and those still waiting from before (see
+            _init_schedule).
+        '''
+        end = int(np.searchsorted(self.schedule_times, self.total_time,
+                                  side='left'))
+        due = np.union1d(self.waiting_ids,
+                         self.schedule[self.schedule_next:end])
+        self.schedule_next = max(end, self.schedule_next)
+        due = [self.agents[i] for i in due.tolist()
+               if self.agents[i].status == 0]
+        self.waiting_ids = np.array([agent.unique_id for agent in due],
+                                    dtype=int)
+        if not due:
+            return
+        state = self.random.bit_generator.state
+        perturb = self.gates_space * self.random.uniform(-10, +10,
+                                                         size=10*len(due))
+        radius = 1.1 * max(agent.size for agent in due)
+        index = stationsim_index.INDEXES[self.neighbour_index](
+            self.agents_location, self.boundaries, radius)
+        # Every location that could be tried at each gate, and the agents
+        # near each of them, out of those near the gate
+        tries = {}
+        for agent in due:
+            if agent.gate_in not in tries:
+                locations = agent.gate_locations(agent.gate_in, perturb)
+                gate = agent.gate_locations(agent.gate_in, 0.0)
+                nearby = np.array(index.query(
+                    gate, (10 * self.gates_space + radius) * (1 + 1e-9)),
+                    dtype=int)
+                dx = locations[:, None, 0] - self.agents_location[nearby, 0]
+                dy = locations[:, None, 1] - self.agents_location[nearby, 1]
+                rows, columns = np.nonzero(dx * dx + dy * dy <=
+                                           radius * radius)
+                starts = np.searchsorted(rows, np.arange(len(locations) + 1))
+                tries[agent.gate_in] = (locations, starts.tolist(),
+                                        nearby[columns].tolist())
+
+        placements = Placements(self.agents_location, radius)
+        used = 0
+        for agent in due:
+            locations, starts, neighbours = tries[agent.gate_in]
+            r = agent.size*1.1
+            for _ in range(10):
+                new_location = locations[used]
+                x, y = new_location.tolist()
+                used += 1
+                if not placements.free(
+                        agent.unique_id, x, y, r,
+                        neighbours[starts[used-1]:starts[used]]):
+                    continue
+                agent.location = new_location
+                agent.status = 1
+                self.pop_active += 1
+                agent.step_start = self.total_time
+                agent.loc_start = agent.location.copy()
+                placements.take(agent.unique_id, x, y)
+                break
+        # Leave the generator as though only the tries made had been drawn
+        self.random.bit_generator.state = state
+        self.random.uniform(-10, +10, size=used)
+        moved = np.array(sorted(placements.moved), dtype=int)
+        self.waiting_ids = np.setdiff1d(self.waiting_ids, moved)
+        self.active_ids = np.union1d(self.active_ids, moved)
+
+    def wiggle_agents(self, ids):
+        '''
+        Wiggle the agents ids (that have collided) in turn, as
+        Agent.set_wiggle does for each of them.
+
+        Description:
+            Each agent tries up to 10 lateral steps, to a random side of its
+            direction and of a random length, and takes the first one that
+            is more than 1.1 sizes from every other agent and clear of the
+            walls and obstacles, or stays where it is.
+            The sides and lengths of the 10 steps of every agent are drawn
+            at once, and all of the steps are checked at once against one
+            index of the agents and against the geometry. The agents then
+            take their steps in turn: an agent that has already wiggled
+            blocks the agents after it from where it has moved to (kept in
+            a grid of cells) rather than from where it was, so two agents
+            never wiggle into each other, and the agents end up where they
+            would if each of them had been wiggled on its own, in turn.
+
+        Parameters:
+            ids - the unique_ids of the agents, in the order to wiggle them
+        '''
+        ids = np.fromiter(ids, dtype=int)
+        if not len(ids):
+            return
+        agents = [self.agents[i] for i in ids.tolist()]
+        size = np.array([agent.size for agent in agents], dtype=float)
+        side = self.random.choice((-1, 1), size=(len(ids), 10))
+        length = self.random.normal(size[:, None], size[:, None] / 2.0,
+                                    size=(len(ids), 10))
+
+        # Every step that could be tried, as in Agent.set_wiggle
+        location = self.agents_location[ids]
+        loc_desire = np.array([agent.loc_desire for agent in agents],
+                              dtype=float).reshape(-1, 2)
+        direction = (loc_desire - location) /\
+            distances(*(loc_desire - location).T)[:, None]
+        normal = np.stack([np.broadcast_to(direction[:, None, 1], side.shape),
+                           direction[:, None, 0] * side], axis=-1)
+        tries = location[:, None, :] + normal * length[:, :, None]
+        margin = size[:, None, None]
+        within = np.all((self.boundaries[0] + margin < tries) &
+                        (tries < self.boundaries[1] - margin), axis=2)
+        tries = np.where(within[:, :, None], tries,
+                         np.clip(tries, self.boundaries[0] + margin*1.1,
+                                 self.boundaries[1] - margin*1.1))
+
+        # The agents near each step where they were before any wiggled,
+        # and whether the step overlaps a wall or an obstacle
+        radius = 1.1 * size.max()
+        self.build_index()
+        counts, neighbours = self.index.query_many(tries.reshape(-1, 2),
+                                                   radius)
+        starts = np.concatenate([[0], np.cumsum(counts)]).tolist()
+        neighbours = neighbours.tolist()
+        clear = ~self.geometry.overlaps(tries.reshape(-1, 2),
+                                        np.repeat(size, 10))
+
+        placements = Placements(self.agents_location, radius)
+        n_tries = np.full(len(ids), 10)
+        wiggled = []
+        for row, agent in enumerate(agents):
+            r = agent.size*1.1
+            for k in range(10):
+                i = row*10 + k
+                if not clear[i]:
+                    continue
+                x, y = tries[row, k].tolist()
+                if not placements.free(agent.unique_id, x, y, r,
+                                       neighbours[starts[i]:starts[i+1]]):
+                    continue
+                n_tries[row] = k + 1
+                wiggled.append(row)
+                placements.take(agent.unique_id, x, y)
+                break
+        wiggle_locs = tries[wiggled, n_tries[wiggled] - 1]
+        self.agents_location[ids[wiggled]] = wiggle_locs
+
+        if self.do_history:
+            collided = np.arange(10) < n_tries[:, None]
+            self.history_collision_locs.extend(tries[collided])
+            self.history_collision_times.extend(
+                [self.total_time] * int(n_tries.sum()))
+            self.history_wiggle_locs.extend(wiggle_locs)
+            for agent, n in zip(agents, n_tries.tolist()):
+                agent.history_collisions += n
+            for row in wiggled:
+                agents[row].history_wiggles += 1
+
     @staticmethod
     def _init_kwargs(dict0, dict1):
         '''
@@ -467,79 +841,241 @@ class Model:
     def step(self):
         '''
         Iterate model forward one step.
-        '''
-        if self.step_id == 0:
-            state = self.get_state('location2D')
 
+        Description:
+            All of the agents move on to the time of the next collision
+            (tmin), or by one time unit if that is later, and those that
+            collide then wiggle. With the 'table' scheduler tmin is found
+            from a table of the collisions of every active agent (see
+            get_collisionTable); with 'events' it is found from a heap of
+            the predicted collisions that is only changed for the agents
+            that have moved off their trajectories (see
+            stationsim_gcs_events).
+            With do_history, the locations of the agents are sampled at
+            every whole unit of time as they move (see move_agents).
+        '''
         if self.pop_finished < self.pop_total and\
                 self.step_id < self.step_limit and self.status == 1:
             if self.do_print and self.step_id % 100 == 0:
                 print(f'\tIteration: {self.step_id}/{self.step_limit}')
 
-            [agent.activate() for agent in self.agents]
+            self.activate_agents()
 
-            collisionTable, tmin = self.get_collisionTable()
+            if self.events is not None:
+                tmin = self.events.next_collision()
+            else:
+                collisionTable, tmin = self.get_collisionTable(
+                    horizon=1.0 + self.tolerance)
             if (tmin > 1.0):
-                [agent.step(1) for agent in self.agents]
+                self.move_agents(1)
                 self.total_time += 1
             else:
                 tmin *= 0.98  # stop just before the collision
-                [agent.step(tmin) for agent in self.agents]
-                wiggleTable = self.get_wiggleTable(collisionTable, tmin)
-                [self.agents[i].set_wiggle() for i in wiggleTable]
+                self.move_agents(tmin)
+                if self.events is not None:
+                    wiggleTable = self.events.pop_wiggles(tmin)
+                else:
+                    wiggleTable = self.get_wiggleTable(collisionTable, tmin)
+                self.wiggle_agents(wiggleTable)
                 self.total_time += tmin
-
-            if self.do_history:
-                if (self.total_time % 1.0 <= 1 and 
-                        int(self.total_time) not in self.time_save):
-                    self.time_save.append(int(self.total_time))
-                    state = self.get_state('location2D')
-                    self.history_state.append(state)
-                    [agent.history() for agent in self.agents]
+                if self.events is not None:
+                    self.events.update(wiggleTable)
 
             self.step_id += 1
+            if self.do_history and self.history_path is not None and\
+                    (self.pop_finished == self.pop_total or
+                     self.step_id == self.step_limit):
+                self.save_history()
         else:
             if self.do_print and self.status == 1:
                 print(f'StationSim {self.unique_id} - Everyone made it!')
                 self.status = 0
 
+    def move_agents(self, time_step):
+        '''
+        Step the active agents (active_ids) in unique_id order, and drop
+        those that have left the model from active_ids.
+
+        With do_history, the locations at each whole unit of time within
+        the step are saved (see sample_history).
+        '''
+        ids = self.active_ids
+        if self.do_history:
+            start = self.agents_location[ids]
+        agents = [self.agents[i] for i in ids.tolist()]
+        [agent.step(time_step) for agent in agents]
+        if self.do_history:
+            self.sample_history(ids, start, time_step)
+        self.active_ids = ids[[agent.status == 1 for agent in agents]]
+
+    def sample_history(self, ids, start, time_step):
+        '''
+        Save the locations of the agents at each whole unit of time from
+        total_time to total_time + time_step.
+
+        Description:
+            The model moves on by a variable time at each step, so the
+            samples are taken at fixed times, 0, 1, 2, ..., which are kept
+            in time_save. The agents ids have just moved in a straight line
+            from start, so their locations at the time of a sample are
+            interpolated between start and where they are now (before they
+            wiggle), and the other agents have stayed where they were. The
+            time of the next sample is len(time_save), so each step only
+            does work for the samples that fall within it.
+
+        Parameters:
+            ids       - the unique_ids of the agents that moved, in ascending
+                        order
+            start     - their locations at the start of the step
+            time_step - how long they moved for
+        '''
+        sample = len(self.time_save)
+        while sample <= self.total_time + time_step:
+            state = self.agents_location.copy()
+            fraction = (sample - self.total_time) / time_step\
+                if time_step > 0 else 1.0
+            if fraction < 1.0:
+                state[ids] = start + (state[ids] - start) * fraction
+            locations = np.full_like(state, np.nan)
+            locations[ids] = state[ids]
+            self.history_state.append(state)
+            self.history_locations.append(locations)
+            self.time_save.append(sample)
+            sample += 1
+
     # information about next collision
-    def get_collisionTable(self):
+    def get_collisionTable(self, horizon=np.inf):
         '''
-        Returns the time of next colision (tmin) and a table with 
+        Returns the time of next colision (tmin) and a table with
         information about every possible colision:
-        - collisionTable[0]: collision time
-        - collisionTable[1]: agent agent.unique_id
-        '''
-        collisionTable = []
-        for i in range(self.pop_total):
-            if (self.agents[i].status == 1):
-                collisionTime = self.agents[i].get_collisionTimeWall()
-                collision = (collisionTime, i)
-                collisionTable.append(collision)
-
-                collisionTime =\
-                    self.agents[i].get_collisionTime2Agents(self.clock)
-                collision = (collisionTime, i)
-                collisionTable.append(collision)
-
-                for j in range(i+1, self.pop_total):
-                    if (self.agents[j].status == 1):
-                        collisionTime = self.agents[i].\
-                            get_collisionTime2Agents(self.agents[j])
-                        collision = (collisionTime, i)
-                        collisionTable.append(collision)
-                        collision = (collisionTime, j)
-                        collisionTable.append(collision)
-
-        try:
-            tmin = min(collisionTable)
-            tmin = tmin[0]
-        except:
-            tmin = 1.0e300
+        - collisionTable[:, 0]: collision time
+        - collisionTable[:, 1]: agent agent.unique_id
 
+        Description:
+            For each active agent, in unique_id order, the table has a row
+            for its collision with a wall (Agent.get_collisionTimeWall), a
+            row for its collision with an obstacle (such as the clock, see
+            stationsim_gcs_geometry), and two rows (one for each
+            agent) for its collision with each active agent with a higher
+            unique_id (Agent.get_collisionTime2Agents). The times are
+            computed for all of the agents at once.
+            With a finite horizon, only the pairs of agents that are near
+            enough to collide within horizon are found, with the neighbour
+            index (see build_index), and the other pairs are left out of the
+            table. tmin is then the same whenever it is at most horizon.
+
+        Parameters:
+            horizon - the longest collision time that is needed
+        '''
+        ids, time_wall, time_obstacle, a, b, time_pair =\
+            self.predict_collisions(horizon=horizon)
+        n = len(ids)
+        if not n:
+            return np.empty((0, 2)), 1.0e300
+        a, b = np.searchsorted(ids, a), np.searchsorted(ids, b)
+        time_obstacle, time_pair = np.abs(time_obstacle), np.abs(time_pair)
+
+        # Sort the rows into the order of the loop over agents: the wall,
+        # the obstacle, and then each pair with the agent, then the other
+        m = len(a)
+        times = np.concatenate([time_wall, time_obstacle, time_pair,
+                                time_pair])
+        owner = np.concatenate([np.arange(n), np.arange(n), a, b])
+        keys = (np.concatenate([np.zeros(2*n + m, dtype=int),
+                                np.ones(m, dtype=int)]),
+                np.concatenate([np.zeros(2*n, dtype=int), b, b]),
+                np.repeat([0, 1, 2], [n, n, 2*m]),
+                np.concatenate([np.arange(n), np.arange(n), a, a]))
+        order = np.lexsort(keys)
+        collisionTable = np.column_stack([times[order], ids[owner[order]]])
+        tmin = collisionTable[:, 0].min()
         return collisionTable, tmin
 
+    def predict_collisions(self, ids=None, horizon=np.inf, active=None):
+        '''
+        Returns the times of the next collisions of some active agents
+        with the walls, the obstacles and the other active agents.
+
+        Description:
+            The times of the pairs are those of
+            Agent.get_collisionTime2Agents, computed for all of the agents
+            at once, and the times with the walls and obstacles are those of
+            self.geometry (see stationsim_gcs_geometry). Each pair of agents
+            is given once, with agent a one of ids, and with a < b when both
+            are.
+            With a finite horizon, only the pairs of agents that are near
+            enough to collide within horizon are found, with the neighbour
+            index (see build_index), and the other pairs are left out.
+
+        Parameters:
+            ids     - the unique_ids of the agents, all the active agents
+                      (in unique_id order) by default
+            horizon - the longest collision time that is needed
+            active  - the unique_ids of the agents that can be the other
+                      agent of a pair, in unique_id order, active_ids by
+                      default
+
+        Returns:
+            ids        - the unique_ids of the active agents of ids
+            time_wall  - the time until each of them collides with a wall
+            time_obstacle - the time until each of them collides with an
+                            obstacle
+            a, b       - the unique_ids of the pairs of agents
+            time_pair  - the time until each pair collides
+            The times with the obstacles and of the pairs are negative for
+            the agents that already overlap (see
+            stationsim_gcs_geometry.collision_times).
+        '''
+        if active is None:
+            active = self.active_ids
+        if ids is None:
+            ids = active
+        else:
+            ids = np.array([i for i in ids if self.agents[i].status == 1],
+                           dtype=int)
+        empty = np.empty(0, dtype=int)
+        if not len(ids):
+            return ids, np.empty(0), np.empty(0), empty, empty, np.empty(0)
+
+        # Pairs of agents
+        if np.isinf(horizon):
+            a = np.repeat(ids, len(active))
+            b = np.tile(active, len(ids))
+        else:
+            speed = max(self.agents[i].speed for i in active)
+            radius = 2 * speed * horizon + 2 * self.agent_size
+            radius *= 1 + 1e-9  # no pair is lost to rounding
+            index = stationsim_index.INDEXES[self.neighbour_index](
+                self.agents_location[active], self.boundaries, radius)
+            counts, b = index.query_many(self.agents_location[ids], radius)
+            a, b = np.repeat(ids, counts), active[b]
+        is_id = np.zeros(self.pop_total, dtype=bool)
+        is_id[ids] = True
+        keep = (a != b) & ~(is_id[b] & (b < a))
+        a, b = a[keep], b[keep]
+
+        # The velocity of each agent that is needed
+        agents = np.union1d(ids, b)
+        location = self.agents_location[agents]
+        loc_desire = np.array([self.agents[i].loc_desire for i in agents],
+                              dtype=float).reshape(-1, 2)
+        speed = np.array([self.agents[i].speed for i in agents], dtype=float)
+        size = np.array([self.agents[i].size for i in agents], dtype=float)
+        direction = (loc_desire - location) /\
+            distances(*(loc_desire - location).T)[:, None]
+        velocity = speed[:, None] * direction
+        a_row, b_row = np.searchsorted(agents, a), np.searchsorted(agents, b)
+        time_pair = stationsim_gcs_geometry.collision_times(
+            location[a_row] - location[b_row],
+            velocity[a_row] - velocity[b_row], size[a_row] + size[b_row])
+        rows = np.searchsorted(agents, ids)
+        location, velocity, size = location[rows], velocity[rows], size[rows]
+
+        # Walls and obstacles
+        time_wall, time_obstacle = self.geometry.contact_times(
+            location, velocity, size, horizon)
+        return ids, time_wall, time_obstacle, a, b, time_pair
+
     def get_wiggleTable(self, collisionTable, time):
         '''
         Returns a table with the agent.unique_id of all agents that
@@ -550,42 +1086,127 @@ class Model:
         - Column 0: collision time
         - Column 1: agent.unique_id
         '''
-        return set([line[1] for line in collisionTable
-                    if (abs(line[0] - time) < self.tolerance)])
+        wiggle = np.abs(collisionTable[:, 0] - time) < self.tolerance
+        return set(collisionTable[wiggle, 1].astype(int).tolist())
+
+    # History
+    _history_names = ('history_state', 'history_locations',
+                      'history_wiggle_locs', 'history_collision_locs',
+                      'history_collision_times')
+
+    def _init_history(self):
+        '''
+        Start an empty history, in history_path if it is set.
+        '''
+        self.time_save = []
+        # Locations of every agent at each saved time
+        self.history_state = stationsim_history.history_array(
+            self.history_path, 'history_state', (self.pop_total, 2))
+        # The same for the active agents, nan for the others
+        self.history_locations = stationsim_history.history_array(
+            self.history_path, 'history_locations', (self.pop_total, 2))
+        self.history_wiggle_locs = stationsim_history.history_array(
+            self.history_path, 'history_wiggle_locs', (2,))
+        self.history_collision_locs = stationsim_history.history_array(
+            self.history_path, 'history_collision_locs', (2,))
+        self.history_collision_times = stationsim_history.history_array(
+            self.history_path, 'history_collision_times')
+        self.steps_taken = []
+        self.steps_exped = []
+        self.steps_delay = []
+
+    def save_history(self):
+        '''
+        Save the history to history_path so that it can be reopened with
+        load_history().
+
+        Description:
+            The history arrays are already in memory-mapped files. This
+            flushes them and saves the rest of what the analytics and
+            figures need. It is called at the end of the run, and can be
+            called at any time to save a run that is stopped early.
+        '''
+        stationsim_history.save_history(
+            self.history_path,
+            {name: getattr(self, name) for name in self._history_names},
+            params=self.params, seed_entropy=self.seed_sequence.entropy,
+            seed_spawn_key=self.seed_sequence.spawn_key, step_id=self.step_id,
+            total_time=self.total_time, time_save=self.time_save,
+            pop_active=self.pop_active, pop_finished=self.pop_finished,
+            agents_status=[agent.status for agent in self.agents],
+            agents_collisions=[agent.history_collisions for agent in
+                               self.agents],
+            agents_wiggles=[agent.history_wiggles for agent in self.agents],
+            steps_taken=self.steps_taken, steps_exped=self.steps_exped,
+            steps_delay=self.steps_delay)
+
+    @classmethod
+    def load_history(cls, history_path):
+        '''
+        Reopen the history of a model that was run with a history_path.
+
+        Description:
+            Recreates the model from its saved parameters and seed, without
+            running it, and attaches the saved history (read-only), so that
+            the analytics and figures can be made again.
+        '''
+        index = stationsim_history.load_history(history_path)
+        seed_sequence = np.random.SeedSequence(
+            index['seed_entropy'], spawn_key=tuple(index['seed_spawn_key']))
+        model = cls(**dict(index['params'], random_seed=seed_sequence,
+                           history_path=None, do_history=True))
+        model.history_path = history_path
+        for name, array in index['arrays'].items():
+            setattr(model, name, array)
+        for key in ('step_id', 'total_time', 'time_save', 'pop_active',
+                    'pop_finished', 'steps_taken', 'steps_exped',
+                    'steps_delay'):
+            setattr(model, key, index[key])
+        for i, agent in enumerate(model.agents):
+            agent.status = index['agents_status'][i]
+            agent.history_collisions = index['agents_collisions'][i]
+            agent.history_wiggles = index['agents_wiggles'][i]
+        model._init_schedule()
+        return model
 
     # State
     def get_state(self, sensor=None):
         '''
-        Convert list of agents in model to state vector.
+        Convert the agents in the model to a state vector.
+
+        The locations are copied out of agents_location, so changing the
+        state does not change the model.
         '''
         if sensor is None:
             state = [(agent.status, *agent.location, agent.speed) for agent in
                      self.agents]
             state = np.append(self.step_id, np.ravel(state))
-        elif sensor is 'location':
-            state = [agent.location for agent in self.agents]
-            state = np.ravel(state)
-        elif sensor is 'location2D':
-            state = [agent.location for agent in self.agents]
+        elif sensor == 'location':
+            state = self.agents_location[:self.pop_total].flatten()
+        elif sensor == 'location2D':
+            state = self.agents_location[:self.pop_total].copy()
         return state
 
     def set_state(self, state, sensor=None):
         '''
         Use state vector to set agent locations.
+
+        The locations are copied into agents_location in one assignment.
         '''
         if sensor is None:
             self.step_id = int(state[0])
             state = np.reshape(state[1:], (self.pop_total, 3))
             for i, agent in enumerate(self.agents):
                 agent.status = int(state[i, 0])
-                agent.location = state[i, 1:]
-        elif sensor is 'location':
-            state = np.reshape(state, (self.pop_total, 2))
-            for i, agent in enumerate(self.agents):
-                agent.location = state[i, :]
-        elif sensor is 'location2D':
-            for i, agent in enumerate(self.agents):
-                agent.location = state[i, :]
+            self.agents_location[:self.pop_total] = state[:, 1:]
+        elif sensor == 'location':
+            self.agents_location[:self.pop_total] =\
+                np.reshape(state, (self.pop_total, 2))
+        elif sensor == 'location2D':
+            self.agents_location[:self.pop_total] = state
+        self._init_schedule()
+        if self.events is not None:
+            self.events.clear()
 
     # TODO: Deprecated, update PF
     def agents2state(self, do_ravel=True):
@@ -607,16 +1228,15 @@ class Model:
         directory = sensor + '_' + time_id
         if not(os.path.exists(directory)):
             os.mkdir(directory)
-        locs = np.array([agent.history_locations for agent in
-                         self.agents[:agents]]).transpose((1, 2, 0))        
+        locs = self.history_locations[:, :agents].transpose((0, 2, 1))
         if(sensor == 'frame'):
             for frame in self.time_save:
                 save_file = open(directory+'/frame_'+ str(frame) +'.dat', 'w')
                 print('#agentID', 'x', 'y', file=save_file)
-                x = locs[frame-1][0]
-                y = locs[frame-1][1]
+                x = locs[frame][0]
+                y = locs[frame][1]
                 for agent in range(self.pop_total):
-                    if(x[agent]!=None):
+                    if not np.isnan(x[agent]):
                         print(agent, x[agent], y[agent], file=save_file)
                 save_file.close()
 
@@ -679,7 +1299,7 @@ class Model:
             else:
                 alpha = 1
                 colour = colours[2]
-            locs = np.array(agent.history_locations).T
+            locs = agent.history_locations.T
             plt.plot(*locs, color=colour, alpha=alpha, linewidth=.5)
         if xlim is not None:  # Optionally set the x limits
             plt.xlim(xlim)
@@ -746,12 +1366,8 @@ class Model:
         :param title: (optional) title for the plot
         :return:
         '''
-        history_locs = []
-        for agent in self.agents:
-            for loc in agent.history_locations:
-                if None not in loc:
-                    history_locs.append(loc)
-        history_locs = np.array(history_locs).T
+        history_locs = self.history_locations.data.reshape(-1, 2)
+        history_locs = history_locs[~np.isnan(history_locs[:, 0])].T
         fig, ax = plt.subplots(1, figsize=self._figsize, dpi=self._dpi)
         fig.tight_layout(pad=0)
         self._heightmap(data=history_locs, ax=ax, kdeplot=do_kdeplot,
@@ -766,8 +1382,7 @@ class Model:
     def get_ani(self, agents=None, colour='k', alpha=.5, show_separation=False,
                 wiggle_map=False):
         # Load Data
-        locs = np.array([agent.history_locations for agent in
-                        self.agents[:agents]]).transpose((1, 2, 0))
+        locs = self.history_locations[:, :agents].transpose((0, 2, 1))
         markersize1 = self.separation * 216*self._rel  # 3*72px/in=216
         markersize2 = 216*self._rel
         #
@@ -797,7 +1412,10 @@ class Model:
 
     @classmethod
     def set_random_seed(cls, seed=None):
-        '''Set a new numpy random seed
+        '''Set a new seed for the global numpy random state
+        The models draw from their own generator (self.random) rather than
+        the global random state, so this only affects code that uses
+        np.random.
         :param seed: the optional seed value (if None then
         get one from os.urandom)
         '''
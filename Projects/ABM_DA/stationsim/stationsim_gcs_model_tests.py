@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for stationsim_gcs_model.
+
+Run from this directory with `python -m unittest stationsim_gcs_model_tests`.
+"""
+
+import copy
+import os
+import tempfile
+import unittest
+import warnings
+import numpy as np
+from stationsim_gcs_model import Model
+from stationsim_gcs_geometry import Geometry
+
+
+class Still:
+    """An obstacle as a still agent, for Agent.get_collisionTime2Agents."""
+
+    speed = 0.0
+
+    def __init__(self, x, y, size):
+        self.location = np.array([x, y])
+        self.loc_desire = self.location
+        self.size = size
+
+    def get_direction(self, loc_desire, location):
+        return np.zeros(2)
+
+
+def collision_table_loop(model):
+    """The collision table made one agent and one pair at a time."""
+    obstacles = [Still(*circle) for circle in model.geometry.circles]
+    table = []
+    for i, agent in enumerate(model.agents):
+        if agent.status == 1:
+            table.append((agent.get_collisionTimeWall(), i))
+            times = [agent.get_collisionTime2Agents(obstacle)
+                     for obstacle in obstacles]
+            table.append((min(times, default=1.0e300), i))
+            for j in range(i+1, model.pop_total):
+                if model.agents[j].status == 1:
+                    time = agent.get_collisionTime2Agents(model.agents[j])
+                    table.extend([(time, i), (time, j)])
+    return np.array(table).reshape(-1, 2)
+
+
+def wiggle_loop(model, ids, side, length):
+    """Agent.set_wiggle one agent and one step at a time, with given draws."""
+    for row, i in enumerate(ids):
+        agent = model.agents[i]
+        direction = agent.get_direction(agent.loc_desire, agent.location)
+        model.build_index()
+        for k in range(10):
+            normal_direction = np.array([direction[1],
+                                         direction[0] * side[row, k]])
+            new_location = agent.location + normal_direction * length[row, k]
+            if not model.is_within_bounds(agent, new_location):
+                new_location = model.re_bound(agent, new_location)
+            agent.history_collisions += 1
+            model.history_collision_locs.append(new_location)
+            neighbouring_agents = model.index.query(new_location,
+                                                    agent.size*1.1)
+            if (neighbouring_agents in ([], [i]) and
+                    not model.geometry.overlaps(new_location, agent.size)):
+                agent.location = new_location
+                agent.history_wiggles += 1
+                model.history_wiggle_locs.append(new_location)
+                break
+
+
+class Test_Collisions(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        warnings.simplefilter('ignore')
+        cls.models = []
+        for params in (dict(pop_total=60, gates_speed=2),
+                       dict(pop_total=120, gates_speed=.5,
+                            station='Grand_Central')):
+            model = Model(do_print=False, random_seed=2, **params)
+            for _ in range(40):
+                model.step()
+            cls.models.append(model)
+
+    def test_collision_table(self):
+
+        """get_collisionTable gives the table of the loop over agents.
+
+        With a horizon it only leaves out pairs that collide later, so
+        the rows within the horizon, tmin and the wiggle set are the same.
+        """
+
+        for model in self.models:
+            expected = collision_table_loop(model)
+            table, tmin = model.get_collisionTable()
+            np.testing.assert_array_equal(table, expected)
+            self.assertEqual(tmin, expected[:, 0].min())
+
+            horizon = 1.0 + model.tolerance
+            table, tmin = model.get_collisionTable(horizon=horizon)
+            soon = expected[expected[:, 0] <= horizon]
+            np.testing.assert_array_equal(table[table[:, 0] <= horizon], soon)
+            self.assertEqual(tmin, expected[:, 0].min())
+            self.assertEqual(list(model.get_wiggleTable(table, .98 * tmin)),
+                             list(model.get_wiggleTable(expected, .98 * tmin)))
+
+    def test_events(self):
+
+        """The 'events' scheduler steps the model as the 'table' one does.
+
+        Its collision times are kept as absolute times, so they may round
+        differently, but the agents wiggle at the same steps and in the
+        same order, so the models stay together.
+        """
+
+        for params in (dict(pop_total=60, gates_speed=2),
+                       dict(pop_total=120, gates_speed=.5,
+                            station='Grand_Central')):
+            table = Model(do_print=False, random_seed=2, **params)
+            events = Model(do_print=False, random_seed=2, scheduler='events',
+                           **params)
+            for _ in range(150):
+                table.step()
+                events.step()
+            self.assertAlmostEqual(events.total_time, table.total_time)
+            np.testing.assert_allclose(events.agents_location,
+                                       table.agents_location, atol=1e-6)
+            self.assertEqual(len(events.history_wiggle_locs),
+                             len(table.history_wiggle_locs))
+            self.assertEqual(events.random.bit_generator.state,
+                             table.random.bit_generator.state)
+
+
+class Test_Activation(unittest.TestCase):
+
+    def test_activate_agents(self):
+
+        """Model.activate_agents places the agents as Agent.activate does.
+
+        With a burst of arrivals, many agents are due at once and many of
+        them cannot be placed, so they try again at the next step.
+        """
+
+        warnings.simplefilter('ignore')
+        model = Model(do_print=False, random_seed=3, pop_total=400,
+                      gates_speed=.05, station='Grand_Central')
+        for _ in range(10):
+            loop, batched = copy.deepcopy(model), copy.deepcopy(model)
+            [agent.activate() for agent in loop.agents]
+            batched.activate_agents()
+            np.testing.assert_array_equal(batched.agents_location,
+                                          loop.agents_location)
+            self.assertEqual([agent.status for agent in batched.agents],
+                             [agent.status for agent in loop.agents])
+            self.assertEqual(batched.pop_active, loop.pop_active)
+            self.assertEqual(batched.random.bit_generator.state,
+                             loop.random.bit_generator.state)
+            model.step()
+        self.assertLess(model.pop_active, model.pop_total)
+
+
+class Test_Wiggle(unittest.TestCase):
+
+    def test_wiggle_agents(self):
+
+        """Model.wiggle_agents moves the agents as Agent.set_wiggle does.
+
+        All of the agents near the gates wiggle at once, so many of them
+        try to step into each other, and into where the others were.
+        """
+
+        warnings.simplefilter('ignore')
+        model = Model(do_print=False, random_seed=3, pop_total=400,
+                      gates_speed=.05, station='Grand_Central')
+        for _ in range(5):
+            model.step()
+        ids = model.active_ids[::-1]
+        loop, batched = copy.deepcopy(model), copy.deepcopy(model)
+        side = loop.random.choice((-1, 1), size=(len(ids), 10))
+        length = loop.random.normal(1.0, .5, size=(len(ids), 10))
+        wiggle_loop(loop, ids, side, length)
+        batched.wiggle_agents(ids)
+        np.testing.assert_array_equal(batched.agents_location,
+                                      loop.agents_location)
+        for name in ('history_collision_locs', 'history_wiggle_locs'):
+            np.testing.assert_array_equal(getattr(batched, name),
+                                          getattr(loop, name))
+        self.assertEqual([agent.history_wiggles for agent in batched.agents],
+                         [agent.history_wiggles for agent in loop.agents])
+        self.assertEqual(batched.random.bit_generator.state,
+                         loop.random.bit_generator.state)
+        wiggles = len(batched.history_wiggle_locs) -\
+            len(model.history_wiggle_locs)
+        self.assertGreater(wiggles, 0)
+        self.assertLess(wiggles, len(ids))
+
+
+class Test_History(unittest.TestCase):
+
+    def test_sample_history(self):
+
+        """The history is sampled at every whole unit of time.
+
+        A lone agent moves in a straight line at its speed, so between two
+        samples it moves exactly its speed, whatever the steps were.
+        """
+
+        warnings.simplefilter('ignore')
+        for seed in range(3):
+            model = Model(do_print=False, random_seed=seed, pop_total=1,
+                          gates_speed=2)
+            while model.pop_finished < model.pop_total:
+                model.step()
+            self.assertEqual(model.time_save,
+                             list(range(int(model.total_time) + 1)))
+            self.assertEqual(len(model.history_state), len(model.time_save))
+            locations = model.agents[0].history_locations
+            moving = ~np.isnan(locations[:, 0])
+            self.assertGreater(moving.sum(), 10)
+            steps = np.diff(locations[moving], axis=0)
+            np.testing.assert_allclose(np.hypot(*steps.T),
+                                       model.agents[0].speed)
+
+    def test_get_data(self):
+
+        """The frame written for time t holds the locations sampled at time t."""
+
+        warnings.simplefilter('ignore')
+        model = Model(do_print=False, random_seed=1, pop_total=5,
+                      gates_speed=2)
+        for _ in range(40):
+            model.step()
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                model.get_data('test')
+                checked = 0
+                for frame in model.time_save:
+                    locations = model.history_locations[frame]
+                    active = np.flatnonzero(~np.isnan(locations[:, 0]))
+                    data = np.loadtxt(f'frame_test/frame_{frame}.dat',
+                                      ndmin=2).reshape(-1, 3)
+                    np.testing.assert_array_equal(data[:, 0], active)
+                    np.testing.assert_allclose(data[:, 1:],
+                                               locations[active])
+                    checked += len(active) > 0
+                self.assertGreater(checked, 5)
+            finally:
+                os.chdir(cwd)
+
+
+class Test_Geometry(unittest.TestCase):
+
+    def test_contact_times(self):
+
+        """The first contact with a wall, the end of a wall and a circle."""
+
+        geometry = Geometry.rectangle(100, 100, circles=[[80, 50, 5]],
+                                      segments=[[[50, 20], [50, 60]]])
+        location = [[10, 50], [10, 70], [10, 60.5], [60, 50], [50, 90]]
+        velocity = [[2, 0], [2, 0], [2, 0], [-1, 0], [0, 0]]
+        time_wall, time_obstacle = geometry.contact_times(location, velocity,
+                                                          1.0)
+        # Into the middle wall, past its end to the station wall, onto the
+        # end of the middle wall, back into the middle wall, and still
+        np.testing.assert_allclose(
+            time_wall, [19.5, 44.5, (40 - np.sqrt(.75)) / 2, 9, 1e300])
+        np.testing.assert_allclose(time_obstacle, [32, 1e300, 1e300, 1e300,
+                                                   1e300])
+        self.assertTrue(geometry.overlaps([50.5, 40], 1.0))
+        self.assertTrue(geometry.overlaps([75, 50], 1.0))
+        self.assertFalse(geometry.overlaps([48, 40], 1.0))
+
+    def test_horizon(self):
+
+        """With a horizon, the times within it are the same."""
+
+        random = np.random.default_rng(0)
+        start = random.uniform(0, 400, (200, 2))
+        segments = np.stack([start, start + random.normal(0, 10, (200, 2))],
+                            axis=1)
+        circles = np.column_stack([random.uniform(0, 400, (100, 2)),
+                                   random.uniform(1, 5, 100)])
+        geometry = Geometry.rectangle(400, 400, circles, segments)
+        location = random.uniform(0, 400, (500, 2))
+        velocity = random.normal(0, 1, (500, 2))
+        expected = geometry.contact_times(location, velocity, 1.0)
+        for horizon in (.5, 2, 10):
+            times = geometry.contact_times(location, velocity, 1.0, horizon)
+            for time, time_expected in zip(times, expected):
+                soon = np.abs(time_expected) <= horizon
+                self.assertGreater(soon.sum(), 0)
+                np.testing.assert_array_equal(time[soon], time_expected[soon])
+                self.assertTrue(np.all(np.abs(time[~soon]) > horizon))
+
+
+class Test_Clone(unittest.TestCase):
+
+    def test_clone(self):
+
+        """A clone, and a model given its state, step as the model does."""
+
+        warnings.simplefilter('ignore')
+        for scheduler in ('table', 'events'):
+            model = Model(do_print=False, random_seed=3, pop_total=40,
+                          scheduler=scheduler)
+            for _ in range(50):
+                model.step()
+            clone = model.clone()
+            self.assertEqual(len(clone.history_state), 0)
+            self.assertEqual(len(model.clone(include_history=True)
+                                 .history_state), len(model.history_state))
+            other = Model(do_print=False, random_seed=4, pop_total=40,
+                          scheduler=scheduler)
+            other.copy_state_from(model)
+            other.random = copy.deepcopy(model.random)
+            for _ in range(100):
+                model.step()
+                clone.step()
+                other.step()
+            np.testing.assert_array_equal(clone.agents_location,
+                                          model.agents_location)
+            np.testing.assert_array_equal(other.agents_location,
+                                          model.agents_location)
+            self.assertEqual(other.pop_finished, model.pop_finished)
+
+    def test_spawn(self):
+
+        """Spawned clones draw different random numbers."""
+
+        warnings.simplefilter('ignore')
+        model = Model(do_print=False, random_seed=3, pop_total=5)
+        models = model.spawn(2)
+        self.assertFalse(np.array_equal(models[0].random.random(3),
+                                        models[1].random.random(3)))
+
+
+if __name__ == "__main__":
+    unittest.main()
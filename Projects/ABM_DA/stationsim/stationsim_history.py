@@ -0,0 +1,169 @@
+'''
+StationSim History
+    Buffers that the StationSim models record their history in.
+
+Description:
+    A HistoryArray is appended to along its first axis like a list, but its
+    rows live in one NumPy array. Given a path the array is a np.memmap, so a
+    long run streams its history to disk rather than holding it in memory.
+
+    A model with a `history_path` keeps each of its history arrays in a raw
+    '<name>.dat' file in that directory, and describes them (and anything else
+    needed to reopen them) in 'history.json'. load_history() reopens them.
+'''
+
+import json
+import os
+import numpy as np
+
+
+INDEX = 'history.json'
+
+
+class HistoryArray:
+    '''
+    A NumPy array that is appended to along its first axis, like a list.
+
+    Description:
+        Rows are written into a preallocated array whose capacity is doubled
+        when it fills up, so recording the history creates no Python objects
+        per agent or per event. Indexing, len(), iteration and np.asarray()
+        only see the rows that have been written.
+
+    Parameters:
+        shape    - the shape of each row
+        dtype    - the type of the array
+        capacity - the number of rows to allocate at first
+        path     - if given, the rows are kept in a memory-mapped file at path
+    '''
+    def __init__(self, shape=(), dtype=float, capacity=64, path=None):
+        self.path = path
+        self._len = 0
+        self._data = self._allocate((capacity, *shape), dtype, 'w+')
+
+    def _allocate(self, shape, dtype, mode):
+        if self.path is None:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(self.path, dtype=dtype, mode=mode, shape=shape)
+
+    def _reserve(self, length):
+        if length > len(self._data):
+            shape = (max(length, 2 * len(self._data)), *self._data.shape[1:])
+            if self.path is None:
+                data = self._allocate(shape, self._data.dtype, None)
+                data[:self._len] = self._data[:self._len]
+            else:
+                # The rows are contiguous, so growing the file keeps them in place
+                self._data.flush()
+                data = self._allocate(shape, self._data.dtype, 'r+')
+            self._data = data
+
+    def append(self, row):
+        self._reserve(self._len + 1)
+        self._data[self._len] = row
+        self._len += 1
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=self._data.dtype)
+        if len(rows):
+            self._reserve(self._len + len(rows))
+            self._data[self._len:self._len + len(rows)] = rows
+            self._len += len(rows)
+
+    def __getstate__(self):
+        '''
+        Copies and pickles are held in memory, so that they never write to
+        the file of a memory-mapped array.
+        '''
+        return {'path': None, '_len': self._len, '_data': np.array(self._data)}
+
+    def flush(self):
+        if self.path is not None:
+            self._data.flush()
+
+    def info(self):
+        '''
+        What load_history needs to know to reopen the array.
+        '''
+        return {'file': os.path.basename(self.path) if self.path else None,
+                'dtype': self._data.dtype.str,
+                'shape': self._data.shape[1:],
+                'length': self._len}
+
+    @classmethod
+    def open(cls, directory, info):
+        '''
+        Reopen a memory-mapped history array read-only.
+        '''
+        history = cls.__new__(cls)
+        history.path = os.path.join(directory, info['file'])
+        history._len = info['length']
+        shape = (max(history._len, 1), *info['shape'])  # np.memmap can not map an empty file
+        history._data = history._allocate(shape, np.dtype(info['dtype']), 'r')
+        return history
+
+    @property
+    def data(self):
+        return self._data[:self._len]
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array(self.data, dtype=dtype, copy=copy)
+
+
+def history_array(history_path, name, shape=(), dtype=float):
+    '''
+    A new HistoryArray, kept in history_path/<name>.dat if history_path is given.
+    '''
+    if history_path is None:
+        return HistoryArray(shape, dtype)
+    os.makedirs(history_path, exist_ok=True)
+    return HistoryArray(shape, dtype, path=os.path.join(history_path, name + '.dat'))
+
+
+def save_history(history_path, arrays, **attrs):
+    '''
+    Flush the memory-mapped history arrays and write the index that describes them.
+
+    Parameters:
+        history_path - the directory the arrays are kept in
+        arrays       - dictionary of the model's HistoryArrays, by name
+        **attrs      - anything else to save, it must be JSON serialisable
+    '''
+    for array in arrays.values():
+        array.flush()
+    index = dict(attrs, arrays={name: array.info() for name, array in arrays.items()})
+    with open(os.path.join(history_path, INDEX), 'w') as f:
+        json.dump(index, f, default=_to_json)
+
+
+def load_history(history_path):
+    '''
+    Read the index written by save_history and reopen the arrays it lists.
+
+    Returns:
+        index - the saved attributes, with index['arrays'] a dictionary of
+                read-only HistoryArrays by name
+    '''
+    with open(os.path.join(history_path, INDEX)) as f:
+        index = json.load(f)
+    index['arrays'] = {name: HistoryArray.open(history_path, info) for name, info in index['arrays'].items()}
+    return index
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.random.SeedSequence):
+        return {'entropy': value.entropy, 'spawn_key': value.spawn_key}
+    raise TypeError(f'{type(value).__name__} is not JSON serialisable')
@@ -0,0 +1,205 @@
+'''
+StationSim Index
+    Neighbour indexes that the StationSim models find nearby agents with.
+
+Description:
+    An index is built over the locations of some agents at the start of a
+    step (or a move) and answers "which of them are within r of here?".
+    Every index takes the same arguments and has the same methods, so the
+    models can use any of them (see the `neighbour_index` model parameter):
+
+        index = INDEXES[name](locations, boundaries, radius)
+        index.query(location, r)       -> list of indices within r of location
+        index.query_many(locations, r) -> (counts, indices) for many locations
+
+    The indices are rows of the locations that the index was built with.
+    A point is within r when its squared distance is at most r*r, as in
+    cKDTree.query_ball_point, so every index finds the same points.
+
+    'kdtree' - scipy's cKDTree, the best choice for sparse crowds
+    'grid'   - a uniform grid of cells the size of the radius, rebuilt by
+               counting sort, the best choice for dense crowds
+
+    Run this module to benchmark the two and see where they cross over.
+'''
+
+import itertools
+import numpy as np
+from scipy.spatial import cKDTree
+try:
+    import stationsim_numba
+except ImportError:  # imported as part of the stationsim package
+    from . import stationsim_numba
+
+
+class KDTreeIndex:
+    '''
+    A neighbour index backed by scipy's cKDTree.
+
+    Parameters:
+        locations  - (N, 2) array of the points to index
+        boundaries - [[x_min, y_min], [x_max, y_max]] of the station (not used)
+        radius     - the radius that will usually be queried (not used)
+    '''
+    def __init__(self, locations, boundaries=None, radius=None):
+        self.tree = cKDTree(locations)
+
+    def query(self, location, r):
+        return self.tree.query_ball_point(location, r)
+
+    def query_many(self, locations, r):
+        '''
+        The points within r of each of the locations.
+
+        Returns:
+            counts  - the number of points within r of each location
+            indices - the points, concatenated in the order of the locations
+                      and in ascending order for each location
+        '''
+        neighbours = self.tree.query_ball_point(locations, r)
+        counts = np.fromiter(map(len, neighbours), dtype=int, count=len(locations))
+        indices = np.fromiter(itertools.chain.from_iterable(neighbours), dtype=int, count=counts.sum())
+        return counts, indices
+
+
+class GridIndex:
+    '''
+    A neighbour index that sorts the points into a uniform grid of cells.
+
+    Description:
+        The cells are radius wide (see stationsim_numba.build_grid), so a
+        query for the points within r of a location only looks in the cells
+        that overlap the square of side 2r around it. Building the grid is
+        O(N) and a query is O(points in those cells), which beats a KD-tree
+        when the points are dense. When they are sparse the cells are made
+        larger, so that there are no more than a few cells for each point.
+
+        The points can be split into groups, such as the replicates of a
+        stationsim_batch.BatchModel, each with a grid of its own, so that a
+        query only finds the points of its own group.
+
+    Parameters:
+        locations  - (N, 2) array of the points to index
+        boundaries - [[x_min, y_min], [x_max, y_max]] of the station, the
+                     points outside it are put in the nearest cell
+        radius     - the radius that will usually be queried
+        groups     - the group (from 0) of each point, if they are grouped
+    '''
+    def __init__(self, locations, boundaries, radius, groups=None):
+        self.locations = np.asarray(locations, dtype=float).reshape(-1, 2)
+        self.origin = np.asarray(boundaries[0], dtype=float)
+        size = np.asarray(boundaries[1], dtype=float) - self.origin
+        n_groups = 1 if groups is None or not len(groups) else int(np.max(groups)) + 1
+        self.cell_size = float(max(radius, np.sqrt(size.prod() * n_groups / (4 * max(len(self.locations), 1))),
+                                   1e-9))
+        self.shape = np.floor(size / self.cell_size).astype(np.int64) + 1
+        if groups is None:
+            self.cell_start, self.order = stationsim_numba.build_grid(self.locations, self.origin, self.cell_size,
+                                                                      self.shape)
+        else:
+            # The cells of group g follow those of group g-1
+            cell = np.asarray(groups, dtype=np.int64) * self.shape.prod() + self._cell_ids(self.locations)
+            self.order = np.argsort(cell, kind='stable')
+            self.cell_start = np.concatenate([[0], np.cumsum(np.bincount(cell, minlength=n_groups *
+                                                                          self.shape.prod()))])
+
+    def _cells(self, locations):
+        return np.clip(np.floor((locations - self.origin) / self.cell_size).astype(np.int64), 0, self.shape - 1)
+
+    def _cell_ids(self, locations):
+        cells = self._cells(locations)
+        return cells[:, 0] * self.shape[1] + cells[:, 1]
+
+    def query(self, location, r):
+        return self.query_many(np.reshape(location, (1, 2)), r)[1].tolist()
+
+    def query_many(self, locations, r, groups=None):
+        '''
+        The points within r of each of the locations.
+
+        Parameters:
+            locations - (M, 2) array of locations
+            r         - the distance to find the points within
+            groups    - the group of each location, if the points are
+                        grouped, to only find the points of that group
+
+        Returns:
+            counts  - the number of points within r of each location
+            indices - the points, concatenated in the order of the locations
+                      and in ascending order for each location
+        '''
+        locations = np.asarray(locations, dtype=float).reshape(-1, 2)
+        lower, upper = self._cells(locations - r), self._cells(locations + r)
+        first = 0 if groups is None else np.asarray(groups, dtype=np.int64) * self.shape.prod()
+        span = int(np.ceil(2 * r / self.cell_size)) + 1
+        queries, points = [], []
+        for di, dj in itertools.product(range(span), repeat=2):
+            q = np.flatnonzero((lower[:, 0] + di <= upper[:, 0]) & (lower[:, 1] + dj <= upper[:, 1]))
+            cell = (lower[q, 0] + di) * self.shape[1] + lower[q, 1] + dj
+            if groups is not None:
+                cell = cell + first[q]
+            start, stop = self.cell_start[cell], self.cell_start[cell + 1]
+            queries.append(np.repeat(q, stop - start))
+            points.append(self.order[concatenated_ranges(start, stop)])
+        queries, points = np.concatenate(queries), np.concatenate(points)
+        dx = self.locations[points, 0] - locations[queries, 0]
+        dy = self.locations[points, 1] - locations[queries, 1]
+        within = dx * dx + dy * dy <= r * r
+        # Sort by location and then by point in one go
+        n = max(len(self.locations), 1)
+        key = np.sort(queries[within] * n + points[within])
+        return np.bincount(key // n, minlength=len(locations)), key % n
+
+
+def concatenated_ranges(starts, stops):
+    '''
+    np.concatenate([np.arange(a, b) for a, b in zip(starts, stops)]), vectorised.
+    '''
+    lengths = stops - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(lengths.sum())
+
+
+# The neighbour indexes by name, for the `neighbour_index` model parameter
+INDEXES = {'kdtree': KDTreeIndex, 'grid': GridIndex}
+
+
+def benchmark(populations=(30, 100, 300, 1000, 3000, 10000), width=400, height=200, radius=5, queries=4,
+              repeats=5):
+    '''
+    Time the indexes for a range of population densities.
+
+    Description:
+        'batched' builds an index and queries it once at `queries`
+        locations near each point, as stationsim_model.Model.step does.
+        'single' builds an index and queries it at one location, as the
+        GCS model does each time an agent is activated or wiggles.
+
+    Returns:
+        a list of (population, density, {(name, use): seconds}) tuples,
+        with the density in agents per radius x radius square
+    '''
+    import timeit
+    random = np.random.default_rng(0)
+    boundaries = np.array([[0, 0], [width, height]])
+    results = []
+    for population in populations:
+        locations = random.uniform(boundaries[0], boundaries[1], (population, 2))
+        targets = np.clip(np.repeat(locations, queries, axis=0)
+                          + random.normal(0, radius / 2, (population * queries, 2)), boundaries[0], boundaries[1])
+        times = {}
+        for name, index in INDEXES.items():
+            uses = {'batched': lambda: index(locations, boundaries, radius).query_many(targets, radius),
+                    'single': lambda: index(locations, boundaries, radius).query(targets[0], radius)}
+            for use, run in uses.items():
+                times[name, use] = min(timeit.repeat(run, number=1, repeat=repeats))
+        results.append((population, population * radius**2 / (width * height), times))
+    return results
+
+
+if __name__ == '__main__':
+    results = benchmark()
+    columns = list(results[0][2])
+    print(f"{'agents':>8} {'density':>8} " + ' '.join(f'{name:>9} {use:<7}' for name, use in columns))
+    for population, density, times in results:
+        print(f'{population:>8} {density:>8.3f} ' + ' '.join(f'{times[column]*1e3:>15.3f}ms' for column in columns))
@@ -14,15 +14,25 @@ Todo:
     speeds[-1] separation drawn
     set_pickle?
     get_pickle?
-    Look at model get_state and set_state - should comparisons be '==' or 'is'?
 '''
 
 import warnings
+import copy
+import math
 import numpy as np
 import os
-from scipy.spatial import cKDTree
 import matplotlib.pyplot as plt
 from matplotlib.animation import FuncAnimation
+try:
+    import stationsim_history
+    import stationsim_index
+    import stationsim_numba
+    from stationsim_agents import AgentArray, distances
+except ImportError:  # imported as part of the stationsim package
+    from . import stationsim_history
+    from . import stationsim_index
+    from . import stationsim_numba
+    from .stationsim_agents import AgentArray, distances
 # Dont automatically load seaborn as it isn't needed on the HPC
 try: 
     from seaborn import kdeplot as sns_kdeplot
@@ -34,46 +44,45 @@ class Agent:
     '''
     A class representing a generic agent for the StationSim ABM.
     '''
+    status = AgentArray('agents_status')  # 0 Not Started, 1 Active, 2 Finished
+    location = AgentArray('agents_location')
+    loc_start = AgentArray('agents_loc_start')
+    loc_desire = AgentArray('agents_loc_desire')
+    speed = AgentArray('agents_speed')
+    wiggle = AgentArray('agents_wiggle')
+    steps_activate = AgentArray('agents_steps_activate')
+    step_start = AgentArray('agents_step_start')
+    history_collisions = AgentArray('agents_collisions')
+    history_wiggles = AgentArray('agents_wiggles')
+
     def __init__(self, model, unique_id):
         '''
         Initialise a new agent.
 
         Desctiption:
-            Creates a new agent and gives it a randomly chosen entrance, exit,
-            and desired speed.
-            All agents start with active state 0 ('not started').
-            Their initial location (** (x,y) tuple-floats **) is set to the location
-            of the entrance that they are assigned to.
+            An agent is a view of row unique_id of the model's agent arrays.
+            Its entrance, exit and desired speed are drawn for all of the
+            agents at once by Model._init_agents.
 
         Parameters:
             model - a pointer to the StationSim model that is creating this agent
         '''
+        self.model = model
         self.unique_id = unique_id
-        # Required
-        self.status = 0  # 0 Not Started, 1 Active, 2 Finished
-        # Location
-        perturb = model.gates_space * np.random.uniform(-1, +1)
-        gate_in = np.random.randint(model.gates_in)
-        self.loc_start = model.gates_locations[gate_in] + [0, perturb]
-        gate_out = np.random.randint(model.gates_out) + model.gates_in
-        self.loc_desire = model.gates_locations[gate_out]
-        self.location = self.loc_start
-        # Speed
-        speed_max = 0
-        while speed_max <= model.speed_min:
-            speed_max = np.random.normal(model.speed_mean, model.speed_std)
-        self.speeds = np.arange(speed_max, model.speed_min, -model.speed_step)
-        self.speed = None
-        # Others
-        self.steps_activate = np.random.exponential(model.gates_speed)
-        self.wiggle = min(model.max_wiggle, speed_max)
-        # History
-        if model.do_history:
-            self.history_locations = []
-            self.history_speeds = []
-            self.history_wiggles = 0
-            self.history_collisions = 0
-            self.step_start = None
+
+    @property
+    def speeds(self):
+        '''
+        The speeds that the agent tries when moving, fastest first.
+        '''
+        return self.model.agents_speeds[self.unique_id, :self.model.agents_n_speeds[self.unique_id]]
+
+    @property
+    def history_locations(self):
+        '''
+        The agent's location at the end of each step, nan when it was not active.
+        '''
+        return self.model.history_locations[:, self.unique_id]
 
     def step(self, model):
         '''
@@ -88,7 +97,6 @@ class Agent:
         elif self.status == 1:
             self.move(model)
             self.deactivate(model)
-        self.history(model)
 
     def activate(self, model):
         '''
@@ -113,7 +121,7 @@ class Agent:
         '''
         x = loc1[0] - loc2[0]
         y = loc1[1] - loc2[1]
-        norm = (x*x + y*y)**.5
+        norm = math.sqrt(x*x + y*y)  # Correctly rounded, as np.sqrt is, see distances()
         return norm
 
     def move(self, model):
@@ -125,10 +133,10 @@ class Agent:
         without causing a colision with another agent.
         '''
         direction = (self.loc_desire - self.location) / self.distance(self.loc_desire, self.location)
-        for speed in self.speeds:
+        for speed_id, speed in enumerate(self.speeds):
             # Direct. Try to move forwards by gradually smaller and smaller amounts
             new_location = self.location + speed * direction
-            if self.collision(model, new_location):
+            if self.collision(model, new_location, speed_id):
                 if model.do_history:
                     self.history_collisions += 1
                     model.history_collision_locs.append(new_location)
@@ -138,7 +146,7 @@ class Agent:
                 break
             # If even the slowest speed results in a colision, then wiggle.
             if speed == self.speeds[-1]:
-                new_location = self.location + [0, self.wiggle*np.random.randint(-1, 1+1)]
+                new_location = self.location + [0, self.wiggle*model.random.integers(-1, 1+1)]
                 if model.do_history:
                     self.history_wiggles += 1
                     model.history_wiggle_locs.append(new_location)
@@ -149,35 +157,38 @@ class Agent:
         self.location = new_location
         self.speed = speed
 
-    def collision(self, model, new_location):
+    def collision(self, model, new_location, speed_id=None):
         '''
         Detects whether a move to the new_location will cause a collision
         (either with the model boundary or another agent).
         '''
         if not model.is_within_bounds(new_location):
             collide = True
-        elif self.neighbourhood(model, new_location):
+        elif self.neighbourhood(model, new_location, speed_id):
             collide = True
         else:
             collide = False
         return collide
 
-    def neighbourhood(self, model, new_location):
+    def neighbourhood(self, model, new_location, speed_id=None):
         '''
         This method finds whether or not nearby neighbours are a collision.
 
         :param model:        the model that this agent is part of
         :param new_location: the proposed new location that the agent will move to
                              (a standard (x,y) floats-tuple)
+        :param speed_id:     the index in self.speeds of the speed that gives new_location,
+                             if given the neighbours are looked up from the batched query
+                             made by Model.step (see Model.neighbours) rather than the neighbour index
         '''
-        neighbours = False
-        neighbouring_agents = model.tree.query_ball_point(new_location, model.separation)
-        for neighbouring_agent in neighbouring_agents:
-            agent = model.agents[neighbouring_agent]
-            if agent.status == 1 and self.unique_id != agent.unique_id and new_location[0] <= agent.location[0]:
-                neighbours = True
-                break
-        return neighbours
+        if speed_id is None:
+            neighbouring_agents = model.index_ids[model.index.query(new_location, model.separation)]
+        else:
+            neighbouring_agents = model.neighbours(self.unique_id, speed_id)
+        neighbours = np.any((model.agents_status[neighbouring_agents] == 1)
+                            & (neighbouring_agents != self.unique_id)
+                            & (new_location[0] <= model.agents_location[neighbouring_agents, 0]))
+        return bool(neighbours)
 
     def deactivate(self, model):
         '''
@@ -196,16 +207,6 @@ class Agent:
                 steps_delay = steps_taken - steps_exped
                 model.steps_delay.append(steps_delay)
 
-    def history(self, model):
-        '''
-        Save agent location.
-        '''
-        if model.do_history:
-            if self.status == 1:
-                self.history_locations.append(self.location)
-            else:
-                self.history_locations.append((None, None))
-
 
 class Model:
     '''
@@ -220,6 +221,9 @@ class Model:
         **kwargs    # check `params`, and `params_changed`
         do_history  # save memory
         do_print    # mute printing
+        backend     # 'agent' (default), 'numpy' or 'numba', see step()
+        neighbour_index  # 'kdtree' (default) or 'grid', see _build_index()
+        history_path  # keep the history on disk, see save_history()
 
     Returns:
         step_id
@@ -228,6 +232,7 @@ class Model:
 
         get_state()
         set_state()
+        run()
 
         get_analytics()
         get_trails()
@@ -267,8 +272,13 @@ class Model:
 
             'do_history': True,
             'do_print': True,
+            'history_path': None,  # directory to keep the history in, as memory-mapped files
+
+            'random_seed': int.from_bytes(os.urandom(4), byteorder='little'),
 
-            'random_seed': int.from_bytes(os.urandom(4), byteorder='little')
+            'backend': 'agent',  # 'agent' steps Agent objects one by one, 'numpy' steps the agent arrays at once,
+                                 # 'numba' steps the agent arrays with a compiled kernel
+            'neighbour_index': 'kdtree'  # how neighbours are found, 'kdtree' or 'grid' (see stationsim_index)
 
         }
         if len(kwargs) == 0:
@@ -278,8 +288,16 @@ class Model:
             )
         self.params, self.params_changed = Model._init_kwargs(params, kwargs)
         [setattr(self, key, value) for key, value in self.params.items()]
-        # Set the random seed
-        np.random.seed(self.random_seed)
+        if self.backend not in ('agent', 'numpy', 'numba'):
+            raise ValueError(f"Unknown backend '{self.backend}', expected 'agent', 'numpy' or 'numba'")
+        if self.neighbour_index not in stationsim_index.INDEXES:
+            raise ValueError(f"Unknown neighbour_index '{self.neighbour_index}', expected one of "
+                             f"{', '.join(stationsim_index.INDEXES)}")
+        if self.backend == 'numba' and not stationsim_numba.NUMBA:
+            warnings.warn("Numba is not installed, using the 'numpy' backend instead of 'numba'", RuntimeWarning)
+            self.backend = 'numpy'
+        # The model draws all of its random numbers from its own generator
+        self._init_random(self.random_seed)
         # Constants
         self.speed_step = (self.speed_mean - self.speed_min) / self.speed_steps
         self.boundaries = np.array([[0, 0], [self.width, self.height]])
@@ -291,18 +309,16 @@ class Model:
         self.pop_active = 0
         self.pop_finished = 0
         # Initialise
-        self.agents = [Agent(self, unique_id) for unique_id in range(self.pop_total)]
+        self._init_agent_arrays()
+        self._init_agents()
+        self._init_schedule()
+        self._agents = None
+        self._init_agent_speeds()
         # Following replaced with a normal function
         #self.is_within_bounds = lambda loc: all(self.boundaries[0] <= loc) and all(loc <= self.boundaries[1])
         #self.re_bound = lambda loc: np.clip(loc, self.boundaries[0], self.boundaries[1])
         if self.do_history:
-            self.history_state = []
-            self.history_wiggle_locs = []
-            self.history_collision_locs = []
-            self.history_collision_times = []
-            self.steps_taken = []
-            self.steps_exped = []
-            self.steps_delay = []
+            self._init_history()
             # Figure Shape Stuff
             self._wid = 8
             self._rel = self._wid / self.width
@@ -310,10 +326,189 @@ class Model:
             self._figsize = (self._wid, self._hei)
             self._dpi = 160
 
+    def _init_history(self):
+        # Locations of every agent at the start of each step
+        self.history_state = stationsim_history.history_array(self.history_path, 'history_state', (self.pop_total, 2))
+        # Locations of the active agents at the end of each step, nan for the others
+        self.history_locations = stationsim_history.history_array(self.history_path, 'history_locations',
+                                                                  (self.pop_total, 2))
+        self.history_wiggle_locs = stationsim_history.history_array(self.history_path, 'history_wiggle_locs', (2,))
+        self.history_collision_locs = stationsim_history.history_array(self.history_path, 'history_collision_locs',
+                                                                       (2,))
+        self.history_collision_times = stationsim_history.history_array(self.history_path, 'history_collision_times',
+                                                                        dtype=int)
+        self.steps_taken = []
+        self.steps_exped = []
+        self.steps_delay = []
+
     @staticmethod
     def _gates_init(x, y, n):
         return np.array([np.full(n, x), np.linspace(0, y, n+2)[1:-1]]).T
 
+    @property
+    def agents(self):
+        '''
+        The Agent objects, which view the agent arrays (a clone creates them when they are first used).
+        '''
+        if self._agents is None:
+            self._agents = [Agent(self, unique_id) for unique_id in range(self.pop_total)]
+        return self._agents
+
+    # Arrays with a row for each agent, see _init_agent_arrays and _init_agent_speeds
+    _agent_array_names = ('agents_status', 'agents_location', 'agents_loc_start', 'agents_loc_desire',
+                          'agents_speed_max', 'agents_speed', 'agents_wiggle', 'agents_steps_activate',
+                          'agents_step_start', 'agents_collisions', 'agents_wiggles', 'agents_speeds',
+                          'agents_n_speeds')
+
+    def clone(self, include_history=False):
+        '''
+        Copy the model, much faster than copy.deepcopy.
+
+        Description:
+            The agent arrays are copied. The other attributes are constants or
+            are replaced rather than changed in place (such as the neighbour index), so
+            the clone shares them. The clone makes its own Agent objects when
+            they are first used. The clone's generator starts in the same
+            state as this model's, so it draws the same random numbers (see
+            spawn for clones that do not).
+            With include_history the clone gets a copy of the history,
+            otherwise it starts an empty one. Either way the clone's history
+            is kept in memory, so it never writes to this model's history_path.
+            This is so for any model that has a history, including one made
+            with do_history=False that run() has recorded into.
+
+        Parameters:
+            include_history - whether to copy the history (if any)
+        '''
+        model = type(self).__new__(type(self))
+        model.__dict__.update(self.__dict__)
+        for name in self._agent_array_names:
+            setattr(model, name, getattr(self, name).copy())
+        model._init_schedule()
+        model.random = copy.deepcopy(self.random)
+        model._agents = None
+        if hasattr(self, 'history_state'):  # Not only if do_history, see run()
+            model.history_path = None
+            if include_history:
+                for name in self._history_names:
+                    setattr(model, name, copy.deepcopy(getattr(self, name)))
+                model.steps_taken, model.steps_exped, model.steps_delay =\
+                    list(self.steps_taken), list(self.steps_exped), list(self.steps_delay)
+            else:
+                model._init_history()
+        return model
+
+    def spawn(self, n, include_history=False):
+        '''
+        Make n clones of the model that draw independent random numbers.
+
+        Description:
+            Each clone is given a generator seeded with a child of this model's
+            SeedSequence (see SeedSequence.spawn), such as for the particles of
+            a particle filter. The clones are reproducible from random_seed,
+            and do not share any random state with each other or this model.
+
+        Parameters:
+            n               - the number of clones
+            include_history - whether to copy the history (if do_history)
+        '''
+        models = [self.clone(include_history) for _ in range(n)]
+        for model, seed_sequence in zip(models, self.seed_sequence.spawn(n)):
+            model._init_random(seed_sequence)
+        return models
+
+    def _init_random(self, seed):
+        '''
+        Seed the model's generator, self.random, from an int, None (fresh entropy) or a SeedSequence.
+        '''
+        self.seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.random = np.random.default_rng(self.seed_sequence)
+
+    def copy_state_from(self, other):
+        '''
+        Copy the state of another model into this one, in place.
+
+        Description:
+            Copies the agent arrays and the step and population counts of
+            `other`, which must have the same parameters (a clone, say), into
+            the arrays this model already has. The history and the generator
+            are left alone, so the two models go on to draw different random
+            numbers.
+        '''
+        for name in self._agent_array_names:
+            getattr(self, name)[...] = getattr(other, name)
+        self.step_id = other.step_id
+        self.pop_active = other.pop_active
+        self.pop_finished = other.pop_finished
+        self.status = other.status
+        self._init_schedule()
+
+    def _init_agent_arrays(self):
+        '''
+        Allocate the arrays that hold the state of every agent.
+
+        Description:
+            Row i of each array belongs to the agent with unique_id i. The
+            Agent objects read and write their attributes through these
+            arrays (see AgentArray), so the 'agent' and 'numpy' backends
+            share the same state.
+        '''
+        n = self.pop_total
+        self.agents_status = np.zeros(n, dtype=int)
+        self.agents_location = np.zeros((n, 2))
+        self.agents_loc_start = np.zeros((n, 2))
+        self.agents_loc_desire = np.zeros((n, 2))
+        self.agents_speed_max = np.zeros(n)
+        self.agents_speed = np.full(n, np.nan)  # nan until the agent first moves
+        self.agents_wiggle = np.zeros(n)
+        self.agents_steps_activate = np.zeros(n)
+        self.agents_step_start = np.full(n, -1)  # -1 until the agent is activated
+        self.agents_collisions = np.zeros(n, dtype=int)
+        self.agents_wiggles = np.zeros(n, dtype=int)
+
+    def _init_agents(self):
+        '''
+        Draw the entrance, exit, desired speed and activation time of every agent.
+
+        Description:
+            Each quantity is drawn for all of the agents at once from the
+            model's generator. Every agent is given a randomly chosen entrance
+            (perturbed along the gate by up to gates_space), exit, and maximum
+            speed from a normal distribution truncated below at speed_min.
+            All agents start with status 0 ('not started') at their entrance.
+        '''
+        n = self.pop_total
+        perturb = self.gates_space * self.random.uniform(-1, +1, size=n)
+        gate_in = self.random.integers(self.gates_in, size=n)
+        gate_out = self.random.integers(self.gates_out, size=n) + self.gates_in
+        self.agents_loc_start[:] = self.gates_locations[gate_in]
+        self.agents_loc_start[:, 1] += perturb
+        self.agents_loc_desire[:] = self.gates_locations[gate_out]
+        self.agents_location[:] = self.agents_loc_start
+        # Redraw the speeds that are too slow until there are none
+        speed_max = self.agents_speed_max
+        redraw = np.arange(n)
+        while redraw.size:
+            speed_max[redraw] = self.random.normal(self.speed_mean, self.speed_std, size=redraw.size)
+            redraw = redraw[speed_max[redraw] <= self.speed_min]
+        self.agents_steps_activate[:] = self.random.exponential(self.gates_speed, size=n)
+        self.agents_wiggle[:] = np.minimum(self.max_wiggle, speed_max)
+
+    def _init_agent_speeds(self):
+        '''
+        Tabulate the speeds that each agent tries when moving.
+
+        Description:
+            Row i holds np.arange(speed_max, speed_min, -speed_step) for agent
+            i, padded with nan to the length of the longest row. The number of
+            valid speeds in each row is kept in agents_n_speeds.
+        '''
+        speeds = [np.arange(speed_max, self.speed_min, -self.speed_step) for speed_max in self.agents_speed_max]
+        self.agents_n_speeds = np.array([len(s) for s in speeds], dtype=int)
+        self.agents_speeds = np.full((self.pop_total, max(self.agents_n_speeds, default=0)), np.nan)
+        for unique_id, s in enumerate(speeds):
+            self.agents_speeds[unique_id, :len(s)] = s
+
     def is_within_bounds(self, loc):
         return all(self.boundaries[0] <= loc) and all(loc <= self.boundaries[1])
 
@@ -342,53 +537,617 @@ class Model:
     def step(self):
         '''
         Iterate model forward one step.
+
+        With the 'agent' backend each Agent object is stepped in turn. The
+        'numpy' backend steps all of the agents at once on the agent arrays
+        and gives the same result for the same random seed. The 'numba'
+        backend steps each agent in turn on the agent arrays, in a compiled
+        kernel (see stationsim_numba).
         '''
         if self.pop_finished < self.pop_total and self.step_id < self.step_limit and self.status==1:
             if self.do_print and self.step_id%100==0:
                 print(f'\tIteration: {self.step_id}/{self.step_limit}')
-            state = self.get_state('location2D')
-            self.tree = cKDTree(state)
-            [agent.step(self) for agent in self.agents]
-            if self.do_history:
-                self.history_state.append(state)
+            self._step_backend()
             self.step_id += 1
+            if self.do_history and self.history_path is not None and\
+                    (self.pop_finished == self.pop_total or self.step_id == self.step_limit):
+                self.save_history()
         else:
             if self.do_print and self.status==1:
                 print(f'StationSim {self.unique_id} - Everyone made it!')
                 self.status = 0
 
+    def _step_backend(self):
+        '''
+        Step the agents with the backend, without the checks and the printing of step().
+        '''
+        if self.backend == 'numpy':
+            self._step_numpy()
+        elif self.backend == 'numba':
+            self._step_numba()
+        else:
+            self._step_agents()
+
+    def _step_agents(self):
+        '''
+        Step each Agent object in turn ('agent' backend).
+        '''
+        state = self.get_state('location2D')
+        due = self._due_ids()
+        self._build_index(state, due)
+        self._batch_neighbours(state)
+        agents = self.agents
+        [agents[unique_id].step(self) for unique_id in self.index_ids.tolist()]
+        self._update_active(due)
+        if self.do_history:
+            self._history_states(state)
+
+    # What run() can record, see run()
+    _run_records = ('analytics', 'collisions', 'wiggles', 'counts', 'states')
+
+    def run(self, until=None, record=('analytics',), bins=10):
+        '''
+        Run the model until everyone has left (or step_limit), or until step `until`, in one loop.
+
+        Description:
+            Calling step() in a loop checks whether to print and to save the
+            history at every step. run() steps the backend directly and only
+            records what is asked for. The locations of every agent at every
+            step (history_state and history_locations), which take most of the
+            time and memory of the history, are only kept if 'states' is
+            asked for, or if the model was made with do_history (so that its
+            history has a frame for every step, as get_ani and get_trails
+            expect). The collisions, wiggles and finishing times are kept
+            if anything is asked for, in the model's history arrays, even if
+            the model was made with do_history=False (and nothing is kept if
+            record is empty).
+            The model is stepped exactly as step() would step it, and when
+            everyone has left, or step_limit is reached, its status is set
+            to 0. A model can be run on from where it stopped, and be stepped
+            after it has been run.
+
+        Parameters:
+            until  - the step_id to stop at, step_limit by default
+            record - the outputs to return, any of:
+                     'analytics'  - get_analytics() at the end
+                     'collisions' - (n, 2) array of the locations of the collisions
+                     'wiggles'    - (n, 2) array of the locations of the wiggles
+                     'counts'     - the number of collisions in each area of the
+                                    station, see np.histogram2d
+                     'states'     - (steps, pop_total, 2) array of the locations
+                                    of every agent at the start of each step
+            bins   - the areas of 'counts', as the bins of np.histogram2d
+
+        Returns:
+            a dictionary of the outputs in record
+        '''
+        record = tuple(record)
+        for name in record:
+            if name not in self._run_records:
+                raise ValueError(f"Unknown record '{name}', expected any of {', '.join(self._run_records)}")
+        until = self.step_limit if until is None else min(until, self.step_limit)
+        do_history = self.do_history
+        self.do_history = bool(record)
+        if self.do_history and not hasattr(self, 'history_state'):
+            self._init_history()
+        record_states = self._record_states
+        self._record_states = do_history and record_states or 'states' in record
+        states_start = len(self.history_state) if self._record_states else 0
+        try:
+            step = self._step_backend
+            while self.pop_finished < self.pop_total and self.step_id < until and self.status == 1:
+                step()
+                self.step_id += 1
+        finally:
+            self.do_history = do_history
+            self._record_states = record_states
+        if self.pop_finished == self.pop_total or self.step_id == self.step_limit:
+            self.status = 0
+            if self.do_history and self.history_path is not None:
+                self.save_history()
+        outputs = {}
+        for name in record:
+            if name == 'analytics':
+                outputs[name] = self.get_analytics()
+            elif name == 'collisions':
+                outputs[name] = np.array(self.history_collision_locs).reshape(-1, 2)
+            elif name == 'wiggles':
+                outputs[name] = np.array(self.history_wiggle_locs).reshape(-1, 2)
+            elif name == 'counts':
+                collisions = np.array(self.history_collision_locs).reshape(-1, 2)
+                outputs[name] = np.histogram2d(collisions[:, 0], collisions[:, 1], bins=bins,
+                                               range=[[0, self.width], [0, self.height]])[0]
+            elif name == 'states':
+                outputs[name] = np.array(self.history_state[states_start:]).reshape(-1, self.pop_total, 2)
+        return outputs
+
+    def _init_schedule(self):
+        '''
+        Sort the agents that have not started by activation time, and list the active agents.
+
+        Description:
+            Agents are activated in the order of steps_activate, so the
+            schedule holds the unique_ids of the agents with status 0 in that
+            order, and schedule_next is the first of them that has not been
+            activated. active_ids holds the unique_ids of the active agents in
+            ascending order. A step only looks at the agents in active_ids and
+            those that are due (see _due_ids), rather than at every agent.
+            Both are made again from agents_status whenever the statuses are
+            set from outside a step (set_state, copy_state_from and so on).
+        '''
+        pending = np.flatnonzero(self.agents_status == 0)
+        self.schedule = pending[np.argsort(self.agents_steps_activate[pending], kind='stable')]
+        self.schedule_times = self.agents_steps_activate[self.schedule]
+        self.schedule_next = 0
+        self.active_ids = np.flatnonzero(self.agents_status == 1)
+
+    def _due_ids(self):
+        '''
+        The unique_ids of the agents that are activated in this step, in ascending order.
+
+        Description:
+            These are the agents in the schedule whose steps_activate is below
+            step_id, and they are taken out of it.
+        '''
+        end = int(np.searchsorted(self.schedule_times, self.step_id, side='left'))
+        due = self.schedule[self.schedule_next:end]
+        self.schedule_next = max(end, self.schedule_next)
+        return np.sort(due[self.agents_status[due] == 0])
+
+    def _update_active(self, due):
+        '''
+        Add the agents that were activated in this step to active_ids, and drop those that have finished.
+        '''
+        active = np.union1d(self.active_ids, due)
+        self.active_ids = active[self.agents_status[active] == 1]
+
+    def _build_index(self, state, due):
+        '''
+        Build the neighbour index of the agents that can be a neighbour in this step.
+
+        Description:
+            The index is the neighbour_index parameter, one of
+            stationsim_index.INDEXES ('kdtree' or 'grid'). Only active agents
+            can cause a collision. These are the agents that are active at the
+            start of the step and those that are activated during it, so the
+            agents that have not started or have finished are left out of the
+            index. Point i of the index is the agent with unique_id index_ids[i].
+        '''
+        self.index_ids = self._neighbour_ids(due)
+        self.index = stationsim_index.INDEXES[self.neighbour_index](state[self.index_ids], self.boundaries,
+                                                                    self.separation)
+
+    def _neighbour_ids(self, due):
+        '''
+        The unique_ids of the agents that are active or are activated in this step (due), in ascending order.
+        '''
+        return np.union1d(self.active_ids, due)
+
+    def _batch_neighbours(self, state):
+        '''
+        Find the neighbours of every location that an active agent may try this step.
+
+        Description:
+            An agent tries the locations location + speed * direction for each
+            of its speeds, and all of them are known at the start of the step.
+            Rather than querying the neighbour index once for each of these in
+            Agent.neighbourhood, they are queried together here and looked up
+            with neighbours(). Locations outside the station are not queried
+            because they collide with the boundary first.
+        '''
+        movers = self.active_ids
+        candidates, inside = self._candidates(movers, state[movers])
+        counts = np.zeros(inside.size, dtype=int)
+        counts[inside.ravel()], self._neighbours = self._query_neighbours(candidates[inside])
+        self._neighbours_start = np.concatenate([[0], np.cumsum(counts)])
+        self._neighbours_row = np.full(self.pop_total, -1)
+        self._neighbours_row[movers] = np.arange(movers.size) * inside.shape[1]
+
+    def neighbours(self, unique_id, speed_id):
+        '''
+        The agents within `separation` of the location that agent `unique_id`
+        tries with its speed `speed_id` in this step (see _batch_neighbours).
+        '''
+        i = self._neighbours_row[unique_id] + speed_id
+        return self._neighbours[self._neighbours_start[i]:self._neighbours_start[i+1]]
+
+    def _candidates(self, movers, location):
+        '''
+        The locations that the movers try, as in Agent.move.
+
+        Returns:
+            candidates - (movers, speeds, 2) array of location + speed * direction
+                         for each of the speeds of each mover, fastest first
+            inside     - mask of the candidates that are a speed of their mover
+                         and are within the station
+        '''
+        speeds = self.agents_speeds[movers]
+        valid = np.arange(speeds.shape[1]) < self.agents_n_speeds[movers, None]
+        loc_desire = self.agents_loc_desire[movers]
+        direction = (loc_desire - location) / distances(loc_desire[:, 0] - location[:, 0],
+                                                        loc_desire[:, 1] - location[:, 1])[:, None]
+        candidates = location[:, None, :] + speeds[:, :, None] * direction[:, None, :]
+        inside = valid & np.all((self.boundaries[0] <= candidates) & (candidates <= self.boundaries[1]), axis=2)
+        return candidates, inside
+
+    def _query_neighbours(self, locations, owners=None):
+        '''
+        Query the neighbour index for the agents within `separation` of each location at once.
+
+        Parameters:
+            locations - (M, 2) array of locations
+            owners    - the unique_id of the agent that tries each location,
+                        which only matters to stationsim_batch.BatchModel
+
+        Returns:
+            counts     - the number of neighbours of each location
+            neighbours - the unique_ids of the neighbours, concatenated in the
+                         order of the locations
+        '''
+        counts, neighbours = self.index.query_many(locations, self.separation)
+        return counts, self.index_ids[neighbours]
+
+    def _step_numpy(self):
+        '''
+        Iterate every agent at once using the agent arrays ('numpy' backend).
+
+        Description:
+            Gives the same result as calling Agent.step on each agent in
+            unique_id order (the 'agent' backend). Agents that are due are
+            activated, and active agents are moved towards their exit in
+            vectorised batches (see _move_numpy), then leave the model if
+            they have arrived.
+        '''
+        status = self.agents_status.copy()
+        state = self.agents_location.copy()
+        due = self._due_ids()
+        self._build_index(state, due)
+        movers = self.active_ids
+        if movers.size:
+            activate = np.zeros(self.agents_status.size, dtype=bool)
+            activate[due] = True
+            self._move_numpy(movers, status, state, activate)
+        self.agents_status[due] = 1
+        self.agents_step_start[due] = self.step_id
+        self.pop_active += due.size
+        self._update_active(due)
+        if self.do_history:
+            self._history_states(state)
+
+    def _move_numpy(self, movers, status, state, activate):
+        '''
+        Move, wiggle and deactivate all of the active agents.
+
+        Description:
+            In the 'agent' backend each agent tries its speeds in turn and
+            takes the fastest one that is inside the station and not blocked.
+            A location is blocked by an active agent (found with the neighbour index
+            built at the start of the step) that is further along in x. The
+            status and x of agents with a lower unique_id are taken after
+            they have moved, those of agents with a higher unique_id before
+            they move.
+            Most of these checks do not depend on how the lower-id agents
+            move: a neighbour blocks a location that is behind every place it
+            can move to, and never blocks one that is ahead of all of them.
+            The remaining checks are resolved in waves, each wave deciding in
+            one batch every mover whose lower-id neighbours have moved.
+            A mover that cannot move wiggles, and the y direction of the
+            wiggle is drawn in unique_id order. A wiggle only changes y, so
+            wigglers are resolved before their draw is known unless the draw
+            decides whether they reach their exit; in that case they wait
+            until every mover with a lower unique_id has been decided.
+
+        Parameters:
+            movers   - unique_ids of the active agents, in ascending order
+            status   - agents_status at the start of the step
+            state    - agents_location at the start of the step
+            activate - mask of the agents that are activated in this step
+        '''
+        n = movers.size
+        # Candidate locations, one row per mover with its fastest speed first
+        speeds = self.agents_speeds[movers]
+        n_speeds = self.agents_n_speeds[movers]
+        valid = np.arange(speeds.shape[1]) < n_speeds[:, None]
+        location = state[movers]
+        loc_desire = self.agents_loc_desire[movers]
+        wiggle = self.agents_wiggle[movers]
+        candidates, inside = self._candidates(movers, location)
+        candidates = candidates.reshape(-1, 2)
+        # Every x that a mover can end the step at, and whether it can leave
+        x_wiggle = np.clip(location[:, 0], *self.boundaries[:, 0])
+        x_inside = candidates[:, 0].reshape(inside.shape)
+        x_min = np.minimum(np.where(inside, x_inside, np.inf).min(axis=1), x_wiggle)
+        x_max = np.maximum(np.where(inside, x_inside, -np.inf).max(axis=1), x_wiggle)
+        reach = np.minimum(np.hypot(*(loc_desire - location).T) - speeds[:, 0],
+                           np.hypot(*(loc_desire - self.re_bound(location)).T) - wiggle)
+        can_leave = reach < self.gates_space + 1e-6 * (1 + np.abs(reach))
+        row = np.full(self.agents_status.size, -1)
+        row[movers] = np.arange(n)
+        # Pairs of (candidate, neighbouring agent), excluding the mover itself
+        pair_cand = np.flatnonzero(inside)
+        counts, pair_agent = self._query_neighbours(candidates[pair_cand], movers[pair_cand // speeds.shape[1]])
+        pair_cand = np.repeat(pair_cand, counts)
+        pair_owner = movers[pair_cand // speeds.shape[1]]
+        pair_x = candidates[pair_cand, 0]
+        pair_lower = pair_agent < pair_owner
+        # Neighbours whose status and x are known now
+        seen_status = np.where(pair_lower & activate[pair_agent], 1, status[pair_agent])
+        blocked = np.zeros(inside.size, dtype=bool)
+        blocked[pair_cand[(seen_status == 1) & (pair_x <= state[pair_agent, 0]) & (pair_agent != pair_owner)
+                          & ~(pair_lower & (status[pair_agent] == 1))]] = True
+        # Lower-id movers
+        mover = pair_lower & (status[pair_agent] == 1)
+        pair_cand, pair_agent, pair_x = pair_cand[mover], pair_agent[mover], pair_x[mover]
+        always = (pair_x <= x_min[row[pair_agent]]) & ~can_leave[row[pair_agent]]
+        blocked[pair_cand[always]] = True
+        depends = ~always & (pair_x <= x_max[row[pair_agent]])
+        pair_cand, pair_agent, pair_x = pair_cand[depends], pair_agent[depends], pair_x[depends]
+        pair_row = pair_cand // speeds.shape[1]
+        # A mover waits until the lower movers in its pairs are resolved
+        waiting = np.bincount(pair_row, minlength=n)
+        row_start = np.searchsorted(pair_row, np.arange(n + 1))
+        by_lower = np.argsort(row[pair_agent], kind='stable')
+        lower_start = np.searchsorted(row[pair_agent][by_lower], np.arange(n + 1))
+        # Status and x of the movers after they move
+        status_end = status.copy()
+        x_end = state[:, 0].copy()
+        resolved = np.zeros(n, dtype=bool)
+        # Outcome of each mover: the index of its speed, or -1 to wiggle
+        choice = np.zeros(n, dtype=int)
+        decided = np.zeros(n, dtype=bool)
+        ambiguous = np.zeros(n, dtype=bool)
+        while not resolved.all():
+            done = []
+            rows = np.flatnonzero(~decided & (waiting == 0))
+            if rows.size:
+                sel = stationsim_index.concatenated_ranges(row_start[rows], row_start[rows + 1])
+                agent = pair_agent[sel]
+                hit = (status_end[agent] == 1) & (pair_x[sel] <= x_end[agent])
+                blocked[pair_cand[sel][hit]] = True
+                free = inside[rows] & ~blocked.reshape(inside.shape)[rows]
+                moved = free.any(axis=1)
+                choice[rows] = np.where(moved, free.argmax(axis=1), -1)
+                decided[rows] = True
+                # Movers: the new location decides whether they leave
+                rows_moved = rows[moved]
+                new_location = candidates[rows_moved * speeds.shape[1] + choice[rows_moved]]
+                x_end[movers[rows_moved]] = new_location[:, 0]
+                status_end[movers[rows_moved]] = np.where(self._arrived(new_location, loc_desire[rows_moved]), 2, 1)
+                done.append(rows_moved)
+                # Wigglers: resolved now unless the draw decides whether they leave
+                rows_wiggled = rows[~moved]
+                x_end[movers[rows_wiggled]] = x_wiggle[rows_wiggled]
+                done.append(rows_wiggled[~can_leave[rows_wiggled]])
+                rows_wiggled = rows_wiggled[can_leave[rows_wiggled]]
+                if rows_wiggled.size:
+                    arrived = np.array([self._arrived(self._wiggled(location[rows_wiggled], wiggle[rows_wiggled], draw),
+                                                      loc_desire[rows_wiggled]) for draw in (-1, 0, 1)])
+                    certain = arrived.all(axis=0) | ~arrived.any(axis=0)
+                    status_end[movers[rows_wiggled[certain]]] = np.where(arrived[0, certain], 2, 1)
+                    done.append(rows_wiggled[certain])
+                    ambiguous[rows_wiggled[~certain]] = True
+            # Draw-dependent wigglers, once every lower mover has been decided
+            lowest_undecided = decided.argmin() if not decided.all() else n
+            rows = np.flatnonzero(ambiguous[:lowest_undecided])
+            if rows.size:
+                wiggled = choice[:lowest_undecided] == -1
+                draws = self._draw_wiggles(movers[:lowest_undecided], wiggled, peek=True)
+                rank = np.cumsum(wiggled)[rows] - 1
+                new_location = self._wiggled(location[rows], wiggle[rows], draws[rank])
+                status_end[movers[rows]] = np.where(self._arrived(new_location, loc_desire[rows]), 2, 1)
+                ambiguous[rows] = False
+                done.append(rows)
+            done = np.concatenate(done)
+            resolved[done] = True
+            sel = by_lower[stationsim_index.concatenated_ranges(lower_start[done], lower_start[done + 1])]
+            waiting -= np.bincount(pair_row[sel], minlength=n)
+        # Wiggle directions are drawn in unique_id order, as in Agent.move
+        wiggled = choice == -1
+        draw = self._draw_wiggles(movers, wiggled)
+        speed_id = np.where(wiggled, n_speeds - 1, choice)
+        new_location = candidates[np.arange(n) * speeds.shape[1] + speed_id]
+        wiggle_location = location[wiggled] + np.column_stack([np.zeros(draw.size), wiggle[wiggled] * draw])
+        new_location[wiggled] = np.clip(wiggle_location, self.boundaries[0], self.boundaries[1])
+        arrived = self._arrived(new_location, loc_desire)
+        self.agents_location[movers] = new_location
+        self.agents_speed[movers] = speeds[np.arange(n), speed_id]
+        self.agents_status[movers[arrived]] = 2
+        self.pop_active -= int(np.count_nonzero(arrived))
+        self.pop_finished += int(np.count_nonzero(arrived))
+        if self.do_history:
+            n_collisions = np.where(wiggled, n_speeds, choice)
+            collided = valid & (np.arange(speeds.shape[1]) < n_collisions[:, None])
+            self.history_collision_locs.extend(candidates[collided.ravel()])
+            self.history_collision_times.extend([self.step_id] * np.count_nonzero(collided))
+            self.history_wiggle_locs.extend(wiggle_location)
+            self.agents_collisions[movers] += n_collisions
+            self.agents_wiggles[movers[wiggled]] += 1
+            self._history_finished(movers[arrived])
+
+    def _draw_wiggles(self, movers, wiggled, peek=False):
+        '''
+        Draw the y direction (-1, 0 or +1) of the wiggle of each mover that wiggles, in unique_id order.
+
+        Parameters:
+            movers  - unique_ids of the movers, in ascending order
+            wiggled - mask of the movers that wiggle
+            peek    - leave the generator as it was, to look at the draws of
+                      the first wigglers before the later movers are decided
+
+        Returns:
+            the draws of the movers that wiggle, in the order of movers
+        '''
+        random_state = self.random.bit_generator.state
+        draws = self.random.integers(-1, 1+1, size=np.count_nonzero(wiggled))
+        if peek:
+            self.random.bit_generator.state = random_state
+        return draws
+
+    def _step_numba(self):
+        '''
+        Iterate every agent in turn in a compiled kernel ('numba' backend).
+
+        Description:
+            stationsim_numba.step_agents does what Agent.step does for each
+            agent, on the agent arrays. It always finds the neighbours with a
+            stationsim_index.GridIndex of the agents that can be a neighbour in
+            this step (as in _build_index), whatever the neighbour_index. The
+            wiggle directions are drawn up front, one for each active agent,
+            and the generator is then left as if only the draws that were used
+            had been made.
+        '''
+        state = self.agents_location.copy()
+        due = self._due_ids()
+        grid_ids = self._neighbour_ids(due)
+        grid = stationsim_index.GridIndex(state[grid_ids], self.boundaries, self.separation)
+        movers = self.active_ids.size
+        random_state = self.random.bit_generator.state
+        draws = self.random.integers(-1, 1+1, size=movers)
+        collision_locs = np.empty((self.agents_n_speeds.sum() if self.do_history else 0, 2))
+        wiggle_locs = np.empty((movers if self.do_history else 0, 2))
+        finished = np.empty(movers, dtype=int)
+        n_activated, n_collisions, n_wiggles, n_finished = stationsim_numba.step_agents(
+            self.step_id, self.agents_status, self.agents_location, self.agents_loc_desire, self.agents_speeds,
+            self.agents_n_speeds, self.agents_speed, self.agents_wiggle, self.agents_steps_activate,
+            self.agents_step_start, self.agents_collisions, self.agents_wiggles, self.boundaries,
+            float(self.separation), float(self.gates_space), grid.locations, grid_ids, grid.origin, grid.cell_size,
+            grid.shape, grid.cell_start, grid.order, draws, self.do_history, collision_locs, wiggle_locs, finished)
+        self.random.bit_generator.state = random_state
+        self.random.integers(-1, 1+1, size=n_wiggles)
+        self.pop_active += n_activated - n_finished
+        self._update_active(due)
+        self.pop_finished += n_finished
+        if self.do_history:
+            self._history_states(state)
+            self.history_collision_locs.extend(collision_locs[:n_collisions])
+            self.history_collision_times.extend([self.step_id] * n_collisions)
+            self.history_wiggle_locs.extend(wiggle_locs[:n_wiggles])
+            self._history_finished(finished[:n_finished])
+
+    def _history_finished(self, finished):
+        '''
+        Save how long the agents that have just finished took, as in Agent.deactivate.
+        '''
+        loc_start = self.agents_loc_start[finished]
+        loc_desire = self.agents_loc_desire[finished]
+        distance = distances(loc_start[:, 0] - loc_desire[:, 0], loc_start[:, 1] - loc_desire[:, 1])
+        steps_exped = (distance - self.gates_space) / self.agents_speeds[finished, 0]
+        steps_taken = self.step_id - self.agents_step_start[finished]
+        self.steps_exped.extend(steps_exped)
+        self.steps_taken.extend(steps_taken)
+        self.steps_delay.extend(steps_taken - steps_exped)
+
+    # Whether each step saves the locations of the agents, see run()
+    _record_states = True
+
+    def _history_states(self, state):
+        '''
+        Save the locations of the agents at the start (state) and at the end of the step.
+        '''
+        if self._record_states:
+            self.history_state.append(state)
+            self._history_locations()
+
+    def _history_locations(self):
+        '''
+        Save the locations of the active agents at the end of the step.
+        '''
+        self.history_locations.append(np.where((self.agents_status == 1)[:, None], self.agents_location, np.nan))
+
+    def _wiggled(self, location, wiggle, draw):
+        '''
+        Locations after a wiggle of `draw` (-1, 0 or +1) times `wiggle` in y.
+        '''
+        return np.clip(location + np.column_stack([np.zeros(len(location)), wiggle * draw]),
+                       self.boundaries[0], self.boundaries[1])
+
+    def _arrived(self, location, loc_desire):
+        '''
+        Whether agents at `location` are close enough to their exit to leave.
+        '''
+        return distances(location[:, 0] - loc_desire[:, 0], location[:, 1] - loc_desire[:, 1]) < self.gates_space
+
+    # History
+    _history_names = ('history_state', 'history_locations', 'history_wiggle_locs', 'history_collision_locs',
+                      'history_collision_times')
+
+    def save_history(self):
+        '''
+        Save the history to history_path so that it can be reopened with load_history().
+
+        Description:
+            The history arrays are already in memory-mapped files. This flushes
+            them and saves the rest of what the analytics and figures need.
+            It is called at the end of the run, and can be called at any time
+            to save a run that is stopped early.
+        '''
+        stationsim_history.save_history(
+            self.history_path, {name: getattr(self, name) for name in self._history_names},
+            params=self.params, seed_entropy=self.seed_sequence.entropy,
+            seed_spawn_key=self.seed_sequence.spawn_key, step_id=self.step_id, pop_active=self.pop_active, pop_finished=self.pop_finished,
+            agents_status=self.agents_status, agents_collisions=self.agents_collisions,
+            agents_wiggles=self.agents_wiggles, steps_taken=self.steps_taken, steps_exped=self.steps_exped,
+            steps_delay=self.steps_delay)
+
+    @classmethod
+    def load_history(cls, history_path):
+        '''
+        Reopen the history of a model that was run with a history_path.
+
+        Description:
+            Recreates the model from its saved parameters and seed, without
+            running it, and attaches the saved history (read-only), so that the
+            analytics and figures can be made again.
+        '''
+        index = stationsim_history.load_history(history_path)
+        seed_sequence = np.random.SeedSequence(index['seed_entropy'], spawn_key=tuple(index['seed_spawn_key']))
+        model = cls(**dict(index['params'], random_seed=seed_sequence, history_path=None, do_history=True))
+        model.history_path = history_path
+        for name, array in index['arrays'].items():
+            setattr(model, name, array)
+        model.step_id, model.pop_active, model.pop_finished = index['step_id'], index['pop_active'], index['pop_finished']
+        model.agents_status[:] = index['agents_status']
+        model._init_schedule()
+        model.agents_collisions[:] = index['agents_collisions']
+        model.agents_wiggles[:] = index['agents_wiggles']
+        model.steps_taken, model.steps_exped, model.steps_delay = index['steps_taken'], index['steps_exped'], index['steps_delay']
+        return model
+
     # State
     def get_state(self, sensor=None):
         '''
-        Convert list of agents in model to state vector.
+        Convert the agent arrays to a state vector.
+
+        The locations are copied out of agents_location, so changing the
+        state does not change the model.
         '''
         if sensor is None:
-            state = [(agent.status, *agent.location, agent.speed) for agent in self.agents]
-            state = np.append(self.step_id, np.ravel(state))
-        elif sensor is 'location':
-            state = [agent.location for agent in self.agents]
-            state = np.ravel(state)
-        elif sensor is 'location2D':
-            state = [agent.location for agent in self.agents]
+            state = np.column_stack((self.agents_status, self.agents_location, self.agents_speed))
+            state = np.append(self.step_id, state)
+        elif sensor == 'location':
+            state = self.agents_location.flatten()
+        elif sensor == 'location2D':
+            state = self.agents_location.copy()
         return state
 
     def set_state(self, state, sensor=None):
         '''
         Use state vector to set agent locations.
+
+        The state is copied into agents_location in one assignment. Only
+        the full state (sensor None) sets the statuses, so only then is
+        the schedule made again (see _init_schedule).
         '''
         if sensor is None:
             self.step_id = int(state[0])
             state = np.reshape(state[1:], (self.pop_total, 3))
-            for i, agent in enumerate(self.agents):
-                agent.status = int(state[i, 0])
-                agent.location = state[i, 1:]
-        elif sensor is 'location':
-            state = np.reshape(state, (self.pop_total, 2))
-            for i, agent in enumerate(self.agents):
-                agent.location = state[i, :]
-        elif sensor is 'location2D':
-            for i, agent in enumerate(self.agents):
-                agent.location = state[i, :]
+            self.agents_status[:] = state[:, 0]
+            self.agents_location[:] = state[:, 1:]
+            self._init_schedule()
+        elif sensor == 'location':
+            self.agents_location[:] = np.reshape(state, (self.pop_total, 2))
+        elif sensor == 'location2D':
+            self.agents_location[:] = state
 
     # TODO: Deprecated, update PF
     def agents2state(self, do_ravel=True):
@@ -452,7 +1211,7 @@ class Model:
             else:
                 alpha = 1
                 colour = colours[2]
-            locs = np.array(agent.history_locations).T
+            locs = agent.history_locations.T
             plt.plot(*locs, color=colour, alpha=alpha, linewidth=.5)
         if xlim != None: # Optionally set the x limits
             plt.xlim(xlim)
@@ -512,12 +1271,8 @@ class Model:
         :param title: (optional) title for the plot
         :return:
         """
-        history_locs = []
-        for agent in self.agents:
-            for loc in agent.history_locations:
-                if None not in loc:
-                    history_locs.append(loc)
-        history_locs = np.array(history_locs).T
+        history_locs = self.history_locations.data.reshape(-1, 2)
+        history_locs = history_locs[~np.isnan(history_locs[:, 0])].T
         fig, ax = plt.subplots(1, figsize=self._figsize, dpi=self._dpi)
         fig.tight_layout(pad=0)
         self._heightmap(data=history_locs, ax=ax, kdeplot=do_kdeplot, cmap='gray_r', cbar=color_bar)
@@ -530,7 +1285,7 @@ class Model:
 
     def get_ani(self, agents=None, colour='k', alpha=.5, show_separation=False, wiggle_map=False):
         # Load Data
-        locs = np.array([agent.history_locations for agent in self.agents[:agents]]).transpose((1,2,0))
+        locs = self.history_locations[:, :agents].transpose((0,2,1))
         markersize = self.separation * 216*self._rel  # 3*72px/in=216
         #
         fig, ax = plt.subplots(figsize=self._figsize, dpi=self._dpi)
@@ -553,7 +1308,9 @@ class Model:
 
     @classmethod
     def set_random_seed(cls, seed=None):
-        """Set a new numpy random seed
+        """Set a new seed for the global numpy random state
+        The models draw from their own generator (self.random) rather than the
+        global random state, so this only affects code that uses np.random.
         :param seed: the optional seed value (if None then get one from os.urandom)
         """
         new_seed = int.from_bytes(os.urandom(4), byteorder='little') if seed == None else seed
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for stationsim_model.
+
+Run from this directory with `python -m unittest stationsim_model_tests`.
+"""
+
+import unittest
+import warnings
+import tempfile
+import copy
+import numpy as np
+from stationsim_model import Model
+from stationsim_batch import BatchModel
+import stationsim_index
+
+
+def run_model(model, steps):
+    """Step `model` up to `steps` times, stopping when everyone has left."""
+    for _ in range(steps):
+        if model.pop_finished == model.pop_total:
+            break
+        model.step()
+    return model
+
+
+class Test_Backends(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        warnings.simplefilter('ignore')
+        cls.model_params = {
+
+        'width': 60,
+        'height': 30,
+        'pop_total': 150,
+        'gates_speed': .3,
+
+        'gates_in': 3,
+        'gates_out': 2,
+        'gates_space': 2,
+
+        'speed_min': .2,
+        'speed_mean': 1,
+        'speed_std': 1,
+        'speed_steps': 3,
+
+        'separation': 5,
+        'max_wiggle': 1,
+
+        'step_limit': 3600,
+
+        'do_history': True,
+        'do_print': False,
+
+        'random_seed': 8,
+        }
+
+    def test_seeded_run(self):
+
+        """The 'numpy' backend reproduces the 'agent' backend.
+
+        Run a crowded model with each backend from the same seed and compare
+        the full history, the analytics and the random state at the end.
+        """
+
+        models = []
+        for backend in ('agent', 'numpy'):
+            model = run_model(Model(backend=backend, **self.model_params), 300)
+            models.append((model, model.random.bit_generator.state))
+        (agent, agent_random), (numpy, numpy_random) = models
+
+        np.testing.assert_array_equal(np.array(agent.history_state), np.array(numpy.history_state))
+        np.testing.assert_array_equal(np.array(agent.history_collision_locs), np.array(numpy.history_collision_locs))
+        np.testing.assert_array_equal(np.array(agent.history_wiggle_locs), np.array(numpy.history_wiggle_locs))
+        np.testing.assert_array_equal(agent.get_state(), numpy.get_state())
+        self.assertEqual(agent.get_analytics(), numpy.get_analytics())
+        self.assertEqual(agent_random, numpy_random)
+
+    def test_numba(self):
+
+        """The 'numba' backend reproduces the 'agent' backend.
+
+        Without Numba the model falls back to the 'numpy' backend, which
+        must also give the same run.
+        """
+
+        models = [run_model(Model(backend=backend, **self.model_params), 300) for backend in ('agent', 'numba')]
+        (agent, numba) = models
+        np.testing.assert_array_equal(np.array(agent.history_state), np.array(numba.history_state))
+        np.testing.assert_array_equal(np.array(agent.history_collision_locs), np.array(numba.history_collision_locs))
+        np.testing.assert_array_equal(np.array(agent.history_wiggle_locs), np.array(numba.history_wiggle_locs))
+        self.assertEqual(agent.get_analytics(), numba.get_analytics())
+        self.assertEqual(agent.random.bit_generator.state, numba.random.bit_generator.state)
+
+    def test_neighbour_index(self):
+
+        """The 'grid' neighbour index gives the same run as the 'kdtree' one."""
+
+        for backend in ('agent', 'numpy'):
+            kdtree, grid = [run_model(Model(backend=backend, neighbour_index=index, **self.model_params), 200)
+                            for index in ('kdtree', 'grid')]
+            np.testing.assert_array_equal(np.array(kdtree.history_state), np.array(grid.history_state))
+            np.testing.assert_array_equal(kdtree.get_state(), grid.get_state())
+
+    def test_crowded_exit(self):
+
+        """Agents that may leave after a wiggle are resolved in unique_id order.
+
+        Put the agents close to a single exit, so that whether a wiggling agent
+        leaves depends on its random wiggle, and compare one step of each
+        backend from the same state and generator.
+        """
+
+        params = dict(self.model_params, pop_total=40, width=20, height=10, gates_out=1, gates_space=1,
+                      separation=2, do_history=True)
+        for trial in range(20):
+            random = np.random.RandomState(trial)
+            status = random.choice([0, 1, 1, 1, 2], params['pop_total'])
+            location = np.column_stack([20 - random.exponential(1.5, params['pop_total']),
+                                        5 + random.normal(0, 1.5, params['pop_total'])])
+            location = np.clip(location, 0, [20, 10])
+            results = []
+            for backend in ('agent', 'numpy'):
+                model = Model(backend=backend, **params)
+                model.agents_status[:] = status
+                model.set_state(location, sensor='location2D')
+                model.step_id = 5
+                model.random = np.random.default_rng(trial)
+                model.step()
+                results.append((model.get_state(), np.array(model.history_wiggle_locs), model.random.integers(2**30)))
+            for agent, numpy in zip(*results):
+                np.testing.assert_array_equal(agent, numpy)
+
+    def test_schedule(self):
+
+        """The schedule and active_ids follow the statuses of the agents.
+
+        After each step active_ids are the active agents, and what is left of
+        the schedule is the agents that have not started. Setting the whole
+        state (with the statuses) makes both again from the statuses.
+        """
+
+        for backend in ('agent', 'numpy', 'numba'):
+            model = Model(backend=backend, **self.model_params)
+            for _ in range(60):
+                model.step()
+                np.testing.assert_array_equal(model.active_ids, np.flatnonzero(model.agents_status == 1))
+                pending = model.schedule[model.schedule_next:]
+                self.assertEqual(sorted(pending), list(np.flatnonzero(model.agents_status == 0)))
+                self.assertTrue(np.all(model.agents_steps_activate[pending] >= model.step_id - 1))
+            status = model.agents_status.copy()
+            status[:10] = 0
+            model.set_state(np.append(model.step_id, np.column_stack((status, model.agents_location))))
+            self.assertEqual(sorted(model.schedule), list(np.flatnonzero(model.agents_status == 0)))
+            np.testing.assert_array_equal(model.active_ids, np.flatnonzero(model.agents_status == 1))
+
+
+class Test_Index(unittest.TestCase):
+
+    def test_query_many(self):
+
+        """Every neighbour index finds the same points, in the same order.
+
+        Half of the points and locations are on a lattice, so that many of
+        the points are exactly r from a location.
+        """
+
+        random = np.random.default_rng(1)
+        boundaries = np.array([[0, 0], [100, 50]])
+        locations = random.uniform(boundaries[0], boundaries[1], (2000, 2))
+        locations[::2] = np.round(locations[::2])
+        targets = random.uniform(boundaries[0] - 3, boundaries[1] + 3, (1000, 2))
+        targets[::2] = np.round(targets[::2])
+        for r in (.5, 5, 12):
+            kdtree = stationsim_index.KDTreeIndex(locations, boundaries, 5).query_many(targets, r)
+            grid = stationsim_index.GridIndex(locations, boundaries, 5).query_many(targets, r)
+            np.testing.assert_array_equal(kdtree[0], grid[0])
+            np.testing.assert_array_equal(kdtree[1], grid[1])
+
+    def test_groups(self):
+
+        """A grouped GridIndex only finds the points of the group of each location."""
+
+        random = np.random.default_rng(2)
+        boundaries = np.array([[0, 0], [100, 50]])
+        locations = random.uniform(boundaries[0], boundaries[1], (3000, 2))
+        groups = random.integers(3, size=3000)
+        targets = random.uniform(boundaries[0], boundaries[1], (500, 2))
+        target_groups = random.integers(3, size=500)
+        counts, points = stationsim_index.GridIndex(locations, boundaries, 5, groups).query_many(targets, 5,
+                                                                                                  target_groups)
+        for g in range(3):
+            mine = np.flatnonzero(groups == g)
+            expected = stationsim_index.GridIndex(locations[mine], boundaries, 5).query_many(targets, 5)
+            rows = np.repeat(target_groups == g, counts)
+            np.testing.assert_array_equal(counts[target_groups == g], expected[0][target_groups == g])
+            np.testing.assert_array_equal(points[rows], mine[expected[1][np.repeat(target_groups == g,
+                                                                                   expected[0])]])
+
+
+class Test_Clone(unittest.TestCase):
+
+    def test_clone(self):
+
+        """A clone steps exactly as a deepcopy would, without sharing state."""
+
+        warnings.simplefilter('ignore')
+        model = run_model(Model(pop_total=60, width=50, height=20, gates_speed=.5, do_print=False,
+                                random_seed=4), 30)
+        deep, clone, history = copy.deepcopy(model), model.clone(), model.clone(include_history=True)
+        for other in (deep, clone, history):
+            run_model(other, 20)
+        np.testing.assert_array_equal(clone.get_state(), deep.get_state())
+        np.testing.assert_array_equal(np.asarray(history.history_state), np.asarray(deep.history_state))
+        self.assertEqual(len(clone.history_state), 20)
+        self.assertEqual(model.step_id, 30)
+
+        clone.copy_state_from(model)
+        np.testing.assert_array_equal(clone.get_state(), model.get_state())
+        self.assertIs(clone.agents[0].model, clone)
+
+
+class Test_Run(unittest.TestCase):
+
+    def test_run(self):
+
+        """Model.run gives the run of step(), recording only what is asked for."""
+
+        warnings.simplefilter('ignore')
+        params = dict(pop_total=60, width=50, height=20, gates_speed=.5, do_print=False, random_seed=7)
+        stepped = run_model(Model(**params), 3600)
+        for backend in ('agent', 'numpy', 'numba'):
+            model = Model(backend=backend, **params)
+            outputs = model.run(until=30, record=('states',))
+            np.testing.assert_array_equal(outputs['states'], np.asarray(stepped.history_state)[:30])
+            outputs = model.run(record=('analytics', 'collisions', 'counts'))
+            self.assertEqual(outputs['analytics'], stepped.get_analytics())
+            np.testing.assert_array_equal(outputs['collisions'], np.asarray(stepped.history_collision_locs))
+            self.assertEqual(outputs['counts'].shape, (10, 10))
+            self.assertEqual(len(model.history_state), model.step_id)
+            self.assertEqual(model.status, 0)
+            np.testing.assert_array_equal(model.get_state(), stepped.get_state())
+
+        model = Model(**dict(params, do_history=False))
+        self.assertEqual(model.run(record=()), {})
+        self.assertFalse(hasattr(model, 'history_state'))
+        np.testing.assert_array_equal(model.get_state(), stepped.get_state())
+
+        # The history that run() keeps for a model without do_history is not shared with its clones
+        model = Model(**dict(params, do_history=False))
+        collisions = len(model.run(until=20, record=('collisions',))['collisions'])
+        for clone in [model.clone()] + model.spawn(2):
+            clone.run(until=50, record=('collisions',))
+        self.assertEqual(len(model.history_collision_locs), collisions)
+
+
+class Test_Batch(unittest.TestCase):
+
+    def test_batch(self):
+
+        """Each replicate of a BatchModel steps exactly as its own Model does."""
+
+        warnings.simplefilter('ignore')
+        params = dict(pop_total=150, width=60, height=30, gates_speed=.3, gates_space=2, do_print=False,
+                      do_history=False, random_seed=8)
+        models = run_model(Model(**params), 20).spawn(4)
+        expected = [run_model(model.clone(), 200) for model in models]
+        batch = BatchModel.from_models(models)
+        batch.run(until=220)
+        self.assertEqual(batch.locations.shape, (4, 150, 2))
+        batch.copy_to(models)
+        for model, other in zip(models, expected):
+            np.testing.assert_array_equal(model.get_state('location2D'), other.get_state('location2D'))
+            np.testing.assert_array_equal(model.agents_status, other.agents_status)
+            self.assertEqual(model.pop_finished, other.pop_finished)
+            self.assertEqual(model.random.bit_generator.state, other.random.bit_generator.state)
+        np.testing.assert_array_equal(batch.replicate_finished, [model.pop_finished for model in models])
+
+        batch = BatchModel(2, **params)
+        batch.run(until=50)
+        for r, seed_sequence in enumerate(np.random.SeedSequence(8).spawn(2)):
+            model = run_model(Model(**dict(params, random_seed=seed_sequence)), 50)
+            np.testing.assert_array_equal(batch.get_state()[r], model.get_state('location2D'))
+
+
+class Test_Random(unittest.TestCase):
+
+    def test_seed(self):
+
+        """A model only draws from its own generator, so the same seed gives the same run."""
+
+        warnings.simplefilter('ignore')
+        params = dict(pop_total=40, width=50, height=20, gates_speed=.5, do_print=False, random_seed=6)
+        model = run_model(Model(**params), 40)
+        np.random.seed(0)
+        other = Model(**params)
+        np.random.random(100)
+        run_model(other, 40)
+        np.testing.assert_array_equal(np.asarray(model.history_state), np.asarray(other.history_state))
+
+    def test_spawn(self):
+
+        """Spawned models are independent of each other but reproducible from the seed."""
+
+        warnings.simplefilter('ignore')
+        params = dict(pop_total=40, width=50, height=20, gates_speed=.5, do_print=False, random_seed=6)
+        first, second = Model(**params).spawn(2), Model(**params).spawn(2)
+        draws = [[model.random.normal(size=5) for model in models] for models in (first, second)]
+        np.testing.assert_array_equal(draws[0], draws[1])
+        self.assertFalse(np.array_equal(*draws[0]))
+        np.testing.assert_array_equal(first[0].get_state(), first[1].get_state())
+
+
+class Test_History(unittest.TestCase):
+
+    def test_history_locations(self):
+
+        """history_locations holds the end of step locations of active agents.
+
+        The row for a step is the state at the start of the next step, with
+        nan for the agents that are not active.
+        """
+
+        warnings.simplefilter('ignore')
+        model = run_model(Model(pop_total=40, width=50, height=20, gates_speed=.5, do_print=False,
+                                random_seed=3), 60)
+        locations = np.asarray(model.history_locations)
+        state = np.asarray(model.history_state)
+        self.assertEqual(locations.shape, (model.step_id, model.pop_total, 2))
+        active = ~np.isnan(locations[:-1, :, 0])
+        np.testing.assert_array_equal(locations[:-1][active], state[1:][active])
+        np.testing.assert_array_equal(model.agents[0].history_locations, locations[:, 0])
+        self.assertEqual(len(model.history_collision_locs), len(model.history_collision_times))
+
+    def test_history_path(self):
+
+        """A history saved to history_path reopens with Model.load_history."""
+
+        warnings.simplefilter('ignore')
+        with tempfile.TemporaryDirectory() as history_path:
+            model = run_model(Model(pop_total=40, width=50, height=20, gates_speed=.5, do_print=False,
+                                    random_seed=3, history_path=history_path, step_limit=60), 60)
+            loaded = Model.load_history(history_path)
+            for name in Model._history_names:
+                np.testing.assert_array_equal(np.asarray(getattr(loaded, name)), np.asarray(getattr(model, name)))
+            self.assertEqual(loaded.get_analytics(), model.get_analytics())
+            del loaded
+
+
+if __name__ == "__main__":
+    unittest.main()
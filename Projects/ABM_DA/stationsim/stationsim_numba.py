@@ -0,0 +1,187 @@
+'''
+StationSim Numba
+    Compiled kernels for the 'numba' backend of the StationSim model.
+
+Description:
+    step_agents() runs Agent.step for the agents in unique_id order, as the
+    'agent' backend does, but over the model's agent arrays and in one call.
+    The neighbours of a location are found with a uniform grid (see
+    build_grid) rather than the KD-tree.
+
+    The kernels are compiled with Numba's @njit when Numba is installed.
+    Without it they are plain Python functions, which are far too slow to
+    step a model with, so Model falls back to the 'numpy' backend (see
+    NUMBA).
+'''
+
+import math
+import numpy as np
+try:
+    from numba import njit
+    NUMBA = True
+except ImportError:
+    NUMBA = False
+
+    def njit(*args, **kwargs):
+        '''
+        Stand in for numba.njit that leaves the function as it is.
+        '''
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda function: function
+
+
+@njit(cache=True)
+def _cell(x, origin, cell_size, n_cells):
+    i = int(np.floor((x - origin) / cell_size))
+    return min(max(i, 0), n_cells - 1)
+
+
+@njit(cache=True)
+def _counting_sort(locations, origin, cell_size, shape):
+    n_cells = shape[0] * shape[1]
+    cell = np.empty(len(locations), dtype=np.int64)
+    cell_start = np.zeros(n_cells + 1, dtype=np.int64)
+    for i in range(len(locations)):
+        cell[i] = (_cell(locations[i, 0], origin[0], cell_size, shape[0]) * shape[1]
+                   + _cell(locations[i, 1], origin[1], cell_size, shape[1]))
+        cell_start[cell[i] + 1] += 1
+    for c in range(n_cells):
+        cell_start[c + 1] += cell_start[c]
+    order = np.empty(len(locations), dtype=np.int64)
+    fill = cell_start[:-1].copy()
+    for i in range(len(locations)):
+        order[fill[cell[i]]] = i
+        fill[cell[i]] += 1
+    return cell_start, order
+
+
+def build_grid(locations, origin, cell_size, shape):
+    '''
+    Sort points into the cells of a uniform grid.
+
+    Description:
+        Cell (i, j) covers origin + [i, j] * cell_size to origin + [i+1, j+1]
+        * cell_size, and points outside the grid are put in the nearest cell.
+        The points are counting sorted by cell, in O(N) when compiled, so
+        that the points in cell c are order[cell_start[c]:cell_start[c+1]]
+        (with c = i * shape[1] + j), in ascending order.
+
+    Parameters:
+        locations - (N, 2) array of points
+        origin    - the lower corner of the grid
+        cell_size - the width and height of a cell
+        shape     - the number of cells in x and y
+
+    Returns:
+        cell_start - (shape[0] * shape[1] + 1) array of where each cell starts in order
+        order      - the indices of the points, sorted by cell
+    '''
+    locations = np.ascontiguousarray(locations, dtype=float)
+    origin = np.asarray(origin, dtype=float)
+    shape = np.asarray(shape, dtype=np.int64)
+    if NUMBA:
+        return _counting_sort(locations, origin, float(cell_size), shape)
+    index = np.clip(np.floor((locations - origin) / cell_size).astype(np.int64), 0, shape - 1)
+    cell = index[:, 0] * shape[1] + index[:, 1]
+    order = np.argsort(cell, kind='stable')
+    cell_start = np.concatenate([[0], np.cumsum(np.bincount(cell, minlength=shape[0] * shape[1]))])
+    return cell_start, order
+
+
+@njit(cache=True)
+def _blocked(i, x, y, separation, status, location, grid_location, grid_ids, origin, cell_size, shape, cell_start,
+             order):
+    '''
+    Agent.neighbourhood: whether an agent within separation of (x, y) at the
+    start of the step is active and no further back in x than x.
+    '''
+    i0 = _cell(x - separation, origin[0], cell_size, shape[0])
+    i1 = _cell(x + separation, origin[0], cell_size, shape[0])
+    j0 = _cell(y - separation, origin[1], cell_size, shape[1])
+    j1 = _cell(y + separation, origin[1], cell_size, shape[1])
+    for ci in range(i0, i1 + 1):
+        for c in range(ci * shape[1] + j0, ci * shape[1] + j1 + 1):
+            for k in order[cell_start[c]:cell_start[c + 1]]:
+                dx = grid_location[k, 0] - x
+                dy = grid_location[k, 1] - y
+                j = grid_ids[k]
+                # The squared distance, as cKDTree.query_ball_point compares it
+                if (dx * dx + dy * dy <= separation * separation and j != i and status[j] == 1
+                        and x <= location[j, 0]):
+                    return True
+    return False
+
+
+@njit(cache=True)
+def step_agents(step_id, status, location, loc_desire, speeds, n_speeds, speed, wiggle, steps_activate, step_start,
+                collisions, wiggles, boundaries, separation, gates_space, grid_location, grid_ids, origin, cell_size,
+                shape, cell_start, order, draws, do_history, collision_locs, wiggle_locs, finished):
+    '''
+    Agent.step for every agent on the grid in unique_id order.
+
+    Description:
+        Activates the agents that are due, and moves each active agent to
+        the fastest of its speeds that is inside the station and not blocked
+        (or wiggles it), and then removes it if it has reached its exit. The
+        agent arrays are changed in place.
+        Only the agents on the grid (grid_ids, in ascending order) are
+        stepped. These are the agents that are active or due, and Agent.step
+        leaves the others as they are.
+        The neighbours are the agents on the grid, which holds the locations
+        at the start of the step, and their status and x are read as they
+        are when the agent moves, as in Agent.neighbourhood. The wiggles use
+        draws in order.
+        Distances are taken as math.sqrt(x*x + y*y), like Agent.distance.
+
+    Returns:
+        n_activated  - the number of agents activated
+        n_collisions - the number of rows written to collision_locs
+        n_wiggles    - the number of rows written to wiggle_locs (and draws used)
+        n_finished   - the number of unique_ids written to finished
+    '''
+    n_activated = n_collisions = n_wiggles = n_finished = 0
+    for k in range(len(grid_ids)):
+        i = grid_ids[k]
+        if status[i] == 0:
+            if step_id > steps_activate[i]:
+                status[i] = 1
+                step_start[i] = step_id
+                n_activated += 1
+        elif status[i] == 1:
+            # Agent.move
+            x, y = location[i, 0], location[i, 1]
+            dx, dy = loc_desire[i, 0] - x, loc_desire[i, 1] - y
+            distance = math.sqrt(dx * dx + dy * dy)
+            dx, dy = dx / distance, dy / distance
+            for s in range(n_speeds[i]):
+                new_x, new_y = x + speeds[i, s] * dx, y + speeds[i, s] * dy
+                if not (boundaries[0, 0] <= new_x and boundaries[0, 1] <= new_y
+                        and new_x <= boundaries[1, 0] and new_y <= boundaries[1, 1]):
+                    collide = True
+                else:
+                    collide = _blocked(i, new_x, new_y, separation, status, location, grid_location, grid_ids,
+                                       origin, cell_size, shape, cell_start, order)
+                if not collide:
+                    break
+                if do_history:
+                    collisions[i] += 1
+                    collision_locs[n_collisions, 0], collision_locs[n_collisions, 1] = new_x, new_y
+                    n_collisions += 1
+                if s == n_speeds[i] - 1:
+                    new_x, new_y = x + 0., y + wiggle[i] * draws[n_wiggles]
+                    n_wiggles += 1
+                    if do_history:
+                        wiggles[i] += 1
+                        wiggle_locs[n_wiggles - 1, 0], wiggle_locs[n_wiggles - 1, 1] = new_x, new_y
+            # Rebound
+            location[i, 0] = min(max(new_x, boundaries[0, 0]), boundaries[1, 0])
+            location[i, 1] = min(max(new_y, boundaries[0, 1]), boundaries[1, 1])
+            speed[i] = speeds[i, s]
+            # Agent.deactivate
+            dx, dy = location[i, 0] - loc_desire[i, 0], location[i, 1] - loc_desire[i, 1]
+            if math.sqrt(dx * dx + dy * dy) < gates_space:
+                status[i] = 2
+                finished[n_finished] = i
+                n_finished += 1
+    return n_activated, n_collisions, n_wiggles, n_finished
@@ -90,11 +90,7 @@ class stationsim_RipleysK():
         with HiddenPrints():
             if single_process or n_runs == 1:
                 for _ in range(n_runs):
-                    #generate model and run til status goes back to 0 (finished)
-                    model = Model(**model_params)
-                    while model.status == 1:
-                        model.step()
-                    models.append(model)
+                    models.append(stationsim_RipleysK.run_model(model_params))
             else:
                 pool = multiprocessing.Pool()
                 try:
@@ -124,8 +120,8 @@ class stationsim_RipleysK():
             the finished model
         """
         model = Model(**model_params)
-        while model.status == 1:
-            model.step()
+        #only the collisions are needed for Ripley's K
+        model.run(record=("collisions",))
         return model
         
 
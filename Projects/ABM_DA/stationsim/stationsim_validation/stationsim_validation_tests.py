@@ -54,7 +54,7 @@ class Test_ssRK(unittest.TestCase):
         
         build a list of stationsim models of length 1 
         model has random_seed arguement 8
-        will produce an expected number of collisions (484)
+        will produce an expected number of collisions (496)
         assert number of collisions is the same
         
         (perhaps extend this to test further attributes.)
@@ -65,7 +65,7 @@ class Test_ssRK(unittest.TestCase):
                                                  self.model_params)
         
         actual = len(models[0].history_collision_locs) 
-        expected = 484
+        expected = 496
         
         "assert list of length 1"
         self.assertEqual(type(models), list)
@@ -90,10 +90,10 @@ class Test_ssRK(unittest.TestCase):
         actual_rkes, actual_rs = self.ssRK.ripleysKE(models, 
                                                      self.model_params)
         
-        expected_rkes = np.array([   0.      ,  747.576653, 1735.5369  ,
-                                  2419.18413 , 3162.740367, 3830.83855 , 
-                                  4518.04765 , 5203.250371, 5935.255249, 
-                                  6653.870481])
+        expected_rkes = np.array([    0.      ,  1625.90895 ,  2169.838498,
+                                  3266.328012,  6777.646718,  8441.553976,
+                                  9840.72623 , 11115.783897, 12232.55895 ,
+                                  13271.980354])
         
         expected_rs = np.array([ 0.      ,  7.856742, 15.713484,
                                    23.570226, 31.426968, 39.28371 ,
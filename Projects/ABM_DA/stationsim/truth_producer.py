@@ -0,0 +1,297 @@
+'''
+Truth Producer
+    Runs the base model of a filter ahead of it, in a thread or a process.
+
+Description:
+    The filters make their synthetic truth by stepping a base model in the
+    main process, and only then step their particles or ensemble, so the
+    two never overlap. A TruthProducer instead steps a clone of the base
+    model in a thread (or a process) of its own, and passes each new state
+    to the filter through a bounded queue, so the truth can run up to
+    `maxsize` steps ahead while the filter is busy with its particles:
+
+        truth = TruthProducer(base_model, until)
+        truth.step(base_model)  # in place of base_model.step()
+        ...
+        truth.close()
+
+    step() sets the base model to the next state of the clone, and its
+    generator to the clone's, so the rest of the filter (observing it,
+    counting its active agents, cloning it as the UKF does) does not
+    change. The clone's generator starts in the same state as the base
+    model's, so the truth is the same as stepping the base model itself.
+    With do_history the base model's history is also the same: step()
+    records its states, and the clone sends the collisions, wiggles and
+    finish times of each step (_event_names) for step() to add to it.
+    A process can step the truth at the same time as the particles, where
+    a thread only does while the particles are stepped by numpy or by the
+    worker processes.
+
+    Only the models of stationsim_model can be stepped this way, as
+    set_frame sets their agent arrays (agents_status and the _frame_arrays)
+    and records their history; the Agent objects of the Grand Central
+    model hold state that a frame does not carry.
+
+    Given a cache directory, the trajectory of the truth is saved there
+    once it has been produced, under a key made from the model's
+    parameters, seed and step, and any later run of the same scenario
+    replays it from the file rather than stepping the model again.
+'''
+
+import hashlib
+import json
+import os
+import queue
+import threading
+import multiprocessing
+import numpy as np
+
+try:
+    from stationsim_model import Model
+except ImportError:  # imported as part of the stationsim package
+    from .stationsim_model import Model
+
+
+# Where a TruthProducer can step the truth, the values of the filters' truth_producer parameter
+MODES = ('thread', 'process')
+
+# The parameters that do not change the trajectory of the model
+_free_params = ('random_seed', 'do_print', 'history_path')
+
+# The agent arrays, other than agents_status and agents_location, that the history and analytics need
+_frame_arrays = ('agents_step_start', 'agents_collisions', 'agents_wiggles')
+
+# The history that a model adds to at each step (if do_history), besides its states
+_event_names = ('history_collision_locs', 'history_collision_times', 'history_wiggle_locs', 'steps_taken',
+                'steps_exped', 'steps_delay')
+
+
+def cache_key(model, until):
+    '''
+    A key for the trajectory of `model` up to step `until`, from its class, parameters, seed and step.
+    '''
+    params = {key: value for key, value in model.params.items() if key not in _free_params}
+    scenario = dict(model=type(model).__name__, params=params, seed_entropy=model.seed_sequence.entropy,
+                    seed_spawn_key=model.seed_sequence.spawn_key, step_id=model.step_id, until=until)
+    return hashlib.sha1(json.dumps(scenario, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_frame(model):
+    '''
+    The state of the model that a filter sees: its step, population counts, agents_status, locations,
+    and the _frame_arrays.
+    '''
+    return np.concatenate([[model.step_id, model.pop_active, model.pop_finished], model.agents_status,
+                           model.get_state(sensor='location')] + [getattr(model, name) for name in _frame_arrays])
+
+
+def set_frame(model, frame, random_state=None, events=None):
+    '''
+    Set the model to a frame of get_frame, recording its history as Model.step does (if do_history).
+
+    Parameters:
+        model        - the model to set
+        frame        - a frame of get_frame
+        random_state - the state of the model's generator, model.random.bit_generator.state, if given
+        events       - the rows that the step added to each of the _event_names, if given
+    '''
+    n = model.pop_total
+    state = model.get_state(sensor='location2D')
+    if random_state is not None:
+        model.random.bit_generator.state = random_state
+    model.step_id, model.pop_active, model.pop_finished = (int(count) for count in frame[:3])
+    model.agents_status[:] = frame[3:3 + n]
+    model._init_schedule()
+    model.set_state(frame[3 + n:3 + 3 * n], sensor='location')
+    for k, name in enumerate(_frame_arrays):
+        getattr(model, name)[:] = frame[(3 + k) * n + 3:(4 + k) * n + 3]
+    if model.do_history:
+        model._history_states(state)
+        if events is not None:
+            for name, rows in zip(_event_names, events):
+                getattr(model, name).extend(rows)
+
+
+def _put(frames, item, stop):
+    '''
+    Put an item in the queue, waiting while it is full, unless the producer is stopped. Returns whether it was put.
+    '''
+    while not stop.is_set():
+        try:
+            frames.put(item, timeout=.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _produce(model, until, frames, stop, path):
+    '''
+    Step the model up to step `until` (or until it finishes), putting each frame, generator state and
+    events in the queue.
+
+    Description:
+        The events are the rows that each step added to the _event_names,
+        if the model has do_history (and None otherwise). Once the model
+        has finished the trajectory is saved to path (if it is not None)
+        and None is put in the queue. If the model raises, the error is put
+        in the queue instead, for the filter to raise.
+    '''
+    trajectory = [(get_frame(model), model.random.bit_generator.state, None)]
+    try:
+        while model.step_id < until:
+            step_id = model.step_id
+            lengths = [len(getattr(model, name)) for name in _event_names] if model.do_history else None
+            model.step()
+            if model.step_id == step_id:  # The model has finished
+                break
+            events = None
+            if model.do_history:
+                events = [np.array(getattr(model, name)[length:])
+                          for name, length in zip(_event_names, lengths)]
+            trajectory.append((get_frame(model), model.random.bit_generator.state, events))
+            if not _put(frames, trajectory[-1], stop):
+                return
+        if path is not None:
+            _save(path, trajectory, model.do_history)
+        _put(frames, None, stop)
+    except Exception as error:
+        _put(frames, error, stop)
+
+
+def _save(path, trajectory, do_history):
+    '''
+    Save a trajectory of _produce to path, written to a temporary file first so that it is never seen half written.
+
+    Description:
+        The rows of each of the events of every step are saved one after
+        the other, with the number that each step added in 'counts'.
+    '''
+    arrays = dict(frames=np.array([frame for frame, _, _ in trajectory]),
+                  random=np.array([json.dumps(random_state) for _, random_state, _ in trajectory]))
+    if do_history:
+        events = [events for _, _, events in trajectory[1:]]
+        counts = [[len(rows) for rows in step] for step in events]
+        arrays['counts'] = np.array(counts, dtype=int).reshape(-1, len(_event_names))
+        for k, name in enumerate(_event_names):
+            arrays[name] = np.concatenate([step[k] for step in events]) if events else np.empty(0)
+    temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temporary, 'wb') as file:
+        np.savez(file, **arrays)
+    os.replace(temporary, path)
+
+
+def _load(path):
+    '''
+    The trajectory saved by _save, as a list of the (frame, generator state, events) of each step.
+    '''
+    with np.load(path) as arrays:
+        frames = arrays['frames']
+        random_states = [json.loads(str(random_state)) for random_state in arrays['random']]
+        events = [None] * len(frames)
+        if 'counts' in arrays:
+            ends = np.cumsum(arrays['counts'], axis=0)
+            starts = ends - arrays['counts']
+            rows = [arrays[name] for name in _event_names]
+            events[1:] = [[rows[k][start[k]:end[k]] for k in range(len(_event_names))]
+                          for start, end in zip(starts, ends)]
+    return list(zip(frames, random_states, events))
+
+
+def check_mode(truth_producer):
+    '''
+    Raise a ValueError unless truth_producer is None or one of the MODES, as the filters check their parameters.
+    '''
+    if truth_producer is not None and truth_producer not in MODES:
+        raise ValueError(f"Unknown truth_producer '{truth_producer}', expected one of {', '.join(MODES)}")
+
+
+class TruthProducer:
+    '''
+    Steps a clone of a filter's base model ahead of the filter, in a thread or a process.
+
+    Parameters:
+        model   - the base model, a stationsim_model.Model, which is cloned (it is not stepped)
+        until   - the step to run the truth up to, the most the filter will step the base model
+        maxsize - the most steps the truth may run ahead of the filter
+        process - whether to step the truth in a process, rather than a thread
+        cache   - a directory to save the trajectory in, and to replay it from if it is already there
+
+    Attributes:
+        path     - the file of the trajectory in the cache, or None
+        replayed - whether the trajectory is replayed from the cache
+    '''
+    def __init__(self, model, until, maxsize=16, process=False, cache=None):
+        if not isinstance(model, Model):
+            raise TypeError(f'A TruthProducer can only step a stationsim_model.Model, not {type(model).__name__}')
+        self.path = None
+        if cache is not None:
+            os.makedirs(cache, exist_ok=True)
+            self.path = os.path.join(cache, f'{cache_key(model, until)}.npz')
+        self.replayed = self.path is not None and os.path.exists(self.path)
+        self._finished = False
+        self._worker = None
+        if self.replayed:
+            self._trajectory = _load(self.path)
+            self._next = 1  # The first frame is the state of the model now
+            return
+        clone = model.clone()
+        clone._record_states = False  # The filter's base model records its own states, see set_frame
+        if process:
+            self._frames, self._stop = multiprocessing.Queue(maxsize), multiprocessing.Event()
+            self._worker = multiprocessing.Process(target=_produce, daemon=True,
+                                                   args=(clone, until, self._frames, self._stop, self.path))
+        else:
+            self._frames, self._stop = queue.Queue(maxsize), threading.Event()
+            self._worker = threading.Thread(target=_produce, daemon=True,
+                                            args=(clone, until, self._frames, self._stop, self.path))
+        self._worker.start()
+
+    def _get(self):
+        '''
+        The next frame, generator state and events, or None once the truth has finished.
+        '''
+        if self._finished:
+            return None
+        if self.replayed:
+            if self._next == len(self._trajectory):
+                self._finished = True
+                return None
+            self._next += 1
+            return self._trajectory[self._next - 1]
+        item = self._frames.get()
+        if isinstance(item, Exception):
+            self._finished = True
+            raise item
+        if item is None:
+            self._finished = True
+        return item
+
+    def step(self, model):
+        '''
+        Step the base model, by setting it to the next state of the truth.
+
+        Description:
+            Once the truth has finished (or reached `until`) the base model
+            is left as it is, as Model.step does when the model has finished.
+        '''
+        item = self._get()
+        if item is not None:
+            set_frame(model, *item)
+
+    def close(self):
+        '''
+        Stop the producer, if it is still running.
+        '''
+        if self._worker is None:
+            return
+        self._stop.set()
+        while self._worker.is_alive():
+            # Empty the queue, so that a process is not left waiting to flush it
+            try:
+                self._frames.get(timeout=.1)
+            except queue.Empty:
+                pass
+        self._worker.join()
+        self._worker = None
+        self._finished = True
@@ -21,6 +21,7 @@ import datetime # for timing experiments
 import pickle # for saving class instances
 from scipy.stats import chi2 # for adaptive ukf test
 import glob
+from truth_producer import TruthProducer, check_mode # for stepping base_model ahead of the ukf
 
 def unscented_Mean(sigmas, wm, kf_function, **function_kwargs):
     
@@ -434,12 +435,19 @@ class ukf_ss:
         index and index 2 - indicate which agents are being observed
         ukf_histories- placeholder to store ukf trajectories
         time1 - start gate time used to calculate run time 
+        truth_producer - step base_model ahead in a 'thread' or 'process' (see truth_producer). default None, only for stationsim_model.Model
+        truth_cache - directory to save base_model's trajectory in and replay it from. default None, only for stationsim_model.Model
+        truth_queue_size - most steps truth_producer may run ahead. default 16
         """
         # call params
         self.model_params = model_params #stationsim parameters
         self.ukf_params = ukf_params # ukf parameters
         self.base_model = base_model #station sim
         
+        self.truth_producer = None
+        self.truth_cache = None
+        self.truth_queue_size = 16
+        self.truth = None
         for key in model_params.keys():
             setattr(self, key, model_params[key])
         for key in ukf_params.keys():
@@ -504,13 +512,16 @@ class ukf_ss:
         
         - forecast state using UKF (unscented transform)
         - update forecasts list
-        - jump base_model forwards to forecast time
+        - jump base_model forwards to forecast time (or to the next state of self.truth)
         - update truths list with new positions
         """
         
         self.ukf.predict() 
         self.forecasts.append(self.ukf.x)
-        self.base_model.step()
+        if self.truth is None:
+            self.base_model.step()
+        else:
+            self.truth.step(self.base_model)
         self.truths.append(self.base_model.get_state(sensor="location"))
 
     def ss_Update(self,step,**hx_kwargs):
@@ -564,24 +575,37 @@ class ukf_ss:
             -    repeat until all agents finish or max iterations reached
         -    if no agents then stop
         
+        with a truth_producer or truth_cache the true model is stepped ahead
+        of the ukf in a thread or process, or replayed from the cache.
         """
         
         "initialise UKF"
         self.init_ukf(self.ukf_params) 
-        for step in range(self.step_limit-1):
-            
-            "forecast next StationSim state and jump model forwards"
-            self.ss_Predict()
-            "assimilate forecasts using new model state."
-            self.ss_Update(step, **self.hx_kwargs)
-            
-            finished = self.base_model.pop_finished == self.pop_total
-            if finished: #break condition
-                break
-            
-            #elif np.nansum(np.isnan(self.ukf.x)) == 0:
-            #    print("math error. try larger values of alpha else check fx and hx.")
-            #    break
+        check_mode(self.truth_producer)
+        if self.truth_producer is not None or self.truth_cache is not None:
+            self.truth = TruthProducer(self.base_model, self.base_model.step_id + self.step_limit - 1,
+                                       self.truth_queue_size, process=self.truth_producer == "process",
+                                       cache=self.truth_cache)
+        try:
+            for step in range(self.step_limit-1):
+                
+                "forecast next StationSim state and jump model forwards"
+                self.ss_Predict()
+                "assimilate forecasts using new model state."
+                self.ss_Update(step, **self.hx_kwargs)
+                
+                finished = self.base_model.pop_finished == self.pop_total
+                if finished: #break condition
+                    break
+                
+                #elif np.nansum(np.isnan(self.ukf.x)) == 0:
+                #    print("math error. try larger values of alpha else check fx and hx.")
+                #    break
+        finally:
+            "stop the producer. it can not be pickled with the finished instance"
+            if self.truth is not None:
+                self.truth.close()
+                self.truth = None
           
 
         self.time2 = datetime.datetime.now()#timer
@@ -627,12 +651,10 @@ class ukf_ss:
             preds[j*self.sample_rate,:] = preds2[j,:]
 
         nan_array = np.ones(shape = truths.shape)*np.nan
-        for i, agent in enumerate(self.base_model.agents):
-            "find which rows are  NOT (None, None). Store in index. "
-            array = np.array(agent.history_locations)
-            index = ~np.equal(array,None)[:,0]
-            "set anything in index to 1. I.E which agents are still in model."
-            nan_array[index,2*i:(2*i)+2] = 1
+        "history_locations is nan wherever an agent is not in the model. set the rest to 1."
+        history_locations = self.base_model.history_locations.data
+        index = ~np.isnan(history_locations.reshape(history_locations.shape[0], -1))
+        nan_array[index] = 1
 
         return obs,preds,truths,nan_array
           